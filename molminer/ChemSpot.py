@@ -2,11 +2,12 @@ from .AbstractLinker import AbstractLinker
 from .utils import common_subprocess, get_input_file_type, get_text, dict_to_csv, eprint
 from .normalize import Normalizer
 from .OPSIN import OPSIN
+from .ChemSpotServer import ChemSpotClient, MODEL_OPTIONS
+from .scheduler import MemoryScheduler
+from .conversion import get_converter
+from .annotation import Annotator
 
-from rdkit.Chem import MolFromSmiles, MolToInchi, InchiToInchiKey
-
-from pubchempy import get_compounds, BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError
-from chemspipy import ChemSpider
+from joblib import Parallel, delayed
 
 from collections import ChainMap, OrderedDict
 import logging
@@ -59,11 +60,15 @@ class ChemSpot(AbstractLinker):
         Return dict with options having internal names.
     path_to_binary : str
         Path to ChemSpot binary.
+    server_address : str
+        Path to UNIX socket of running `ChemSpotServer`. If set, texts are tagged by this server instead of new ChemSpot process.
 
     Methods
     -------
     process
         Process the input file with ChemSpot.
+    process_many
+        Process many texts in one ChemSpot invocation.
     help
         Return ChemSpot help message.
     """
@@ -74,7 +79,7 @@ class ChemSpot(AbstractLinker):
         "path_to_dict": ("-d", "{}"),
         "path_to_ids": ("-i", "{}"),
         "path_to_multiclass": ("-M", "{}"),
-        #"n_threads": ("-T", "{}"),
+        "n_threads": ("-T", "{}"),
         "iob_format": ("-I", "")
     }
 
@@ -82,6 +87,8 @@ class ChemSpot(AbstractLinker):
     RE_ION = re.compile(r"^\s*(?P<ion>[A-Z][a-z]?)\s*\((?P<charge>-?\+?i+\+?-?|-?\+?I+\+?-?|\d+\+|\d+-|\+\d+|-\d+|\++|-+)\)\s*$")
     # matches charge digit or its signs
     RE_CHARGE = re.compile(r"(?P<roman>i+|I+)|(?P<digit>\d+)|(?P<signs>^\++|-+$)")
+    # separates documents joined in process_many(); the full stop ends the last sentence of previous document
+    DOCUMENT_SEPARATOR = "\n\n.\n\n"
 
     logger = logging.getLogger("chemspot")
 
@@ -93,8 +100,22 @@ class ChemSpot(AbstractLinker):
                  path_to_ids: str = "",
                  path_to_multiclass: str = "multiclass.bin",
                  tessdata_path: str = "",
-                 #n_threads: int = 0,
+                 n_threads=0,
                  max_memory: int = 8,
+                 server_address: str = "",
+                 chunk_size: int = 0,
+                 chunk_overlap: int = 500,
+                 chunk_jobs: int = 2,
+                 chunk_max_memory: int = 0,
+                 scheduler: MemoryScheduler = None,
+                 persistent_opsin: bool = False,
+                 opsin_cache_path: str = "",
+                 standardization_cache_path: str = "",
+                 annotation_cache_path: str = "",
+                 annotation_cache_ttl: float = 30,
+                 annotation_cache_negative_ttl: float = 7,
+                 annotation_backend: str = "online",
+                 pubchem_index_path: str = "",
                  verbosity: int = 1):
         """
         Parameters
@@ -114,8 +135,52 @@ class ChemSpot(AbstractLinker):
             Path to a multi-class model file. Enabled by default.
         tessdata_path : str
             Path to directory with Tesseract language data. If empty, the TESSDATA_PREFIX environment variable will be used.
+        n_threads : int or str
+            | Number of threads used by ChemSpot for tagging. If 0, ChemSpot's default is used.
+            | If "auto", use all CPUs. When text is tagged in chunks, these threads are divided among `chunk_jobs`
+              processes.
         max_memory : int
             Maximum amount of memory [GB] which can be used by Java process.
+        server_address : str
+            | Path to UNIX socket of running `ChemSpotServer` (see `molminer ner-server`). If set, texts are sent to this
+              long-lived ChemSpot worker, so Java VM startup and loading of models is not paid for each document.
+            | Model options (`path_to_crf` etc.) and `max_memory` are then given by the server. Warning is logged when
+              models of the server differ from model options of this instance.
+        chunk_size : int
+            | If greater than 0 and normalized text is longer, split the text at page or sentence boundaries into windows
+              of about this number of characters and tag them concurrently. Entities are then merged with global offsets.
+            | Use it for very large texts (theses, books) which would otherwise need too much memory in one Java process.
+        chunk_overlap : int
+            Number of characters shared by neighbouring windows, so entities on window boundary are not lost. Entities
+            found twice are deduplicated. It should be larger than twice the length of the longest expected entity.
+        chunk_jobs : int
+            Maximum number of ChemSpot processes tagging the windows concurrently.
+        chunk_max_memory : int
+            Maximum amount of memory [GB] for each ChemSpot process tagging one window. If 0, `max_memory` is used.
+        scheduler : MemoryScheduler
+            | If set, heap size of each ChemSpot process is estimated from input size (up to `max_memory`) and the process
+              is launched only when it fits to the memory budget shared with other Java processes on this host.
+            | It's also used for OPSIN conversion.
+        persistent_opsin : bool
+            If True, entities of all processed documents are converted by one long-lived OPSIN process
+            (see `OPSIN.persistent`), instead of starting new OPSIN for each document.
+        opsin_cache_path : str
+            Path to SQLite database with cached OPSIN conversions (see `cache_path` in `OPSIN`).
+        standardization_cache_path : str
+            Path to SQLite database with cached standardized molecules (see `conversion.MolConverter`), used for
+            OPSIN results and ions.
+        annotation_cache_path : str
+            Path to SQLite database with cached PubChem and ChemSpider lookups made in annotation, see
+            `annotation.Annotator`. It can be shared by processes and runs.
+        annotation_cache_ttl : float
+            Days after which cached lookup expires. If 0, it doesn't expire.
+        annotation_cache_negative_ttl : float
+            Days after which cached lookup with nothing found expires. If 0, it doesn't expire.
+        annotation_backend : str
+            "online" to annotate in PubChem and ChemSpider APIs, "offline" to annotate in local PubChem index at
+            `pubchem_index_path` (ChemSpider isn't searched then).
+        pubchem_index_path : str
+            Path to PubChem index built by `pubchem_index.build_pubchem_index`.
         verbosity : int
             This class's verbosity. Values: 0, 1, 2
         """
@@ -150,6 +215,29 @@ class ChemSpot(AbstractLinker):
         self.re_ion = self.RE_ION
         self.re_charge = self.RE_CHARGE
 
+        self.server_address = server_address
+        self._client = ChemSpotClient(server_address) if server_address else None
+        self._server_checked = False
+
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.chunk_jobs = chunk_jobs
+        self.chunk_max_memory = chunk_max_memory or max_memory
+
+        self.scheduler = scheduler
+        self.standardization_cache_path = standardization_cache_path
+        self.annotation_cache_path = annotation_cache_path
+        self.annotation_cache_ttl = annotation_cache_ttl
+        self.annotation_cache_negative_ttl = annotation_cache_negative_ttl
+        self.annotation_backend = annotation_backend
+        self.pubchem_index_path = pubchem_index_path
+        self.opsin = OPSIN(verbosity=verbosity, scheduler=scheduler, persistent=persistent_opsin, cache_path=opsin_cache_path,
+                           standardization_cache_path=standardization_cache_path)
+
+        self.n_threads_auto = n_threads == "auto"
+        if self.n_threads_auto:
+            n_threads = self.auto_threads()
+
         _, self.options, self.options_internal = self.build_commands(locals(), self._OPTIONS_REAL, path_to_binary)
         self.options_internal["max_memory"] = max_memory
 
@@ -164,6 +252,18 @@ class ChemSpot(AbstractLinker):
         """
 
         _, self.options, self.options_internal = self.build_commands(options, self._OPTIONS_REAL, self.path_to_binary)
+        self._server_checked = False
+
+    @staticmethod
+    def auto_threads() -> int:
+        """
+        Returns
+        -------
+        int
+            Number of CPUs for ChemSpot, at least 1.
+        """
+
+        return max(1, os.cpu_count() or 1)
 
     @staticmethod
     def version(self) -> str:
@@ -211,8 +311,9 @@ class ChemSpot(AbstractLinker):
                 normalize_text: bool = True,
                 remove_duplicates: bool = False,
                 annotate: bool = True,
-                annotation_sleep: int = 2,
+                annotation_sleep: float = 0,
                 chemspider_token: str = "",
+                annotation_workers: int = 8,
                 continue_on_failure: bool = False) -> OrderedDict:
         r"""
         Process the input file with ChemSpot.
@@ -274,10 +375,15 @@ class ChemSpot(AbstractLinker):
             | If entity has InChI key yet, prefer it in searching.
             | If "*" is present in SMILES, skip annotation.
             | If textual entity has single result in DB when searched by name, fill in missing identifiers (SMILES etc.).
-        annotation_sleep: int
-            How many seconds to sleep between annotation of each entity. It's for preventing overloading of databases.
+            | Each distinct entity (by InChI key, otherwise by name) is annotated once and its results are copied to its
+              other occurrences, also if `remove_duplicates` is False.
+        annotation_sleep: float
+            How many seconds each annotation worker sleeps after annotation of entity. Requests are already rate-limited
+            to published limits of the databases, so it's needed only for stricter limits.
         chemspider_token : str
             Your personal token for accessing the ChemSpider API (needed for annotation). Make account there to obtain it.
+        annotation_workers : int
+            Number of entities annotated concurrently.
         continue_on_failure : bool
             | If True, continue running even if ChemSpot returns non-zero exit code.
             | If False and error occurs, print it and return.
@@ -321,30 +427,19 @@ class ChemSpot(AbstractLinker):
             input_text, _ = get_text(input_file, input_type, lang=lang, tessdata_prefix=os.environ["TESSDATA_PREFIX"])
             input_file = ""
 
-        if annotate and not chemspider_token:
+        if annotate and not chemspider_token and self.annotation_backend == "online":
             self.logger.warning("Cannot perform annotation in ChemSpider: 'chemspider_token' is empty.")
 
-        options = ChainMap({k: v for k, v in {"iob_format": iob_format}.items() if v},
-                           self.options_internal)
-        output_file_temp = None
-
-        commands, _, _ = self.build_commands(options, self._OPTIONS_REAL, self.path_to_binary)
-        commands.insert(1, str(self.options_internal["max_memory"]))
-        commands.append("-t")
-
         if normalize_text:
-            normalizer = Normalizer(strip=True, collapse=True, hyphens=True, quotes=True, slashes=True, tildes=True, ellipsis=True)
-
             if input_file:
                 with open(input_file, mode="r") as f:
                     input_text = f.read()
 
-            input_text = normalizer(input_text)
+            input_text = self._normalize(input_text)
 
             if not input_text:
                 raise UserWarning("'input_text' is empty after normalization.")
 
-            input_text = self.normalize_text(text=input_text)
             input_file_normalized = NamedTemporaryFile(mode="w", encoding="utf-8")
             input_file_normalized.write(input_text)
             input_file_normalized.flush()
@@ -356,21 +451,32 @@ class ChemSpot(AbstractLinker):
                 input_file_temp.flush()
                 input_file = input_file_temp.name
 
-        commands.append(os.path.abspath(input_file))
-        commands.append("-o")
         if format_output:
             output_file_temp = NamedTemporaryFile(mode="w", encoding="utf-8")
-            commands.append(os.path.abspath(output_file_temp.name))
+            output_file_chs = output_file_temp.name
         else:
-            commands.append(os.path.abspath(output_file))
+            output_file_chs = output_file
+
+        commands = self._build_tag_commands(input_file, output_file_chs, iob_format=iob_format)
+        use_server = self._use_server(iob_format=iob_format) if format_output else False
 
         if dry_run:
+            if use_server:
+                return "send {} to ChemSpot server at {}".format(os.path.abspath(input_file), self.server_address)
             return " ".join(commands)
 
-        stdout, stderr, exit_code = common_subprocess(commands)
+        chunked = self.chunk_size > 0 and format_output and not iob_format
+        if chunked:
+            if not input_text:
+                with open(input_file, mode="r", encoding="utf-8") as f:
+                    input_text = f.read()
+            chunked = len(input_text) > self.chunk_size
 
-        if "OutOfMemoryError" in stderr:
-            raise RuntimeError("ChemSpot memory error: {}".format(stderr))
+        if chunked:
+            stdout, stderr, exit_code, entities = self._tag_chunked(input_text)
+        else:
+            stdout, stderr, exit_code, output_chs = self._tag(commands, input_file, read_output=format_output,
+                                                              use_server=use_server)
 
         to_return = {"stdout": stdout, "stderr": stderr, "exit_code": exit_code, "content": None,
                      "normalized_text": input_text if normalize_text else None}
@@ -380,221 +486,597 @@ class ChemSpot(AbstractLinker):
             eprint("\n\t".join("\n{}".format(stderr).splitlines()))
             return to_return
 
+        if not format_output:
+            return to_return
+
+        if not chunked:
+            entities = self.parse_chemspot_iob(text=output_chs) if iob_format else self.parse_chemspot(text=output_chs)
+
+        if remove_duplicates and not iob_format:
+            entities = self._remove_duplicates(entities)
+
+        to_return["content"] = self._format_entities(entities, input_text,
+                                                     paged=input_type in ["pdf", "pdf_scan"] or paged_text,
+                                                     opsin_types=opsin_types, convert_ions=convert_ions,
+                                                     standardize_mols=standardize_mols, output_file_sdf=output_file_sdf,
+                                                     sdf_append=sdf_append, annotate=annotate,
+                                                     annotation_sleep=annotation_sleep, chemspider_token=chemspider_token,
+                                                     annotation_workers=annotation_workers)
+
+        if output_file:
+            dict_to_csv(to_return["content"], output_file=output_file, csv_delimiter=csv_delimiter, write_header=write_header)
+
+        return to_return
+
+    def process_many(self,
+                     texts: list,
+                     output_file_sdf: str = "",
+                     sdf_append: bool = False,
+                     paged_text: bool = False,
+                     opsin_types: list = None,
+                     standardize_mols: bool = True,
+                     convert_ions: bool = True,
+                     normalize_text: bool = True,
+                     remove_duplicates: bool = False,
+                     annotate: bool = True,
+                     annotation_sleep: float = 0,
+                     chemspider_token: str = "",
+                     annotation_workers: int = 8,
+                     continue_on_failure: bool = False) -> list:
+        r"""
+        Process many texts in one ChemSpot invocation, so Java VM startup and loading of models is paid only once.
+        Texts are joined with `DOCUMENT_SEPARATOR` and found entities are then split back per document, with `start`
+        and `end` offsets relative to that document's (normalized) text and pages computed from it.
+
+        Parameters
+        ----------
+        texts : list of str
+            Texts to be processed by ChemSpot.
+        output_file_sdf : str
+            File to write SDF output in. SDF is from OPSIN converted entities of all documents.
+        sdf_append : bool
+            If True, append new molecules to existing SDF file or create new one if doesn't exist.
+        paged_text : bool
+            If True, try to assign pages to chemical entities. ASCII control character 12 (Form Feed, '\f') is expected
+            between pages of each text.
+        opsin_types : list
+            See `process`.
+        standardize_mols : bool
+            If True, use molvs (https://github.com/mcs07/MolVS) to standardize molecules converted by OPSIN.
+        convert_ions : bool
+            If True, try to convert ion entities (e.g. "Ni(II)") to SMILES.
+        normalize_text : bool
+            If True, normalize each text before performing NER.
+        remove_duplicates : bool
+            If True, remove duplicated chemical entities within each document.
+        annotate : bool
+            If True, try to annotate entities in PubChem and ChemSpider. See `process`.
+        annotation_sleep: float
+            How many seconds each annotation worker sleeps after annotation of entity.
+        chemspider_token : str
+            Your personal token for accessing the ChemSpider API (needed for annotation).
+        annotation_workers : int
+            Number of entities annotated concurrently.
+        continue_on_failure : bool
+            | If True, continue running even if ChemSpot returns non-zero exit code.
+            | If False and error occurs, print it and return results with None content.
+
+        Returns
+        -------
+        list of dicts
+            One dict per input text, with the same keys as returned by `process`. "stdout", "stderr" and "exit_code" are
+            shared by all documents.
+        """
+
+        if opsin_types is None:
+            opsin_types = ["SYSTEMATIC"]
+
+        if annotate and not chemspider_token and self.annotation_backend == "online":
+            self.logger.warning("Cannot perform annotation in ChemSpider: 'chemspider_token' is empty.")
+
         if normalize_text:
-            to_return["normalized_text"] = input_text
+            texts = [self._normalize(text) if text else "" for text in texts]
+
+        # start offset of each document in joined text
+        doc_starts = []
+        offset = 0
+        for text in texts:
+            doc_starts.append(offset)
+            offset += len(text) + len(self.DOCUMENT_SEPARATOR)
+        joined_text = self.DOCUMENT_SEPARATOR.join(texts)
+
+        if joined_text.strip():
+            stdout, stderr, exit_code, output_chs = self._tag_text(joined_text)
+        else:
+            stdout, stderr, exit_code, output_chs = "", "", 0, ""
 
-        if not format_output:
+        to_return = [{"stdout": stdout, "stderr": stderr, "exit_code": exit_code, "content": None,
+                      "normalized_text": text if normalize_text else None} for text in texts]
+
+        if not continue_on_failure and exit_code > 0:
+            self.logger.warning("ChemSpot error:")
+            eprint("\n\t".join("\n{}".format(stderr).splitlines()))
             return to_return
-        elif format_output:
-            with open(output_file_temp.name, mode="r", encoding="utf-8") as f:
+
+        entities_per_doc = [[] for _ in texts]
+        for ent in self.parse_chemspot(text=output_chs):
+            start = int(ent["start"])
+            i = bisect.bisect_right(doc_starts, start) - 1
+            if start >= doc_starts[i] + len(texts[i]):
+                # entity found in document separator
+                continue
+            ent["start"] = str(start - doc_starts[i])
+            ent["end"] = str(int(ent["end"]) - doc_starts[i])
+            entities_per_doc[i].append(ent)
+
+        # documents append to SDF, as the first one can have nothing for OPSIN to convert
+        if output_file_sdf and not sdf_append:
+            open(output_file_sdf, mode="w", encoding="utf-8").close()
+
+        for result, text, entities in zip(to_return, texts, entities_per_doc):
+            if remove_duplicates:
+                entities = self._remove_duplicates(entities)
+            result["content"] = self._format_entities(entities, text, paged=paged_text, opsin_types=opsin_types,
+                                                      convert_ions=convert_ions, standardize_mols=standardize_mols,
+                                                      output_file_sdf=output_file_sdf,
+                                                      sdf_append=True,
+                                                      annotate=annotate, annotation_sleep=annotation_sleep,
+                                                      chemspider_token=chemspider_token,
+                                                      annotation_workers=annotation_workers)
+
+        return to_return
+
+    def _normalize(self, text: str) -> str:
+        """
+        Normalize the text with `Normalizer` and `normalize_text`.
+        """
+
+        normalizer = Normalizer(strip=True, collapse=True, hyphens=True, quotes=True, slashes=True, tildes=True, ellipsis=True)
+        text = normalizer(text)
+        if not text:
+            return text
+        return self.normalize_text(text=text)
+
+    def _build_tag_commands(self, input_file: str, output_file: str, iob_format: bool = False,
+                            max_memory: int = 0, n_threads: int = 0) -> list:
+        """
+        Build commands for ChemSpot process which will tag `input_file` and write output to `output_file`.
+        """
+
+        options = ChainMap({k: v for k, v in {"iob_format": iob_format, "n_threads": n_threads}.items() if v},
+                           self.options_internal)
+
+        max_memory = max_memory or self.options_internal["max_memory"]
+        if self.scheduler:
+            uses_dict = any(self.options_internal.get(x, "\"''\"") != "\"''\"" for x in ["path_to_dict", "path_to_ids"])
+            max_memory = self.scheduler.heap_size("chemspot_dict" if uses_dict else "chemspot",
+                                                  input_size=os.path.getsize(input_file), max_memory=max_memory)
+
+        commands, _, _ = self.build_commands(options, self._OPTIONS_REAL, self.path_to_binary)
+        commands.insert(1, str(max_memory))
+        commands.extend(["-t", os.path.abspath(input_file), "-o", os.path.abspath(output_file)])
+        return commands
+
+    def _use_server(self, iob_format: bool = False) -> bool:
+        if self._client is None:
+            return False
+        if iob_format:
+            self.logger.warning("IOB format is not supported by ChemSpot server, new ChemSpot process will be used.")
+            return False
+        if not self._server_checked:
+            self._check_server()
+        return True
+
+    def _check_server(self):
+        """
+        Warn when models loaded by ChemSpot server differ from model options of this instance, as server's models are
+        used for tagging.
+        """
+
+        self._server_checked = True
+        try:
+            config = self._client.config()
+        except (OSError, RuntimeError) as e:
+            self.logger.warning("Cannot get configuration of ChemSpot server: {}".format(e))
+            return
+
+        for option in MODEL_OPTIONS:
+            value = self.options_internal.get(option, "")
+            value = os.path.abspath(value) if value and value != "\"''\"" else ""
+            if config.get(option, "") != value:
+                self.logger.warning("ChemSpot server uses {} '{}' instead of '{}'.".format(option, config.get(option, ""),
+                                                                                           value))
+
+    def _tag(self, commands: list, input_file: str, read_output: bool = True, use_server: bool = False) -> tuple:
+        """
+        Tag the `input_file` with ChemSpot server or new ChemSpot process.
+
+        Returns
+        -------
+        tuple
+            stdout, stderr, exit_code, ChemSpot output (empty if `read_output` is False)
+        """
+
+        if use_server:
+            with open(input_file, mode="r", encoding="utf-8") as f:
+                text = f.read()
+            try:
+                return "", "", 0, self._client.tag(text)
+            except (OSError, RuntimeError) as e:
+                return "", str(e), 1, ""
+
+        if self.scheduler:
+            with self.scheduler.reserve(int(commands[1]), tool="chemspot"):
+                stdout, stderr, exit_code = common_subprocess(commands)
+        else:
+            stdout, stderr, exit_code = common_subprocess(commands)
+
+        if "OutOfMemoryError" in stderr:
+            raise RuntimeError("ChemSpot memory error (try to increase 'max_memory' or to tag the text in chunks with "
+                               "'chunk_size'): {}".format(stderr))
+
+        output_chs = ""
+        if read_output:
+            with open(commands[-1], mode="r", encoding="utf-8") as f:
                 output_chs = f.read()
 
-            entities = self.parse_chemspot_iob(text=output_chs) if iob_format else self.parse_chemspot(text=output_chs)
-            to_return["content"] = entities
-
-            if remove_duplicates and not iob_format:
-                seen = set()
-                seen_add = seen.add
-                to_return["content"] = [x for x in to_return["content"] if not (x["entity"] in seen or seen_add(x["entity"]))]
-
-            if input_type in ["pdf", "pdf_scan"] or paged_text:
-                page_ends = []
-                for i, page in enumerate(input_text.split("\f")):
-                    if page.strip():
-                        try:
-                            page_ends.append(page_ends[-1] + len(page) - 1)
-                        except IndexError:
-                            page_ends.append(len(page) - 1)
-
-            if opsin_types:
-                if convert_ions:
-                    to_convert = [x["entity"] for x in to_return["content"] if x["type"] in opsin_types and not self.re_ion.match(x["entity"])]
-                else:
-                    to_convert = [x["entity"] for x in to_return["content"] if x["type"] in opsin_types]
-
-                if to_convert:
-                    opsin = OPSIN(verbosity=self.verbosity)
-                    opsin_converted = opsin.process(input=to_convert, output_formats=["smiles", "inchi", "inchikey"],
-                                                    standardize_mols=standardize_mols, output_file_sdf=output_file_sdf,
-                                                    sdf_append=sdf_append)
-                    opsin_converted = iter(opsin_converted["content"])
-                else:
-                    self.logger.info("Nothing to convert with OPSIN.")
-
-            if annotate:
-                chemspider = ChemSpider(chemspider_token) if chemspider_token else None
-
-            for i, ent in enumerate(to_return["content"]):
-                if input_type in ["pdf", "pdf_scan"] or paged_text:
-                    ent["page"] = str(bisect.bisect_left(page_ends, int(ent["start"])) + 1)
-
-                if convert_ions:
-                    match_ion = self.re_ion.match(ent["entity"])
-                    if match_ion:
-                        match_ion = match_ion.groupdict()
-                        match_charge = self.re_charge.search(match_ion["charge"])
-                        if match_charge:
-                            match_charge = match_charge.groupdict()
-                            if match_charge["roman"]:
-                                smiles = "[{}+{}]".format(match_ion["ion"], len(match_charge["roman"]))
-                            elif match_charge["digit"]:
-                                if "+" in match_ion["charge"]:
-                                    smiles = "[{}+{}]".format(match_ion["ion"], match_charge["digit"])
-                                elif "-" in match_ion["charge"]:
-                                    smiles = "[{}-{}]".format(match_ion["ion"], match_charge["digit"])
-                            elif match_charge["signs"]:
-                                smiles = "[{}{}{}]".format(match_ion["ion"], match_charge["signs"][0],
-                                                           len(match_charge["signs"]))
-
-                            mol = MolFromSmiles(smiles)
-                            if mol:
-                                inchi = MolToInchi(mol)
-                                if inchi:
-                                    ent.update(OrderedDict(
-                                        [("smiles", smiles), ("inchi", inchi), ("inchikey", InchiToInchiKey(inchi))]))
-                                else:
-                                    ent.update(OrderedDict([("smiles", smiles), ("inchi", ""), ("inchikey", "")]))
-                            else:
-                                ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", "")]))
-                    else:
-                        ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", "")]))
-
-                if opsin_types and to_convert:
-                    if ent["entity"] in to_convert:
-                        ent_opsin = next(opsin_converted)
-                        ent.update(OrderedDict([("smiles", ent_opsin["smiles"]), ("inchi", ent_opsin["inchi"]),
-                                                ("inchikey", ent_opsin["inchikey"]), ("opsin_error", ent_opsin["error"])]))
-                    elif convert_ions and self.re_ion.match(ent["entity"]):
-                        ent.update(OrderedDict([("opsin_error", "")]))
-                    elif (convert_ions and not self.re_ion.match(ent["entity"])) or (not convert_ions and ent["entity"] not in to_convert):
-                        ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", ""), ("opsin_error", "")]))
-
-                # TODO: this should be simplified...looks like garbage code
-                if annotate:
-                    self.logger.info("Annotating entity {}/{}...".format(i + 1, len(to_return["content"])))
-                    ent.update(OrderedDict([("pch_cids_by_inchikey", ""), ("chs_cids_by_inchikey", ""),
-                                            ("pch_cids_by_name", ""), ("chs_cids_by_name", ""),
-                                            ("pch_cids_by_smiles", ""), ("chs_cids_by_smiles", ""),
-                                            ("pch_cids_by_inchi", ""), ("chs_cids_by_inchi", ""),
-                                            ("pch_cids_by_formula", ""),
-                                            ("pch_iupac_name", ""), ("chs_common_name", ""),
-                                            ("pch_synonyms", "")]))
-
-                    # do "double-annotation": some entities can be found in only one DB, updated and then searched in second DB
-                    found_in_pch = False
-                    found_in_chs = False
-                    for _ in range(2):
-                        results = []
-
-                        # prefer InChI key
-                        if "inchikey" in ent and ent["inchikey"]:
-                            try:
-                                results = get_compounds(ent["inchikey"], "inchikey")
-                                if results:
-                                    if len(results) == 1:
-                                        result = results[0]
-                                        synonyms = result.synonyms
-                                        if synonyms:
-                                            ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
-                                        ent["pch_iupac_name"] = result.iupac_name
-                                        if not found_in_chs:
-                                            ent["smiles"] = result.canonical_smiles or ent["smiles"]
-                                            ent["inchi"] = result.inchi or ent["inchi"]
-                                            ent["inchikey"] = result.inchikey or ent["inchikey"]
-                                    ent["pch_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
-                            except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                pass
-
-                            results = chemspider.search(ent["inchikey"]) if chemspider_token else []
-                            if results:
-                                if len(results) == 1:
-                                    result = results[0]
-                                    ent["chs_common_name"] = result.common_name
-                                    if not found_in_pch:
-                                        ent["smiles"] = result.smiles or ent["smiles"]
-                                        ent["inchi"] = result.stdinchi or ent["inchi"]
-                                        ent["inchikey"] = result.stdinchikey or ent["inchikey"]
-                                ent["chs_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
+        return stdout, stderr, exit_code, output_chs
+
+    def _tag_text(self, text: str, iob_format: bool = False, max_memory: int = 0, n_threads: int = 0) -> tuple:
+        """
+        Tag the text with ChemSpot server or new ChemSpot process.
+
+        Returns
+        -------
+        tuple
+            stdout, stderr, exit_code, ChemSpot output
+        """
+
+        with NamedTemporaryFile(mode="w", encoding="utf-8") as input_file, \
+                NamedTemporaryFile(mode="w", encoding="utf-8") as output_file:
+            input_file.write(text)
+            input_file.flush()
+            commands = self._build_tag_commands(input_file.name, output_file.name, iob_format=iob_format,
+                                                max_memory=max_memory, n_threads=n_threads)
+            return self._tag(commands, input_file.name, use_server=self._use_server(iob_format=iob_format))
+
+    def _tag_chunked(self, text: str) -> tuple:
+        """
+        Split the text to overlapping windows (see `split_text`), tag them concurrently on at most `chunk_jobs`
+        ChemSpot processes and merge the entities. With ChemSpot server, windows are tagged one at a time, as the server
+        tags them one at a time anyway.
+
+        Entity found in overlap of two windows is taken from the first window if it starts before the middle of overlap,
+        otherwise from the second one. So entities cut by the window boundary are dropped in favour of complete ones.
+
+        Returns
+        -------
+        tuple
+            stdout, stderr, exit_code, list of parsed entities with offsets relative to `text`
+        """
+
+        chunks = self.split_text(text, self.chunk_size, self.chunk_overlap)
+        self.logger.info("Tagging {} chunks of text with ChemSpot...".format(len(chunks)))
+
+        n_threads = 0
+        if self.n_threads_auto:
+            n_threads = max(1, self.options_internal["n_threads"] // min(self.chunk_jobs, len(chunks)))
+
+        n_jobs = 1 if self._use_server() else self.chunk_jobs
+        outputs = Parallel(n_jobs=n_jobs, backend="threading")(
+            delayed(self._tag_text)(chunk, max_memory=self.chunk_max_memory, n_threads=n_threads) for _, chunk in chunks)
+
+        entities = []
+        seen = set()
+        for i, ((offset, chunk), (_, _, _, output_chs)) in enumerate(zip(chunks, outputs)):
+            # entities are owned by window in which they start between middles of its overlaps
+            own_start = (offset + chunks[i - 1][0] + len(chunks[i - 1][1])) // 2 if i > 0 else 0
+            own_end = (chunks[i + 1][0] + offset + len(chunk)) // 2 if i < len(chunks) - 1 else len(text)
+
+            for ent in self.parse_chemspot(text=output_chs):
+                start = int(ent["start"]) + offset
+                end = int(ent["end"]) + offset
+                if not own_start <= start < own_end or (start, end) in seen:
+                    continue
+                seen.add((start, end))
+                ent["start"] = str(start)
+                ent["end"] = str(end)
+                entities.append(ent)
+
+        entities.sort(key=lambda x: int(x["start"]))
+        stdout = "\n".join(x[0] for x in outputs if x[0])
+        stderr = "\n".join(x[1] for x in outputs if x[1])
+        exit_code = max(x[2] for x in outputs)
+        return stdout, stderr, exit_code, entities
+
+    @staticmethod
+    def split_text(text: str, chunk_size: int, overlap: int = 0) -> list:
+        r"""
+        Split the text to windows of at most `chunk_size` characters. Each window ends preferably on page boundary
+        (Form Feed, '\f'), then on sentence end and then on whitespace, if it can be found in the second half of window.
+        Neighbouring windows share `overlap` characters.
+
+        Parameters
+        ----------
+        text : str
+        chunk_size : int
+        overlap : int
+            It's reduced to quarter of `chunk_size` if larger.
+
+        Returns
+        -------
+        list of tuples
+            (offset of window in `text`, window text)
+        """
+
+        overlap = min(overlap, chunk_size // 4)
+        chunks = []
+        start = 0
+        while True:
+            end = start + chunk_size
+            if end >= len(text):
+                chunks.append((start, text[start:]))
+                return chunks
+
+            half = start + chunk_size // 2
+            for boundary in ["\f", ". ", ".\n", "\n", " "]:
+                i = text.rfind(boundary, half, end)
+                if i > -1:
+                    end = i + len(boundary)
+                    break
+
+            chunks.append((start, text[start:end]))
+
+            next_start = end - overlap
+            # don't start the window in the middle of a word
+            i = text.find(" ", next_start, end)
+            start = i + 1 if i > -1 else next_start
+
+    @staticmethod
+    def _remove_duplicates(entities: list) -> list:
+        seen = set()
+        seen_add = seen.add
+        return [x for x in entities if not (x["entity"] in seen or seen_add(x["entity"]))]
+
+    @staticmethod
+    def _page_ends(text: str) -> list:
+        """
+        Return list of positions of last characters of pages. Pages are separated by Form Feed ('\f').
+        """
+
+        page_ends = []
+        for page in text.split("\f"):
+            if page.strip():
+                try:
+                    page_ends.append(page_ends[-1] + len(page) - 1)
+                except IndexError:
+                    page_ends.append(len(page) - 1)
+        return page_ends
+
+    def _format_entities(self,
+                         entities: list,
+                         text: str,
+                         paged: bool = False,
+                         opsin_types: list = None,
+                         convert_ions: bool = True,
+                         standardize_mols: bool = True,
+                         output_file_sdf: str = "",
+                         sdf_append: bool = False,
+                         annotate: bool = True,
+                         annotation_sleep: float = 0,
+                         chemspider_token: str = "",
+                         annotation_workers: int = 8) -> list:
+        """
+        Assign pages to parsed entities, convert them with OPSIN and annotate them. See `process` for parameters.
+
+        Returns
+        -------
+        list of OrderedDicts
+        """
+
+        if paged:
+            page_ends = self._page_ends(text)
+
+        if opsin_types:
+            if convert_ions:
+                to_convert = OrderedDict.fromkeys(x["entity"] for x in entities
+                                                  if x["type"] in opsin_types and not self.re_ion.match(x["entity"]))
+            else:
+                to_convert = OrderedDict.fromkeys(x["entity"] for x in entities if x["type"] in opsin_types)
+
+            if to_convert:
+                _, opsin_index = self.opsin.process_unique(list(to_convert), output_formats=["smiles", "inchi", "inchikey"],
+                                                           standardize_mols=standardize_mols, output_file_sdf=output_file_sdf,
+                                                           sdf_append=sdf_append)
+            else:
+                self.logger.info("Nothing to convert with OPSIN.")
+
+        # ions are only sanitized, not standardized, so their SMILES are kept
+        converter = get_converter(standardize=False, cache_path=self.standardization_cache_path)
+
+        for ent in entities:
+            if paged:
+                ent["page"] = str(bisect.bisect_left(page_ends, int(ent["start"])) + 1)
+
+            if convert_ions:
+                match_ion = self.re_ion.match(ent["entity"])
+                if match_ion:
+                    match_ion = match_ion.groupdict()
+                    match_charge = self.re_charge.search(match_ion["charge"])
+                    if match_charge:
+                        match_charge = match_charge.groupdict()
+                        if match_charge["roman"]:
+                            smiles = "[{}+{}]".format(match_ion["ion"], len(match_charge["roman"]))
+                        elif match_charge["digit"]:
+                            if "+" in match_ion["charge"]:
+                                smiles = "[{}+{}]".format(match_ion["ion"], match_charge["digit"])
+                            elif "-" in match_ion["charge"]:
+                                smiles = "[{}-{}]".format(match_ion["ion"], match_charge["digit"])
+                        elif match_charge["signs"]:
+                            smiles = "[{}{}{}]".format(match_ion["ion"], match_charge["signs"][0],
+                                                       len(match_charge["signs"]))
+
+                        molecule, _ = converter.convert(smiles, "smiles")
+                        if molecule:
+                            ent.update(OrderedDict(
+                                [("smiles", smiles), ("inchi", molecule.inchi), ("inchikey", molecule.inchikey)]))
                         else:
-                            if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
-                                try:
-                                    results = get_compounds(ent["entity"] or ent["abbreviation"], "name")
-                                    if results:
-                                        if len(results) == 1:
-                                            found_in_pch = True
-                                            result = results[0]
-                                            synonyms = result.synonyms
-                                            if synonyms:
-                                                ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
-                                            # only update identifiers if they weren't found in second DB
-                                            if not found_in_chs:
-                                                ent["smiles"] = result.canonical_smiles or ent["smiles"]
-                                                ent["inchi"] = result.inchi or ent["inchi"]
-                                                ent["inchikey"] = result.inchikey or ent["inchikey"]
-                                            ent["pch_iupac_name"] = result.iupac_name
-                                        ent["pch_cids_by_name"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
-                                except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                    pass
-
-                            if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
-                                results = chemspider.search(ent["entity"] or ent["abbreviation"]) if chemspider_token else []
-                                if results:
-                                    if len(results) == 1:
-                                        found_in_chs = True
-                                        result = results[0]
-                                        if not found_in_pch:
-                                            ent["smiles"] = result.smiles or ent["smiles"]
-                                            ent["inchi"] = result.stdinchi or ent["inchi"]
-                                            ent["inchikey"] = result.stdinchikey or ent["inchikey"]
-                                        ent["chs_common_name"] = result.common_name
-                                    ent["chs_cids_by_name"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
-
-                            for search_field, col_pch, col_chs in [("smiles", "pch_cids_by_smiles", "chs_cids_by_smiles"),
-                                                                   ("inchi", "pch_cids_by_inchi", "chs_cids_by_inchi"),
-                                                                   ("formula", "pch_cids_by_formula", "")]:
-                                results_pch = []
-                                results_chs = []
-
-                                if search_field == "smiles" and "smiles" in ent and ent["smiles"] and "*" not in ent["smiles"]:
-                                    if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
-                                        try:
-                                            results_pch = get_compounds(ent["smiles"], "smiles")
-                                        except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                            pass
-                                    if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
-                                        results_chs = chemspider.search(ent["smiles"]) if chemspider_token else []
-                                elif search_field == "inchi" and "inchi" in ent and ent["inchi"]:
-                                    if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
-                                        try:
-                                            results_pch = get_compounds(ent["inchi"], "inchi")
-                                        except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                            pass
-                                    if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
-                                        results_chs = chemspider.search(ent["inchi"]) if chemspider_token else []
-                                elif search_field == "formula":
-                                    if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
-                                        try:
-                                            results_pch = get_compounds(ent["entity"], "formula")
-                                        except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                            pass
-                                    # ChemSpider doesn't have search field for 'formula'
-
-                                if results_pch:
-                                    ent[col_pch] = "\"{}\"".format(",".join([str(c.cid) for c in results_pch]))
-                                if results_chs:
-                                    ent[col_chs] = "\"{}\"".format(",".join([str(c.csid) for c in results_chs]))
-
-                                sleep(0.5)
-
-                        sleep(annotation_sleep)
-
-                        if not found_in_pch and not found_in_chs:
-                            break
-
-            if output_file:
-                dict_to_csv(to_return["content"], output_file=output_file, csv_delimiter=csv_delimiter, write_header=write_header)
+                            ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", "")]))
+                else:
+                    ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", "")]))
+
+            if opsin_types and to_convert:
+                if ent["entity"] in to_convert:
+                    ent_opsin = opsin_index.get(ent["entity"].strip(), {})
+                    ent.update(OrderedDict([("smiles", ent_opsin.get("smiles", "")), ("inchi", ent_opsin.get("inchi", "")),
+                                            ("inchikey", ent_opsin.get("inchikey", "")), ("opsin_error", ent_opsin.get("error", ""))]))
+                elif convert_ions and self.re_ion.match(ent["entity"]):
+                    ent.update(OrderedDict([("opsin_error", "")]))
+                elif (convert_ions and not self.re_ion.match(ent["entity"])) or (not convert_ions and ent["entity"] not in to_convert):
+                    ent.update(OrderedDict([("smiles", ""), ("inchi", ""), ("inchikey", ""), ("opsin_error", "")]))
+
+        if annotate:
+            annotator = self._get_annotator(chemspider_token, annotation_workers)
+            # InChI keys are resolved in bulk, entities then need requests only for other identifiers
+            annotator.pubchem.prefetch([x["inchikey"] for x in entities if x.get("inchikey")])
+            n_distinct = annotator.map_unique(lambda ent, annotator: self._annotate_entity(ent, annotator, annotation_sleep),
+                                              entities, key=self._annotation_key)
+            self.logger.info("Annotated {} entities ({} distinct) with {} workers.".format(len(entities), n_distinct,
+                                                                                         annotator.n_workers))
+            annotator.report(self.logger)
+
+        return entities
+
+    def _get_annotator(self, chemspider_token: str = "", n_workers: int = 8) -> Annotator:
+        """
+        Return `Annotator` configured by annotation options of this instance.
+        """
 
-        return to_return
+        return Annotator(chemspider_token=chemspider_token, n_workers=n_workers, backend=self.annotation_backend,
+                         index_path=self.pubchem_index_path, cache_path=self.annotation_cache_path,
+                         cache_ttl=self.annotation_cache_ttl, cache_negative_ttl=self.annotation_cache_negative_ttl,
+                         verbosity=self.verbosity)
+
+    @staticmethod
+    def _annotation_key(ent: OrderedDict) -> tuple:
+        """
+        Return identity of entity in annotation: entities with the same key are annotated once, see `process`. Names
+        are compared with normalized whitespace, but case-sensitive (e.g. "CO" and "Co" are different compounds).
+        """
+
+        if ent.get("inchikey"):
+            return "inchikey", ent["inchikey"]
+        return ("name", " ".join(ent["entity"].split()), " ".join(ent["abbreviation"].split()), ent.get("smiles", ""),
+                ent.get("inchi", ""))
+
+    @staticmethod
+    def _annotate_entity(ent: OrderedDict, annotator: Annotator, annotation_sleep: float = 0):
+        """
+        Annotate entity in PubChem and ChemSpider, see `process`. Called concurrently by `Annotator.map`.
+        """
+
+        ent.update(OrderedDict([("pch_cids_by_inchikey", ""), ("chs_cids_by_inchikey", ""),
+                                ("pch_cids_by_name", ""), ("chs_cids_by_name", ""),
+                                ("pch_cids_by_smiles", ""), ("chs_cids_by_smiles", ""),
+                                ("pch_cids_by_inchi", ""), ("chs_cids_by_inchi", ""),
+                                ("pch_cids_by_formula", ""),
+                                ("pch_iupac_name", ""), ("chs_common_name", ""),
+                                ("pch_synonyms", "")]))
+
+        # do "double-annotation": some entities can be found in only one DB, updated and then searched in second DB
+        found_in_pch = False
+        found_in_chs = False
+        for _ in range(2):
+            results = []
+
+            # prefer InChI key
+            if "inchikey" in ent and ent["inchikey"]:
+                results = annotator.pubchem.get_compounds(ent["inchikey"], "inchikey")
+                if results:
+                    if len(results) == 1:
+                        result = results[0]
+                        synonyms = result.synonyms
+                        if synonyms:
+                            ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
+                        ent["pch_iupac_name"] = result.iupac_name
+                        if not found_in_chs:
+                            ent["smiles"] = result.canonical_smiles or ent["smiles"]
+                            ent["inchi"] = result.inchi or ent["inchi"]
+                            ent["inchikey"] = result.inchikey or ent["inchikey"]
+                    ent["pch_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
+
+                results = annotator.search_chemspider(ent["inchikey"])
+                if results:
+                    if len(results) == 1:
+                        result = results[0]
+                        ent["chs_common_name"] = result.common_name
+                        if not found_in_pch:
+                            ent["smiles"] = result.smiles or ent["smiles"]
+                            ent["inchi"] = result.stdinchi or ent["inchi"]
+                            ent["inchikey"] = result.stdinchikey or ent["inchikey"]
+                    ent["chs_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
+            else:
+                if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
+                    results = annotator.pubchem.get_compounds(ent["entity"] or ent["abbreviation"], "name")
+                    if results:
+                        if len(results) == 1:
+                            found_in_pch = True
+                            result = results[0]
+                            synonyms = result.synonyms
+                            if synonyms:
+                                ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
+                            # only update identifiers if they weren't found in second DB
+                            if not found_in_chs:
+                                ent["smiles"] = result.canonical_smiles or ent["smiles"]
+                                ent["inchi"] = result.inchi or ent["inchi"]
+                                ent["inchikey"] = result.inchikey or ent["inchikey"]
+                            ent["pch_iupac_name"] = result.iupac_name
+                        ent["pch_cids_by_name"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
+
+                if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
+                    results = annotator.search_chemspider(ent["entity"] or ent["abbreviation"])
+                    if results:
+                        if len(results) == 1:
+                            found_in_chs = True
+                            result = results[0]
+                            if not found_in_pch:
+                                ent["smiles"] = result.smiles or ent["smiles"]
+                                ent["inchi"] = result.stdinchi or ent["inchi"]
+                                ent["inchikey"] = result.stdinchikey or ent["inchikey"]
+                            ent["chs_common_name"] = result.common_name
+                        ent["chs_cids_by_name"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
+
+                for search_field, col_pch, col_chs in [("smiles", "pch_cids_by_smiles", "chs_cids_by_smiles"),
+                                                       ("inchi", "pch_cids_by_inchi", "chs_cids_by_inchi"),
+                                                       ("formula", "pch_cids_by_formula", "")]:
+                    results_pch = []
+                    results_chs = []
+
+                    if search_field == "smiles" and "smiles" in ent and ent["smiles"] and "*" not in ent["smiles"]:
+                        if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
+                            results_pch = annotator.pubchem.get_compounds(ent["smiles"], "smiles")
+                        if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
+                            results_chs = annotator.search_chemspider(ent["smiles"])
+                    elif search_field == "inchi" and "inchi" in ent and ent["inchi"]:
+                        if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
+                            results_pch = annotator.pubchem.get_compounds(ent["inchi"], "inchi")
+                        if (not found_in_pch and not found_in_chs) or (found_in_pch and not found_in_chs):
+                            results_chs = annotator.search_chemspider(ent["inchi"])
+                    elif search_field == "formula":
+                        if (not found_in_pch and not found_in_chs) or (not found_in_pch and found_in_chs):
+                            results_pch = annotator.pubchem.get_compounds(ent["entity"], "formula")
+                        # ChemSpider doesn't have search field for 'formula'
+
+                    if results_pch:
+                        ent[col_pch] = "\"{}\"".format(",".join([str(c.cid) for c in results_pch]))
+                    if results_chs:
+                        ent[col_chs] = "\"{}\"".format(",".join([str(c.csid) for c in results_chs]))
+
+            if annotation_sleep:
+                sleep(annotation_sleep)
+
+            if not found_in_pch and not found_in_chs:
+                break
 
     @staticmethod
     def normalize_text(input_file_path: str = "", text: str = "", output_file_path: str = "",
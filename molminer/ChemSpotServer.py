@@ -0,0 +1,399 @@
+from .utils import eprint
+
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import struct
+import threading
+
+try:
+    import jpype
+except ImportError:
+    jpype = None
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+# frame header: unsigned 64-bit big-endian payload length
+FRAME_HEADER = struct.Struct(">Q")
+STATUS_OK = b"0"
+STATUS_ERROR = b"1"
+# request types, the first byte of client frame
+REQUEST_TAG = b"T"
+REQUEST_CONFIG = b"C"
+# model options of server, compared by client with its own ones
+MODEL_OPTIONS = ["path_to_crf", "path_to_nlp", "path_to_dict", "path_to_ids", "path_to_multiclass"]
+
+
+def send_frame(sock: socket.socket, data: bytes):
+    """
+    Send one length-prefixed frame.
+
+    Parameters
+    ----------
+    sock : socket.socket
+    data : bytes
+    """
+
+    sock.sendall(FRAME_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    """
+    Receive one length-prefixed frame.
+
+    Parameters
+    ----------
+    sock : socket.socket
+
+    Returns
+    -------
+    bytes
+        Payload of the frame.
+    """
+
+    header = _recv_exactly(sock, FRAME_HEADER.size)
+    length, = FRAME_HEADER.unpack(header)
+    return _recv_exactly(sock, length)
+
+
+def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("ChemSpot server closed the connection.")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+class ChemSpotServer(object):
+    """
+    Long-lived ChemSpot worker. Java VM is started only once (through JPype) and ChemSpot models (CRF, OpenNLP sentence,
+    multiclass and optionally dictionary and IDs) are loaded only once. Texts are then received over a local (UNIX)
+    socket and tagged, so the cost of each document is only the tagging time.
+
+    Protocol: each message is a frame with 8-byte big-endian length followed by payload. Client sends one request type
+    byte followed by UTF-8 text ("T") or nothing ("C" = configuration). Server responds with one status byte
+    ("0" = OK, "1" = error) followed by the tab-separated output in the same format as ChemSpot writes with "-o" option
+    (so it can be parsed with `ChemSpot.parse_chemspot`), JSON with paths to models (`MODEL_OPTIONS`) or error message.
+
+    **Usage:** ::
+
+        server = ChemSpotServer(max_memory=8)
+        server.serve("/tmp/chemspot.sock")  # blocks
+
+        # in another process
+        chemspot = ChemSpot(server_address="/tmp/chemspot.sock")
+        chemspot.process(input_text="...")
+
+    Methods
+    -------
+    start
+        Start the Java VM and load ChemSpot models.
+    tag
+        Tag the text and return ChemSpot's tab-separated output.
+    config
+        Return paths to models used by the server.
+    serve
+        Listen on UNIX socket and tag the received texts.
+    """
+
+    logger = logging.getLogger("chemspot_server")
+
+    def __init__(self,
+                 path_to_jar: str = "",
+                 path_to_crf: str = "",
+                 path_to_nlp: str = "",
+                 path_to_dict: str = "",
+                 path_to_ids: str = "",
+                 path_to_multiclass: str = "multiclass.bin",
+                 max_memory: int = 8,
+                 verbosity: int = 1):
+        """
+        Parameters
+        ----------
+        path_to_jar : str
+            | Path to ChemSpot JAR file. If empty, "CHEMSPOT_JAR" environment variable is used or "chemspot.jar" is
+              searched in the same directory as "chemspot" run script.
+        path_to_crf : str
+            Path to a CRF model file (internal default model file will be used if not provided).
+        path_to_nlp : str
+            Path to a OpenNLP sentence model file (internal default model file will be used if not provided).
+        path_to_dict : str
+            Path to a zipped set of brics dictionary automata. Disabled by default, set to 'dict.zip' to use default
+            dictionary.
+        path_to_ids : str
+            Path to a zipped tab-separated text file representing a map of terms to ids. Disabled by default,
+            set to `ids.zip` to use default IDs.
+        path_to_multiclass : str
+            Path to a multi-class model file. Enabled by default.
+        max_memory : int
+            Maximum amount of memory [GB] which can be used by Java VM.
+        verbosity : int
+            This class's verbosity. Values: 0, 1, 2
+        """
+
+        if verbosity > 2:
+            verbosity = 2
+        elif verbosity not in verbosity_levels:
+            verbosity = 1
+        self.logger.setLevel(verbosity_levels[verbosity])
+
+        if not path_to_jar:
+            if "CHEMSPOT_JAR" in os.environ:
+                path_to_jar = os.environ["CHEMSPOT_JAR"]
+            else:
+                script = shutil.which("chemspot")
+                path_to_jar = os.path.join(os.path.dirname(os.path.realpath(script)), "chemspot.jar") if script else "chemspot.jar"
+
+        if path_to_dict == "dict.zip" and "CHEMSPOT_DATA_PATH" in os.environ:
+            path_to_dict = "{}/{}".format(os.environ["CHEMSPOT_DATA_PATH"], "dict.zip")
+        if path_to_ids == "ids.zip" and "CHEMSPOT_DATA_PATH" in os.environ:
+            path_to_ids = "{}/{}".format(os.environ["CHEMSPOT_DATA_PATH"], "ids.zip")
+        if path_to_multiclass == "multiclass.bin" and "CHEMSPOT_DATA_PATH" in os.environ:
+            path_to_multiclass = "{}/{}".format(os.environ["CHEMSPOT_DATA_PATH"], "multiclass.bin")
+
+        self.path_to_jar = path_to_jar
+        self.path_to_crf = path_to_crf
+        self.path_to_nlp = path_to_nlp
+        self.path_to_dict = path_to_dict
+        self.path_to_ids = path_to_ids
+        self.path_to_multiclass = path_to_multiclass
+        self.max_memory = max_memory
+        self._tagger = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start the Java VM and load ChemSpot models. Called automatically by `tag` and `serve`.
+        """
+
+        if self._tagger is not None:
+            return
+
+        if jpype is None:
+            raise ImportError("ChemSpot server needs JPype to run ChemSpot inside this process. Install it with "
+                              "'pip install molminer[server]' or 'conda install -c conda-forge jpype1'.")
+
+        if not os.path.isfile(self.path_to_jar):
+            raise FileNotFoundError("ChemSpot JAR file not found: {}".format(self.path_to_jar))
+
+        self.logger.info("Starting Java VM and loading ChemSpot models...")
+        if not jpype.isJVMStarted():
+            jpype.startJVM("-Xmx{}G".format(self.max_memory), classpath=[self.path_to_jar], convertStrings=True)
+
+        if self.path_to_crf or self.path_to_nlp:
+            # same constructor as used by ChemSpot's command-line interface with "-m" and "-s" options
+            chemspot = jpype.JClass("de.berlin.hu.chemspot.ChemSpot")
+            self._tagger = chemspot(self.path_to_crf or None, self.path_to_dict or None, self.path_to_nlp or None,
+                                    self.path_to_ids or None, self.path_to_multiclass or None)
+        else:
+            factory = jpype.JClass("de.berlin.hu.chemspot.ChemSpotFactory")
+            self._tagger = factory.createChemSpot(self.path_to_dict or None, self.path_to_ids or None,
+                                                  self.path_to_multiclass or None)
+        self.logger.info("ChemSpot models loaded.")
+
+    def tag(self, text: str) -> str:
+        """
+        Tag the text.
+
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        str
+            | Tab-separated output, one entity per line: start, end, entity, type
+            | Same as the output file written by ChemSpot's command-line interface.
+        """
+
+        self.start()
+
+        with self._lock:
+            mentions = self._tagger.tag(text)
+
+        # ChemSpot's command-line interface writes inclusive end offsets
+        return "".join("{}\t{}\t{}\t{}\n".format(m.getStart(), m.getEnd() - 1, m.getText(), m.getType())
+                       for m in mentions)
+
+    def config(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            Absolute paths to models used by the server, keyed by `MODEL_OPTIONS`. Disabled models have empty path.
+        """
+
+        return {x: os.path.abspath(getattr(self, x)) if getattr(self, x) else "" for x in MODEL_OPTIONS}
+
+    def serve(self, address: str):
+        """
+        Listen on UNIX socket and tag the received texts. Blocks until interrupted.
+
+        Parameters
+        ----------
+        address : str
+            Path to UNIX socket. Existing file will be replaced.
+        """
+
+        self.start()
+
+        if os.path.exists(address):
+            os.remove(address)
+
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        request = recv_frame(self.request)
+                    except ConnectionError:
+                        return
+
+                    try:
+                        if request[:1] == REQUEST_CONFIG:
+                            response = STATUS_OK + json.dumps(server.config()).encode("utf-8")
+                        elif request[:1] == REQUEST_TAG:
+                            response = STATUS_OK + server.tag(request[1:].decode("utf-8")).encode("utf-8")
+                        else:
+                            raise ValueError("Unknown request type: {}".format(request[:1]))
+                    except Exception as e:
+                        server.logger.warning("Cannot tag text: {}".format(e))
+                        response = STATUS_ERROR + str(e).encode("utf-8")
+                    try:
+                        send_frame(self.request, response)
+                    except ConnectionError:
+                        # client closed the connection, e.g. after timeout
+                        return
+
+        with socketserver.ThreadingUnixStreamServer(address, Handler) as unix_server:
+            unix_server.daemon_threads = True
+            self.logger.info("ChemSpot server is listening on {}".format(address))
+            try:
+                unix_server.serve_forever()
+            except KeyboardInterrupt:
+                eprint("ChemSpot server stopped.")
+            finally:
+                if os.path.exists(address):
+                    os.remove(address)
+
+
+class ChemSpotClient(object):
+    """
+    Client for `ChemSpotServer`. One connection is kept open and reused for all texts. Client can be shared by threads,
+    their requests are sent one at a time.
+
+    Methods
+    -------
+    tag
+        Send the text to server and return ChemSpot's tab-separated output.
+    config
+        Return paths to models used by the server.
+    close
+        Close the connection.
+    """
+
+    def __init__(self, address: str, timeout: float = None):
+        """
+        Parameters
+        ----------
+        address : str
+            Path to UNIX socket of running `ChemSpotServer`.
+        timeout : float
+            Socket timeout in seconds. None means to wait forever.
+        """
+
+        self.address = address
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"address": self.address, "timeout": self.timeout}
+
+    def __setstate__(self, state):
+        self.__init__(state["address"], state["timeout"])
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            self._sock.connect(self.address)
+
+    def _request(self, request: bytes) -> str:
+        """
+        Send the request and return the payload of response.
+
+        Raises
+        ------
+        RuntimeError
+            When the server fails to process the request.
+        """
+
+        with self._lock:
+            # reconnect once if the server was restarted since the last call
+            for attempt in range(2):
+                try:
+                    self._connect()
+                    send_frame(self._sock, request)
+                    response = recv_frame(self._sock)
+                    break
+                except ConnectionError:
+                    self.close()
+                    if attempt:
+                        raise
+                except BaseException:
+                    # after timeout or partial frame the late response would be read by the next request
+                    self.close()
+                    raise
+
+        status, payload = response[:1], response[1:].decode("utf-8")
+        if status != STATUS_OK:
+            raise RuntimeError("ChemSpot server error: {}".format(payload))
+        return payload
+
+    def tag(self, text: str) -> str:
+        """
+        Parameters
+        ----------
+        text : str
+
+        Returns
+        -------
+        str
+            Tab-separated output which can be parsed with `ChemSpot.parse_chemspot`.
+
+        Raises
+        ------
+        RuntimeError
+            When the server fails to tag the text.
+        """
+
+        return self._request(REQUEST_TAG + text.encode("utf-8"))
+
+    def config(self) -> dict:
+        """
+        Returns
+        -------
+        dict
+            Absolute paths to models used by the server, see `ChemSpotServer.config`.
+        """
+
+        return json.loads(self._request(REQUEST_CONFIG))
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
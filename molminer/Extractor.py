@@ -2,6 +2,9 @@ from .OPSIN import OPSIN
 from .OSRA import OSRA
 from .ChemSpot import ChemSpot
 from .utils import get_input_file_type, dict_to_csv, get_temp_images, get_text, write_empty_file
+from .scheduler import MemoryScheduler
+from .conversion import report_stats
+from .prefilter import DEFAULT_THRESHOLD
 
 from joblib import Parallel, delayed
 
@@ -57,7 +60,7 @@ class Extractor(object):
         "path_to_dict": "''",
         "path_to_ids": "''",
         "path_to_multiclass": "multiclass.bin",
-        #"n_threads": 0,
+        "n_threads": 0,
         "max_memory": 8
     }
 
@@ -68,6 +71,7 @@ class Extractor(object):
                  osra_options: dict = osra_default_options,
                  chemspot_options: dict = chemspot_default_options,
                  tessdata_path: str = "",
+                 memory_budget: float = 0,
                  verbosity: int = 1,
                  verbosity_classes: int = 1):
         """
@@ -78,8 +82,14 @@ class Extractor(object):
         opsin_options : dict
         osra_options : dict
         chemspot_options : dict
+            | Set "n_threads" to "auto" to give ChemSpot all CPUs (OSRA jobs are finished before ChemSpot starts).
         tessdata_path : str
             Path to directory with Tesseract language data. If empty, the TESSDATA_PREFIX environment variable will be used.
+        memory_budget : float
+            | Total memory [GB] for Java processes (ChemSpot, OPSIN) on this host. If greater than 0, heap sizes are
+              estimated from input size and launches are queued so the sum of heaps stays under budget, also across
+              other Extractor instances and processes (see `MemoryScheduler`).
+            | Maximum heap size is still given by "max_memory" in `chemspot_options` and `opsin_options`.
         verbosity : int
             This class's verbosity. Values: 0, 1, 2
         verbosity_classes : int
@@ -104,9 +114,11 @@ class Extractor(object):
         chemspot_options["verbosity"] = verbosity_classes
         opsin_options["verbosity"] = verbosity_classes
 
+        self.scheduler = MemoryScheduler(memory_budget, verbosity=verbosity) if memory_budget > 0 else None
+
         self.osra = OSRA(**osra_options)
-        self.chemspot = ChemSpot(**chemspot_options)
-        self.opsin = OPSIN(**opsin_options)
+        self.chemspot = ChemSpot(scheduler=self.scheduler, **chemspot_options)
+        self.opsin = OPSIN(scheduler=self.scheduler, **opsin_options)
 
     """
     def _parallel_job(self, worker, queue, input, **kwargs):
@@ -142,14 +154,20 @@ class Extractor(object):
                 lang: str = "eng",
                 use_gm: bool = True,
                 n_jobs: int = -1,
+                osra_figures_only: bool = False,
+                osra_prefilter: bool = False,
+                osra_prefilter_threshold: int = DEFAULT_THRESHOLD,
+                timeout: float = 0,
+                cpu_time: int = 0,
                 opsin_types: list = None,
                 convert_ions: bool = True,
                 standardize_mols: bool = True,
                 remove_entity_duplicates: bool = False,
                 csv_delimiter: str = ";",
                 annotate: bool = True,
-                annotation_sleep: int = 2,
-                chemspider_token: str = "") -> list:
+                annotation_sleep: float = 0,
+                chemspider_token: str = "",
+                annotation_workers: int = 8) -> list:
         """
         Process the input file with OSRA and ChemSpot. IUPAC entities found by ChemSpot are converted by OPSIN to linear
         notation.
@@ -188,6 +206,20 @@ class Extractor(object):
             | If -1 all CPUs are used.
             | If 1 is given, no parallel computing code is used at all, which is useful for debugging.
             | For n_jobs below -1, (n_cpus + 1 + n_jobs) are used. Thus for n_jobs = -2, all CPUs but one are used.
+            | OSRA jobs are finished before ChemSpot starts, so ChemSpot's "n_threads" set to "auto" uses all CPUs.
+        osra_figures_only : bool
+            If True and input is PDF (not scanned), OSRA processes only regions of embedded images and vector drawings
+            looking like 2D structures instead of whole pages. See `figures_only` in `OSRA.process`.
+        osra_prefilter : bool
+            If True, skip OSRA for pages without drawings looking like 2D structure. See `prefilter` in `OSRA.process`.
+        osra_prefilter_threshold : int
+            Minimal number of structure-like drawings on page processed by OSRA.
+        timeout : float
+            | Wall-clock timeout [s] for each run of OSRA and Tesseract on one page. Killed pages are logged (and
+              returned in "timeouts" of OSRA output) and the rest of document is processed.
+            | If 0, there is no timeout.
+        cpu_time : int
+            CPU time limit [s] for each run of OSRA and Tesseract on one page, handled like `timeout`.
         opsin_types : list
             | List of ChemSpot entity types. Entities of types in this list will be converted with OPSIN.
             | OPSIN is designed to convert IUPAC names to linear notation (SMILES etc.) so default value of `opsin_types`
@@ -209,10 +241,13 @@ class Extractor(object):
             | If entity has InChI key yet, prefer it in searching.
             | If "*" is present in SMILES, skip annotation.
             | If textual entity has single result in DB when searched by name, fill in missing identifiers (SMILES etc.).
-        annotation_sleep: int
-            How many seconds to sleep between annotation of each entity. It's for preventing overloading of databases.
+        annotation_sleep: float
+            How many seconds each annotation worker sleeps after annotation of entity found by ChemSpot. Requests are
+            already rate-limited to published limits of the databases.
         chemspider_token : str
             Your personal token for accessing the ChemSpider API (needed for annotation). Make account there to obtain it.
+        annotation_workers : int
+            Number of entities annotated concurrently.
 
         Returns
         -------
@@ -254,7 +289,12 @@ class Extractor(object):
             self.logger.warning("Cannot write separated output: 'output_file' is not set.")
 
         self.logger.info("Extracting text..." + (" (Tesseract OCR)" if input_type == "pdf_scan" else ""))
-        text, temp_images_dir = get_text(input_file, input_type, lang=lang)
+        text_timeouts = []
+        text, temp_images_dir = get_text(input_file, input_type, lang=lang, timeout=timeout, cpu_time=cpu_time,
+                                         timeouts=text_timeouts)
+        if text_timeouts:
+            self.logger.warning("Tesseract was killed on pages {}, their text is missing.".format(
+                ", ".join(str(x["page"]) for x in text_timeouts)))
 
         if input_type == "pdf_scan":
             self.logger.info("Converting PDF to temporary images...")
@@ -265,17 +305,30 @@ class Extractor(object):
                 delayed(self.osra.process)(temp_image_file, use_gm=False, input_type="image", custom_page=page,
                                            output_formats=["smiles", "inchi", "inchikey"], osra_output_format="sdf",
                                            standardize_mols=standardize_mols, output_file_sdf=output_file_sdf_osra, sdf_append=sdf_append,
-                                           annotate=annotate, chemspider_token=chemspider_token)
+                                           annotate=False, prefilter=osra_prefilter,
+                                           prefilter_threshold=osra_prefilter_threshold, timeout=timeout, cpu_time=cpu_time)
                                            for temp_image_file, page in temp_image_files)
             temp_images_dir.cleanup()
-            ocsr = OrderedDict([("stdout", []), ("stderr", []), ("content", []), ("pages", [])])
+            ocsr = OrderedDict([("stdout", []), ("stderr", []), ("content", []), ("pages", []), ("skipped_pages", []),
+                                ("timeouts", [])])
             for x, (_, page) in zip(ocsr_list, temp_image_files):
-                if x["stdout"][0]:
+                ocsr["skipped_pages"].extend(x["skipped_pages"])
+                ocsr["timeouts"].extend(x["timeouts"])
+                if x["stdout"] and x["stdout"][0]:
                     ocsr["stdout"].extend(x["stdout"])
                     ocsr["stderr"].extend(x["stderr"])
                     ocsr["content"].extend(x["content"])
                     ocsr["pages"].append(page)
 
+            # annotate in this process, so all requests share rate limiter
+            if annotate and ocsr["content"]:
+                annotator = self.osra._get_annotator(chemspider_token, annotation_workers)
+                annotator.pubchem.prefetch([x["inchikey"] for x in ocsr["content"] if x.get("inchikey")])
+                n_distinct = annotator.map_unique(OSRA._annotate_entity, ocsr["content"], key=OSRA._annotation_key)
+                self.logger.info("Annotated {} entities found by OSRA ({} distinct).".format(len(ocsr["content"]),
+                                                                                           n_distinct))
+                annotator.report(self.logger)
+
             if separated_output and ocsr["content"]:
                 self.logger.info("Writing separated output from OSRA...")
                 dict_to_csv(ocsr["content"], output_file=output_file_ocsr, csv_delimiter=csv_delimiter, write_header=write_header)
@@ -286,7 +339,7 @@ class Extractor(object):
             ner = self.chemspot.process(input_text=text, remove_duplicates=remove_entity_duplicates,
                                         output_file=output_file_ner, paged_text=True, annotate=annotate,
                                         annotation_sleep=annotation_sleep, chemspider_token=chemspider_token,
-                                        opsin_types=[], convert_ions=convert_ions, standardize_mols=standardize_mols)
+                                        annotation_workers=annotation_workers, opsin_types=[], convert_ions=convert_ions, standardize_mols=standardize_mols)
         else:
             # Parallelization is not working for larger documents.
             # See http://stackoverflow.com/questions/21641887/python-multiprocessing-process-hangs-on-join-for-large-queue
@@ -327,25 +380,29 @@ class Extractor(object):
                                      osra_output_format="smi", standardize_mols=standardize_mols, n_jobs=n_jobs,
                                      output_file=output_file_ocsr, input_type=input_type,
                                      output_file_sdf=output_file_sdf_osra, sdf_append=sdf_append,
-                                     annotate=annotate, chemspider_token=chemspider_token)
+                                     annotate=annotate, chemspider_token=chemspider_token,
+                                     annotation_workers=annotation_workers, figures_only=osra_figures_only,
+                                     prefilter=osra_prefilter, prefilter_threshold=osra_prefilter_threshold,
+                                     timeout=timeout, cpu_time=cpu_time)
 
             self.logger.info("Extracting chemical entities from text with ChemSpot...")
             ner = self.chemspot.process(input_text=text, remove_duplicates=remove_entity_duplicates,
                                         output_file=output_file_ner, paged_text=True if input_type == "pdf" else False,
                                         annotate=annotate, annotation_sleep=annotation_sleep, convert_ions=convert_ions,
-                                        chemspider_token=chemspider_token, opsin_types=[], standardize_mols=standardize_mols)
+                                        chemspider_token=chemspider_token, annotation_workers=annotation_workers,
+                                        opsin_types=[], standardize_mols=standardize_mols)
 
-        to_convert = [x["entity"] for x in ner["content"] if x["type"] in opsin_types]
+        to_convert = list(OrderedDict.fromkeys(x["entity"] for x in ner["content"] if x["type"] in opsin_types))
+        opsin_index = {}
         opsin_converted = []
 
         if to_convert:
             self.logger.info("Converting chemical entities with OPSIN...")
-            opsin_converted = self.opsin.process(input=to_convert,
-                                                 output_formats=["smiles", "inchi", "inchikey"], output_file=output_file_opsin,
-                                                 output_file_sdf=output_file_sdf_opsin, sdf_append=sdf_append,
-                                                 standardize_mols=standardize_mols)
-            if not separated_output:
-                opsin_converted = iter(opsin_converted["content"])
+            opsin_converted, opsin_index = self.opsin.process_unique(to_convert,
+                                                                     output_formats=["smiles", "inchi", "inchikey"],
+                                                                     output_file=output_file_opsin,
+                                                                     output_file_sdf=output_file_sdf_opsin,
+                                                                     sdf_append=sdf_append, standardize_mols=standardize_mols)
         else:
             self.logger.warning("Nothing to convert with OPSIN.")
 
@@ -373,11 +430,11 @@ class Extractor(object):
                                             ("inchi", ent["inchi"]), ("inchikey", ent["inchikey"]), ("opsin_error", "")]))
         for ent in ner["content"]:
             if ent["type"] in opsin_types:
-                ent_opsin = next(opsin_converted)
+                ent_opsin = opsin_index.get(ent["entity"].strip(), {})
                 new_ent = OrderedDict([("source", "chemspot"), ("type", ent["type"]), ("page", ent["page"]),
                                             ("abbreviation", ent["abbreviation"]), ("entity", ent["entity"]),
-                                            ("smiles", ent_opsin["smiles"]), ("inchi", ent_opsin["inchi"]),
-                                            ("inchikey", ent_opsin["inchikey"]), ("opsin_error", ent_opsin["error"])])
+                                            ("smiles", ent_opsin.get("smiles", "")), ("inchi", ent_opsin.get("inchi", "")),
+                                            ("inchikey", ent_opsin.get("inchikey", "")), ("opsin_error", ent_opsin.get("error", ""))])
             else:
                 new_ent = OrderedDict([("source", "chemspot"), ("type", ent["type"]), ("page", ent["page"]),
                                             ("abbreviation", ent["abbreviation"]), ("entity", ent["entity"]),
@@ -392,6 +449,12 @@ class Extractor(object):
                                             ("pch_synonyms", ent["pch_synonyms"])]))
             results.append(new_ent)
 
+        if self.scheduler:
+            self.scheduler.report()
+        if self.opsin.cache:
+            self.opsin.cache.report("OPSIN cache")
+        report_stats(self.logger)
+
         if results:
             if output_file:
                 self.logger.info("Writing results to CSV file...")
@@ -1,12 +1,16 @@
 from .AbstractLinker import AbstractLinker
 from .utils import common_subprocess, dict_to_csv, write_empty_file, eprint
+from .scheduler import MemoryScheduler
+from .OPSINProcess import get_opsin_process, CRASH_ERROR, MISSING_ERROR
+from .cache import DiskCache, make_key
+from .conversion import MolConverter, get_converter, take_stats, add_stats
 
-from rdkit.Chem import MolFromSmiles, MolToSmiles, MolFromInchi, MolToInchi, InchiToInchiKey, SDWriter, MolToMolBlock
-from molvs import Standardizer
+from joblib import Parallel, delayed
 
 from collections import OrderedDict
+from itertools import islice
 import logging
-from typing import Union
+from typing import Union, Iterable, Iterator
 import re
 import os
 
@@ -45,11 +49,21 @@ class OPSIN(AbstractLinker):
         Return dict with options having internal names.
     path_to_binary : str
         Path to OPSIN binary (JAR file).
+    persistent : bool
+        If True, names are converted by long-lived OPSIN process shared in the current Python process.
+    cache : DiskCache
+        Cache of conversion results or None.
+    standardization_cache_path : str
+        Path to cache of standardized molecules or empty string.
 
     Methods
     -------
     process
         Process the input file with OPSIN.
+    iter_process
+        Convert names from file or iterable in batches and yield results.
+    process_unique
+        Convert each distinct name only once and return index of results by name.
     help
         Return OPSINS help message.
     """
@@ -77,6 +91,12 @@ class OPSIN(AbstractLinker):
                  opsin_verbose: bool = False,
                  wildcard_radicals: bool = False,
                  plural_pattern: str = None,
+                 max_memory: int = 0,
+                 scheduler: MemoryScheduler = None,
+                 persistent: bool = False,
+                 cache_path: str = "",
+                 cache_max_entries: int = 100000,
+                 standardization_cache_path: str = "",
                  verbosity: int = 1):
         """
         Parameters
@@ -98,6 +118,26 @@ class OPSIN(AbstractLinker):
             Radicals are output as wildcard atoms.
         plural_pattern : str
             Regex pattern to replace plurals. Default regex is in static attribute PLURAL_PATTERN.
+        max_memory : int
+            | Maximum amount of memory [GB] which can be used by Java process. If 0, Java's default is used.
+            | It's passed to OPSIN run script in OPSIN_MAX_MEMORY environment variable.
+        scheduler : MemoryScheduler
+            If set, heap size is estimated from input size (up to `max_memory`) and OPSIN process is launched only
+            when it fits to the memory budget.
+        persistent : bool
+            | If True, keep one OPSIN process alive in the current Python process (e.g. joblib worker) and stream names
+              to it, so Java VM is not started for each call of `process`. Crashed process is restarted automatically.
+            | Not used for "cml" output format, which has multiple lines per name.
+        cache_path : str
+            | Path to SQLite database with cached conversions. If set, results of `process` (including failures) are
+              stored under normalized name and options affecting the output, and only names not found in cache are sent
+              to OPSIN.
+            | Not used for "cml" output format and when `format_output` is False.
+        cache_max_entries : int
+            Maximum number of cached names. Least recently used ones are evicted. If 0, the size is not bounded.
+        standardization_cache_path : str
+            Path to SQLite database with cached standardized molecules, see `conversion.MolConverter`. It can be
+            shared with OSRA and ChemSpot.
         verbosity : int
             This class's verbosity. Values: 0, 1, 2
         """
@@ -117,6 +157,12 @@ class OPSIN(AbstractLinker):
         else:
             self.plural_pattern = self.PLURAL_PATTERN
 
+        self.max_memory = max_memory
+        self.scheduler = scheduler
+        self.persistent = persistent
+        self.cache = DiskCache(cache_path, max_entries=cache_max_entries, verbosity=verbosity) if cache_path else None
+        self.standardization_cache_path = standardization_cache_path
+
     def set_options(self, options: dict):
         """
         Sets the options passed in dict. Keys are the same as optional parameters in OPSIN constructor (__init__()).
@@ -144,6 +190,48 @@ class OPSIN(AbstractLinker):
         else:
             return stdout
 
+    def _run(self, commands: list, stdin: str = "", input_size: int = 0):
+        """
+        Run OPSIN process with heap size limited by `max_memory` or estimated by `scheduler`.
+
+        Returns
+        -------
+        namedtuple
+            Fields: "stdout", "stderr", "exit_code"
+        """
+
+        memory = self.max_memory
+        if self.scheduler:
+            memory = self.scheduler.heap_size("opsin", input_size=input_size or len(stdin), max_memory=self.max_memory)
+
+        env = dict(os.environ, OPSIN_MAX_MEMORY=str(memory)) if memory else None
+
+        if self.scheduler:
+            with self.scheduler.reserve(memory, tool="opsin"):
+                return common_subprocess(commands, stdin=stdin, env=env)
+        return common_subprocess(commands, stdin=stdin, env=env)
+
+    @staticmethod
+    def _pair_errors(stdout: str, stderr: str) -> list:
+        """
+        Pair OPSIN output lines with failure messages from stderr.
+
+        Returns
+        -------
+        list of tuples
+            (OPSIN output, error) for each input line.
+        """
+
+        outputs = stdout.split("\n")
+        del outputs[-1]
+        errors = iter([x.strip() for x in stderr.split("\n")[1:] if x])  # remove first line of stderr because there is OPSIN message (y u du dis...)
+
+        results = []
+        for output in outputs:
+            output = output.strip()
+            results.append((output, "" if output else next(errors, MISSING_ERROR)))
+        return results
+
     def normalize_iupac(self, iupac_names: Union[str, list]) -> Union[str, list]:
         """
         Normalize IUPAC names:
@@ -191,7 +279,9 @@ class OPSIN(AbstractLinker):
                 csv_delimiter: str = ";",
                 standardize_mols: bool = True,
                 normalize_plurals: bool = True,
-                continue_on_failure: bool = False) -> OrderedDict:
+                continue_on_failure: bool = False,
+                n_jobs: int = 1,
+                chunk_size: int = 10000) -> OrderedDict:
         r"""
         Process the input file with OPSIN.
 
@@ -261,13 +351,21 @@ class OPSIN(AbstractLinker):
         continue_on_failure : bool
             | If True, continue running even if OPSIN returns non-zero exit code.
             | If False and error occurs, print it and return.
+        n_jobs : int
+            | Number of parallel workers. If not 1 and there are more than `chunk_size` names to convert, names are split
+              to chunks which are converted by separate OPSIN processes and post-processed (RDKit, MolVS) in parallel.
+              Results are in the same order as input.
+            | If -1 all CPUs are used. For n_jobs below -1, (n_cpus + 1 + n_jobs) are used.
+            | Not used for "cml" output format.
+        chunk_size : int
+            Number of names in one chunk when `n_jobs` is not 1.
 
         Returns
         -------
         dict
             Keys:
 
-            - stdout: str ... standard output from OPSIN
+            - stdout: str ... standard output from OPSIN (only for names not found in cache, if `cache_path` is set)
             - stderr: str ... standard error output from OPSIN
             - exit_code: int ... exit code from OPSIN
             - content:
@@ -326,19 +424,65 @@ class OPSIN(AbstractLinker):
 
         commands, _, _ = self.build_commands(options_internal, self._OPTIONS_REAL, self.path_to_binary)
 
+        if isinstance(input, list):
+            input = "\n".join([x.strip() for x in input])
+
+        if dry_run:
+            return " ".join(commands + [input_file] if input_file else commands)
+
+        use_cache = self.cache is not None and format_output and opsin_output_format != "cml"
+        use_process = self.persistent and opsin_output_format != "cml"
+
+        if input_file and (use_cache or use_process):
+            with open(input_file, mode="r", encoding="utf-8") as f:
+                input = "\n".join([x.strip() for x in f.readlines()])
+            input_file = ""
+
         if input_file:
-            commands.append(input)
-            stdout, stderr, exit_code = common_subprocess(commands)
+            with open(input_file, mode="r", encoding="utf-8") as f:
+                lines = [x.strip() for x in f.readlines()]
+        else:
+            lines = [x.strip() for x in input.split("\n")]
+
+        # names which will be converted by OPSIN
+        to_convert = lines
+        cached = {}
+        if use_cache:
+            keys = [self._cache_key(x, options_internal, output_formats, standardize_mols) for x in lines]
+            cached = self.cache.get_many([k for k, x in zip(keys, lines) if x])
+            to_convert = list(OrderedDict.fromkeys(x for k, x in zip(keys, lines) if x and k not in cached))
+            self.logger.info("OPSIN cache: {} names found, {} to convert.".format(len(lines) - len(to_convert), len(to_convert)))
+
+        mol_output_template = OrderedDict.fromkeys(["iupac"] + output_formats + ["error"])
+        format_args = (mol_output_template, opsin_output_format, output_formats, standardize_mols)
+        sharded = n_jobs != 1 and chunk_size > 0 and opsin_output_format != "cml" and len(to_convert) > chunk_size
+
+        # list of (OrderedDict, Mol) for each name in to_convert
+        formatted = None
+        if use_cache and not to_convert:
+            stdout, stderr, exit_code = "", "", 0
+            formatted = []
+        elif sharded:
+            chunks = [to_convert[i:i + chunk_size] for i in range(0, len(to_convert), chunk_size)]
+            self.logger.info("Converting {} names in {} chunks with OPSIN...".format(len(to_convert), len(chunks)))
+            outputs = Parallel(n_jobs=n_jobs)(
+                delayed(self._convert_chunk)(chunk, commands, format_output, *format_args) for chunk in chunks)
+            stdout = "".join(x[0] for x in outputs)
+            stderr = "\n".join(x[1] for x in outputs if x[1])
+            exit_code = max(x[2] for x in outputs)
+            for x in outputs:
+                add_stats(x[4])
+            if format_output:
+                formatted = [y for x in outputs for y in x[3]]
+        elif input_file and not use_process:
+            commands.append(input_file)
+            stdout, stderr, exit_code = self._run(commands, input_size=os.path.getsize(input_file))
         elif input:
-            if isinstance(input, list):
-                input = "\n".join([x.strip() for x in input])
-            stdout, stderr, exit_code = common_subprocess(commands, stdin=input)
+            stdout, stderr, exit_code, formatted, stats = self._convert_chunk(to_convert, commands, format_output, *format_args)
+            add_stats(stats)
         else:
             raise UserWarning("Input is empty.")
 
-        if dry_run:
-            return " ".join(commands)
-
         to_return = {"stdout": stdout, "stderr": stderr, "exit_code": exit_code, "content": None}
 
         if not continue_on_failure and exit_code > 0:
@@ -360,102 +504,42 @@ class OPSIN(AbstractLinker):
             return to_return
 
         compounds = []
-        standardizer = Standardizer()
-        empty_cols = OrderedDict([(x, "") for x in output_formats])
-
-        if output_file_sdf:
-            if sdf_append:
-                if not os.path.isfile(output_file_sdf):
-                    open(output_file_sdf, mode="w", encoding="utf-8").close()
-                writer = SDWriter(open(output_file_sdf, mode="a", encoding="utf-8"))
-            else:
-                writer = SDWriter(output_file_sdf)
-
-        stdout = stdout.split("\n")
-        del stdout[-1]
-        stderr = [x.strip() for x in stderr.split("\n")[1:] if x]  # remove first line of stderr because there is OPSIN message (y u du dis...)
-
-        if input_file:
-            with open(input_file, mode="r", encoding="utf-8") as f:
-                lines = iter(f.readlines())
-        else:
-            lines = iter(input.split("\n"))
 
-        mol_output_template = OrderedDict.fromkeys(["iupac"] + output_formats + ["error"])
+        if formatted is None:
+            formatted = self._format_lines(to_convert, self._pair_errors(stdout, stderr), *format_args)
 
-        e = 0
-        for i, line in enumerate(lines):
-            line = line.strip()
-            converted = stdout[i].strip()
-            mol_output = mol_output_template.copy()
-
-            if converted:
-                if opsin_output_format == "stdinchikey":
-                    compounds.append(OrderedDict([("iupac", line), ("stdinchikey_opsin", converted), ("error", "")]))
-                    continue
-                elif opsin_output_format == "extendedsmi":
-                    compounds.append(OrderedDict([("iupac", line), ("smiles_extended_opsin", converted), ("error", "")]))
-                    continue
-
-                if opsin_output_format == "smi":
-                    mol = MolFromSmiles(converted, sanitize=False if standardize_mols else True)
-                elif opsin_output_format in ["inchi", "stdinchi"]:
-                    mol = MolFromInchi(converted, sanitize=False if standardize_mols else True, removeHs=False if standardize_mols else True)
-
-                if mol:
-                    if standardize_mols:
-                        try:
-                            mol = standardizer.standardize(mol)
-                        except ValueError as e:
-                            self.logger.warning("Cannot standardize '{}': {}".format(MolToSmiles(mol), str(e)))
-
-                    for f in output_formats:
-                        if f == "smiles":
-                            mol_output["smiles"] = MolToSmiles(mol, isomericSmiles=True)
-                        elif f == "smiles_opsin" and opsin_output_format == "smi":
-                            mol_output["smiles_opsin"] = converted
-                        elif f == "inchi":
-                            inchi = MolToInchi(mol)
-                            if inchi:
-                                mol_output["inchi"] = inchi
-                            else:
-                                mol_output["inchi"] = ""
-                                self.logger.warning("Cannot convert to InChI: {}".format(converted))
-                        elif f == "inchi_opsin" and opsin_output_format == "inchi":
-                            mol_output["inchi_opsin"] = converted
-                        elif f == "stdinchi_opsin" and opsin_output_format == "stdinchi":
-                            mol_output["stdinchi_opsin"] = converted
-                        elif f == "inchikey":
-                            inchi = MolToInchi(mol)
-                            if inchi:
-                                mol_output["inchikey"] = InchiToInchiKey(inchi)
-                            else:
-                                mol_output["inchikey"] = ""
-                                self.logger.warning("Cannot create InChI-key from InChI: {}".format(converted))
-                        elif f == "stdinchikey_opsin" and opsin_output_format == "stdinchikey":
-                            mol_output["stdinchikey_opsin"] = converted
-                        elif f == "sdf":
-                            mol_output["sdf"] = MolToMolBlock(mol, includeStereo=True)
-
-                    if output_file_sdf:
-                        writer.write(mol)
-
-                    mol_output.update(OrderedDict([("iupac", line), ("error", "")]))
-                else:
-                    mol_output.update([("iupac", line), ("error", "Cannot convert to RDKit mol: {}".format(converted))])
-                    mol_output.update(empty_cols)
-                    self.logger.warning(compounds[-1].error)
+        converted = OrderedDict()
+        for line, result in zip(to_convert, formatted):
+            if use_cache:
+                converted[line] = result
             else:
-                try:
-                    error = stderr[e].strip()
-                except IndexError:
-                    error = ""
+                compounds.append(result)
+
+        if use_cache:
+            to_cache = {}
+            for line, key in zip(lines, keys):
+                if line in converted:
+                    mol_output, molecule = converted[line]
+                    if exit_code == 0 and not mol_output["error"].startswith((CRASH_ERROR, MISSING_ERROR)):
+                        to_cache[key] = {"output": list(mol_output.items())[1:],
+                                         "molblock": molecule.molblock if molecule else ""}
+                    molblock = molecule.molblock if molecule and output_file_sdf else ""
+                elif key in cached:
+                    mol_output = OrderedDict([("iupac", line)] + [tuple(x) for x in cached[key]["output"]])
+                    molblock = cached[key]["molblock"] if output_file_sdf else ""
+                else:
+                    mol_output, molblock = self._format_lines([line], [("", "")], *format_args)[0][0], ""
+                compounds.append((mol_output.copy(), molblock))
+            self.cache.set_many(to_cache)
+        else:
+            compounds = [(mol_output, molecule.molblock if molecule and output_file_sdf else "")
+                         for mol_output, molecule in compounds]
 
-                mol_output.update([("iupac", line), ("error", error)])
-                mol_output.update(empty_cols)
-                e += 1
-            compounds.append(mol_output)
+        if output_file_sdf:
+            with open(output_file_sdf, mode="a" if sdf_append else "w", encoding="utf-8") as f:
+                f.write("".join("{}$$$$\n".format(molblock) for _, molblock in compounds if molblock))
 
+        compounds = [x[0] for x in compounds]
         to_return["content"] = compounds
 
         if output_file and compounds:
@@ -464,3 +548,252 @@ class OPSIN(AbstractLinker):
             write_empty_file(output_file, csv_delimiter=csv_delimiter, header=list(mol_output_template.keys()), write_header=write_header)
 
         return to_return
+
+    def iter_process(self,
+                     input: Union[str, Iterable],
+                     batch_size: int = 1000,
+                     output_file_sdf: str = "",
+                     sdf_append: bool = False,
+                     opsin_output_format: str = "",
+                     output_formats: list = None,
+                     standardize_mols: bool = True,
+                     normalize_plurals: bool = True,
+                     n_jobs: int = 1,
+                     chunk_size: int = 10000) -> Iterator[OrderedDict]:
+        """
+        Read names lazily, convert them with `process` in batches of `batch_size` names and yield the results as soon as
+        each batch is done. Memory usage doesn't depend on input size, so it can be used for arbitrarily large files
+        or in Unix pipeline.
+
+        Use `persistent` in __init__, so OPSIN is not started again for each batch.
+
+        **Usage:** ::
+
+            opsin = OPSIN(persistent=True)
+            with open("names.txt") as f:
+                for compound in opsin.iter_process(f):
+                    print(compound["iupac"], compound["smiles"])
+
+        Parameters
+        ----------
+        input : str or iterable
+            | str: Path to file with one name per line.
+            | iterable: Names, e.g. open file or `sys.stdin`. Empty lines are skipped.
+        batch_size : int
+            Number of names converted at once.
+        output_file_sdf : str
+            File to write SDF output in.
+        sdf_append : bool
+            If True, append new molecules to existing SDF file or create new one if doesn't exist.
+        opsin_output_format : str
+        output_formats : list
+        standardize_mols : bool
+        normalize_plurals : bool
+        n_jobs : int
+        chunk_size : int
+            See `process`. Batch is split to chunks only if `batch_size` is larger than `chunk_size`.
+
+        Yields
+        ------
+        OrderedDict
+            Fields: "iupac", <output formats>, ..., "error"
+        """
+
+        if isinstance(input, str):
+            with open(input, mode="r", encoding="utf-8") as f:
+                yield from self.iter_process(f, batch_size=batch_size, output_file_sdf=output_file_sdf,
+                                             sdf_append=sdf_append, opsin_output_format=opsin_output_format,
+                                             output_formats=output_formats, standardize_mols=standardize_mols,
+                                             normalize_plurals=normalize_plurals, n_jobs=n_jobs, chunk_size=chunk_size)
+            return
+
+        names = (x.strip() for x in input)
+        names = (x for x in names if x)
+
+        for i, batch in enumerate(iter(lambda: list(islice(names, batch_size)), [])):
+            result = self.process(input=batch, output_file_sdf=output_file_sdf, sdf_append=sdf_append or i > 0,
+                                  opsin_output_format=opsin_output_format, output_formats=output_formats,
+                                  standardize_mols=standardize_mols, normalize_plurals=normalize_plurals,
+                                  n_jobs=n_jobs, chunk_size=chunk_size)
+            if result["content"] is None:
+                raise RuntimeError("OPSIN error: {}".format(result["stderr"]))
+            yield from result["content"]
+
+    def process_unique(self, names: list, normalize_plurals: bool = True, **kwargs) -> tuple:
+        """
+        Convert each distinct name only once. Names are distinct after stripping and normalization with
+        `normalize_iupac` (if `normalize_plurals` is True), so e.g. "Benzene" and "benzene" are converted once.
+
+        Parameters
+        ----------
+        names : list
+            Names, possibly with many occurrences of the same name.
+        normalize_plurals : bool
+        kwargs
+            Other parameters of `process`.
+
+        Returns
+        -------
+        tuple
+            | Result of `process` for distinct names and dict mapping each stripped name from `names` to its OrderedDict
+              from "content" of the result.
+            | Dict is empty if OPSIN failed.
+        """
+
+        # name -> normalized name
+        keys = OrderedDict()
+        for name in names:
+            name = name.strip()
+            if name not in keys:
+                keys[name] = self.normalize_iupac(name) if normalize_plurals else name
+
+        # normalized name -> first name with this normalized form
+        unique = OrderedDict()
+        for name, key in keys.items():
+            unique.setdefault(key, name)
+
+        self.logger.info("Converting {} distinct names of {} with OPSIN...".format(len(unique), len(names)))
+        result = self.process(input=list(unique.values()), normalize_plurals=normalize_plurals, **kwargs)
+
+        index = {}
+        if result["content"] is not None:
+            by_key = dict(zip(unique.keys(), result["content"]))
+            index = {name: by_key[key] for name, key in keys.items()}
+
+        return result, index
+
+    @staticmethod
+    def _cache_key(name: str, options_internal: dict, output_formats: list, standardize_mols: bool) -> str:
+        """
+        Make cache key from name and options which affect conversion result.
+        """
+
+        options = {k: v for k, v in options_internal.items() if k != "opsin_verbose"}
+        return make_key(name, options, output_formats, standardize_mols)
+
+    def _convert_chunk(self,
+                       names: list,
+                       commands: list,
+                       format_output: bool,
+                       mol_output_template: OrderedDict,
+                       opsin_output_format: str,
+                       output_formats: list,
+                       standardize_mols: bool) -> tuple:
+        """
+        Convert names with OPSIN and, if `format_output` is True, convert the results to requested formats.
+        It's run by parallel workers in `process`, so each chunk has its own OPSIN process and stderr.
+
+        Returns
+        -------
+        tuple
+            stdout, stderr, exit_code, list of (OrderedDict, Molecule) for each name or None if `format_output` is False
+            and statistics of converter (see `conversion.take_stats`)
+        """
+
+        if self.persistent and opsin_output_format != "cml":
+            results = get_opsin_process(commands, max_memory=self.max_memory, scheduler=self.scheduler).convert(names)
+            stdout = "".join(x[0] + "\n" for x in results)
+            stderr = "\n".join(x[1] for x in results if x[1])
+            exit_code = 0
+        else:
+            stdout, stderr, exit_code = self._run(commands, stdin="\n".join(names))
+            results = self._pair_errors(stdout, stderr)
+
+        formatted = None
+        if format_output:
+            formatted = self._format_lines(names, results, mol_output_template, opsin_output_format, output_formats,
+                                           standardize_mols)
+        return stdout, stderr, exit_code, formatted, take_stats()
+
+    def _format_lines(self,
+                      names: list,
+                      results: list,
+                      mol_output_template: OrderedDict,
+                      opsin_output_format: str,
+                      output_formats: list,
+                      standardize_mols: bool) -> list:
+        """
+        Convert OPSIN results (see `_pair_errors`) of `names` to requested formats.
+
+        Returns
+        -------
+        list of tuples
+            (OrderedDict, Molecule) for each name, see `_format_line`.
+        """
+
+        converter = get_converter(standardize=standardize_mols, cache_path=self.standardization_cache_path)
+        return [self._format_line(line, converted, error, mol_output_template, opsin_output_format, output_formats,
+                                  converter)
+                for line, (converted, error) in zip(names, results)]
+
+    def _format_line(self,
+                     line: str,
+                     converted: str,
+                     error: str,
+                     mol_output_template: OrderedDict,
+                     opsin_output_format: str,
+                     output_formats: list,
+                     converter: MolConverter) -> tuple:
+        """
+        Convert one line of OPSIN output to requested formats.
+
+        Returns
+        -------
+        tuple
+            OrderedDict with fields "iupac", <output formats>, ..., "error" and `conversion.Molecule` (None if not
+            created).
+        """
+
+        mol_output = mol_output_template.copy()
+        empty_cols = OrderedDict([(x, "") for x in output_formats])
+
+        if not converted:
+            mol_output.update([("iupac", line), ("error", error)])
+            mol_output.update(empty_cols)
+            return mol_output, None
+
+        if opsin_output_format == "stdinchikey":
+            return OrderedDict([("iupac", line), ("stdinchikey_opsin", converted), ("error", "")]), None
+        elif opsin_output_format == "extendedsmi":
+            return OrderedDict([("iupac", line), ("smiles_extended_opsin", converted), ("error", "")]), None
+
+        if opsin_output_format == "smi":
+            molecule, warnings = converter.convert(converted, "smiles")
+        elif opsin_output_format in ["inchi", "stdinchi"]:
+            molecule, warnings = converter.convert(converted, "inchi")
+        else:
+            molecule, warnings = None, []
+
+        for warning in warnings:
+            self.logger.warning(warning)
+
+        if not molecule:
+            mol_output.update([("iupac", line), ("error", "Cannot convert to RDKit mol: {}".format(converted))])
+            mol_output.update(empty_cols)
+            self.logger.warning(mol_output["error"])
+            return mol_output, None
+
+        for f in output_formats:
+            if f == "smiles":
+                mol_output["smiles"] = molecule.smiles
+            elif f == "smiles_opsin" and opsin_output_format == "smi":
+                mol_output["smiles_opsin"] = converted
+            elif f == "inchi":
+                mol_output["inchi"] = molecule.inchi
+                if not molecule.inchi:
+                    self.logger.warning("Cannot convert to InChI: {}".format(converted))
+            elif f == "inchi_opsin" and opsin_output_format == "inchi":
+                mol_output["inchi_opsin"] = converted
+            elif f == "stdinchi_opsin" and opsin_output_format == "stdinchi":
+                mol_output["stdinchi_opsin"] = converted
+            elif f == "inchikey":
+                mol_output["inchikey"] = molecule.inchikey
+                if not molecule.inchikey:
+                    self.logger.warning("Cannot create InChI-key from InChI: {}".format(converted))
+            elif f == "stdinchikey_opsin" and opsin_output_format == "stdinchikey":
+                mol_output["stdinchikey_opsin"] = converted
+            elif f == "sdf":
+                mol_output["sdf"] = molecule.molblock
+
+        mol_output.update(OrderedDict([("iupac", line), ("error", "")]))
+        return mol_output, molecule
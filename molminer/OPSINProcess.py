@@ -0,0 +1,313 @@
+from .scheduler import MemoryScheduler
+
+from collections import OrderedDict
+import atexit
+import io
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+# live OPSIN processes of this Python process, see get_opsin_process()
+_processes = {}
+_processes_lock = threading.Lock()
+# prefix of error given to name which crashed OPSIN process
+CRASH_ERROR = "OPSIN process crashed"
+# error given to failed name whose failure message wasn't received
+MISSING_ERROR = "OPSIN failure message not received"
+
+
+class OPSINProcessError(RuntimeError):
+    pass
+
+
+class OPSINProcess(object):
+    """
+    Long-lived OPSIN process which converts names streamed to its stdin. OPSIN reads one name per line and writes one
+    result per line to stdout (empty line on failure), with failure message on stderr. Failure messages are given to
+    the failed names they contain, so late message can't be given to another name.
+
+    The Java VM is started only once, so the cost of its startup is not paid for each document. When the process dies,
+    it's restarted and the remaining names are sent again. Name which crashes the process twice gets an error.
+
+    Use `get_opsin_process` to share one process per options in the current Python process (e.g. joblib worker).
+
+    **Usage:** ::
+
+        opsin = OPSINProcess(["opsin", "--output", "smi"])
+        opsin.convert(["benzene", "foo"])  # [("c1ccccc1", ""), ("", "foo is unparsable due to...")]
+        opsin.close()
+
+    Attributes
+    ----------
+    stats : dict
+        "starts" (including restarts), "names" (converted names) and "crashes".
+    """
+
+    # how many seconds to wait for failure messages on stderr after the last result of batch
+    ERROR_TIMEOUT = 1.0
+
+    logger = logging.getLogger("opsin")
+
+    def __init__(self,
+                 commands: list,
+                 max_memory: int = 0,
+                 scheduler: MemoryScheduler = None):
+        """
+        Parameters
+        ----------
+        commands : list
+            Commands to start OPSIN, without input file (names are read from stdin).
+        max_memory : int
+            Maximum amount of memory [GB] for Java process, passed in OPSIN_MAX_MEMORY environment variable.
+            If 0, Java's default is used.
+        scheduler : MemoryScheduler
+            | If set, `max_memory` (or base heap of OPSIN) is reserved in the memory budget during each `convert` call.
+            | The process stays alive between calls without reservation, so processes of parallel workers (or other
+              Java processes of the same worker) waiting for the budget can't block each other forever.
+        """
+
+        self.commands = list(commands)
+        self.max_memory = max_memory
+        self.scheduler = scheduler
+        self.stats = {"starts": 0, "names": 0, "crashes": 0}
+
+        self._process = None
+        self._stdin = None
+        self._stdout = None
+        self._errors = None
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Start OPSIN process. Running process is stopped first.
+        """
+
+        self.close()
+
+        memory = self._heap_size()
+        env = dict(os.environ, OPSIN_MAX_MEMORY=str(memory)) if memory else None
+
+        self._process = subprocess.Popen(self.commands, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, env=env)
+        self._stdin = io.TextIOWrapper(self._process.stdin, encoding="utf-8")
+        self._stdout = io.TextIOWrapper(self._process.stdout, encoding="utf-8")
+        self._errors = queue.Queue()
+        threading.Thread(target=self._drain_stderr, args=(io.TextIOWrapper(self._process.stderr, encoding="utf-8"),
+                                                          self._errors), daemon=True).start()
+        self.stats["starts"] += 1
+        self.logger.info("Started OPSIN process (PID {}).".format(self._process.pid))
+
+    def _heap_size(self) -> int:
+        if self.scheduler:
+            return self.scheduler.heap_size("opsin", max_memory=self.max_memory)
+        return self.max_memory
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None and self._pid == os.getpid()
+
+    def close(self):
+        """
+        Stop OPSIN process.
+        """
+
+        if self._process is not None and self._pid == os.getpid():
+            try:
+                self._stdin.close()
+            except (OSError, ValueError):
+                pass
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+            self._stdout.close()
+        self._process = None
+
+    def convert(self, names: list) -> list:
+        """
+        Convert names with OPSIN. Empty names are not sent to OPSIN.
+
+        Parameters
+        ----------
+        names : list
+            List of names. Each name must be on one line.
+
+        Returns
+        -------
+        list of tuples
+            (OPSIN output, error) for each name. Output is empty on failure.
+        """
+
+        with self._lock:
+            if self.scheduler:
+                with self.scheduler.reserve(self._heap_size(), tool="opsin"):
+                    results = self._convert_all(names)
+            else:
+                results = self._convert_all(names)
+
+        self.stats["names"] += len(names)
+        return results
+
+    def _convert_all(self, names: list) -> list:
+        """
+        Convert `names`, restarting the process when it dies.
+        """
+
+        results = []
+        crashed_at = -1
+
+        while len(results) < len(names):
+            if not self.is_alive():
+                if self._pid != os.getpid():
+                    # inherited from parent process by fork
+                    self._process = None
+                    self._pid = os.getpid()
+                self.start()
+
+            try:
+                self._convert(names[len(results):], results)
+            except OPSINProcessError as e:
+                self.stats["crashes"] += 1
+                self.logger.warning("OPSIN process crashed, restarting it: {}".format(e))
+                self.close()
+                # name which crashed the process again is skipped
+                if crashed_at == len(results):
+                    results.append(("", "{}: {}".format(CRASH_ERROR, e)))
+                crashed_at = len(results)
+
+        return results
+
+    def _convert(self, names: list, results: list):
+        """
+        Write `names` to stdin in separate thread and read the results to `results`, so large batches can't deadlock
+        on full pipes.
+        """
+
+        # messages left from previous batch (e.g. received after timeout) don't belong to these names
+        while True:
+            try:
+                self._errors.get_nowait()
+            except queue.Empty:
+                break
+
+        to_send = [x for x in names if x.strip()]
+        writer = threading.Thread(target=self._write_names, args=(self._stdin, to_send), daemon=True)
+        writer.start()
+
+        # failed name -> indices in `results` waiting for failure message
+        failed = OrderedDict()
+        try:
+            for name in names:
+                if not name.strip():
+                    results.append(("", ""))
+                    continue
+
+                output = self._stdout.readline()
+                if not output:
+                    raise OPSINProcessError("no output for '{}'".format(name))
+
+                output = output.strip()
+                if not output:
+                    failed.setdefault(name.strip(), []).append(len(results))
+                results.append((output, ""))
+                self._collect_errors(failed, results)
+
+            writer.join()
+            self._collect_errors(failed, results, timeout=self.ERROR_TIMEOUT)
+        finally:
+            for indices in failed.values():
+                for i in indices:
+                    results[i] = ("", MISSING_ERROR)
+
+    def _collect_errors(self, failed: OrderedDict, results: list, timeout: float = 0):
+        """
+        Give failure messages from stderr to the `failed` names they contain (the longest one, if more names match).
+        Messages not containing any failed name are dropped. Wait at most `timeout` seconds for all messages.
+        """
+
+        deadline = time.monotonic() + timeout
+        while failed:
+            remaining = deadline - time.monotonic()
+            try:
+                line = self._errors.get(timeout=remaining) if remaining > 0 else self._errors.get_nowait()
+            except queue.Empty:
+                return
+
+            matches = [x for x in failed if x in line]
+            if not matches:
+                self.logger.info("OPSIN message not matching any failed name: {}".format(line))
+                continue
+
+            name = max(matches, key=len)
+            indices = failed[name]
+            results[indices.pop(0)] = ("", line)
+            if not indices:
+                del failed[name]
+
+    @staticmethod
+    def _write_names(stdin, names: list):
+        try:
+            for name in names:
+                stdin.write(name.strip() + "\n")
+            stdin.flush()
+        except (BrokenPipeError, ValueError):
+            # the process died, the reader will notice it
+            pass
+
+    @staticmethod
+    def _drain_stderr(stderr, errors: queue.Queue):
+        # first line is OPSIN's welcome message
+        stderr.readline()
+        for line in stderr:
+            line = line.strip()
+            if line:
+                errors.put(line)
+        stderr.close()
+
+
+def get_opsin_process(commands: list, max_memory: int = 0, scheduler: MemoryScheduler = None) -> OPSINProcess:
+    """
+    Return `OPSINProcess` for `commands` shared in the current Python process. It's created on first use and stopped
+    at interpreter exit.
+
+    Parameters
+    ----------
+    commands : list
+    max_memory : int
+    scheduler : MemoryScheduler
+
+    Returns
+    -------
+    OPSINProcess
+    """
+
+    key = (os.getpid(), tuple(commands), max_memory)
+    with _processes_lock:
+        if key not in _processes:
+            _processes[key] = OPSINProcess(commands, max_memory=max_memory, scheduler=scheduler)
+        return _processes[key]
+
+
+@atexit.register
+def close_opsin_processes():
+    """
+    Stop all OPSIN processes started by `get_opsin_process` in the current Python process.
+    """
+
+    with _processes_lock:
+        for key, process in list(_processes.items()):
+            if key[0] == os.getpid():
+                process.close()
+            del _processes[key]
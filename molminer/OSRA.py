@@ -1,18 +1,19 @@
 from .AbstractLinker import AbstractLinker
-from .utils import common_subprocess, get_input_file_type, dict_to_csv, write_empty_file, pdf_to_images, get_temp_images, eprint
+from .utils import common_subprocess, get_input_file_type, dict_to_csv, write_empty_file, pdf_to_images, get_temp_images, eprint, file_hash, \
+    get_pdf_page_count, pdf_page_to_image, get_pdf_image_boxes, pdf_limits, SubprocessTimeoutError
+from .cache import DiskCache, make_key
+from .conversion import get_converter, take_stats, add_stats
+from .prefilter import has_structure, read_gray_image, structure_boxes, DEFAULT_THRESHOLD
+from .annotation import Annotator
 
-from rdkit.Chem import MolToInchi, MolToSmiles, InchiToInchiKey, MolFromSmiles, MolFromMolBlock, SDWriter, MolToMolBlock
 from joblib import Parallel, delayed
-from molvs import Standardizer
-
-from pubchempy import get_compounds, BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError
-from chemspipy import ChemSpider
 
 from collections import ChainMap, OrderedDict
 import logging
+import math
 import tempfile
 import os
-from time import sleep
+import re
 
 
 logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
@@ -23,6 +24,105 @@ verbosity_levels = {
 }
 
 
+def _format_page(output: str,
+                 page: int,
+                 osra_output_format: str,
+                 output_formats: list,
+                 output_cols: OrderedDict,
+                 compound_template_dict: OrderedDict,
+                 standardize_mols: bool,
+                 is_output_sdf: bool,
+                 use_gm: bool,
+                 custom_page: int,
+                 standardization_cache_path: str = "") -> tuple:
+    """
+    Parse OSRA output of one page with RDKit, standardize molecules and convert them to `output_formats`. Runs in
+    worker process of `OSRA.process`, so only plain data are returned and warnings are logged by the caller.
+    Molecules are converted by `conversion.MolConverter` shared in the worker process.
+
+    Returns
+    -------
+    tuple
+        List of compound OrderedDicts, list of MOL blocks for SDF output (empty if `is_output_sdf` is False), list
+        of warnings and statistics of converter (see `conversion.take_stats`).
+    """
+
+    converter = get_converter(standardize=standardize_mols, cache_path=standardization_cache_path)
+    osra_smiles_outputs = ["smi", "can"]
+    compounds = []
+    mol_blocks = []
+    warnings = []
+
+    if osra_output_format in osra_smiles_outputs:
+        lines = [x.strip() for x in output.split("\n") if x]
+    else:
+        lines = [x for x in output.split("$$$$") if x.strip()]
+
+    for line in lines:
+        """
+        # so much problems with --learn
+        # we can't simply split output by " " when --learn is present, because its output is like "1,2,2,2 1"
+        if "learn" in filtered_cols:
+            learn_start = filtered_cols.index("learn") + 1 #  "smiles" col isn't in output_cols
+            learn_end = filtered_cols.index("learn") + 1 + 3
+            line[learn_start:learn_end] = [" ".join(line[learn_start:learn_end])]
+        """
+
+        if not line:
+            continue
+
+        if osra_output_format in osra_smiles_outputs:
+            line = [x.strip() for x in line.split()]
+            if custom_page:
+                line[output_cols["page"]] = custom_page
+            elif use_gm:
+                line[output_cols["page"]] = page
+            source = line[0]
+            molecule, convert_warnings = converter.convert(source, "smiles")
+        else:
+            line = "\n" + line.strip()
+            source = line
+            molecule, convert_warnings = converter.convert(source, "molblock")
+        warnings.extend(convert_warnings)
+
+        if molecule:
+            compound = compound_template_dict.copy()
+
+            for f in output_formats:
+                if f == "smiles":
+                    compound["smiles"] = molecule.smiles
+                elif f == "smiles_osra" and osra_output_format == "smi":
+                    compound["smiles_osra"] = line[0]
+                elif f == "smiles_can_osra" and osra_output_format == "can":
+                    compound["smiles_can_osra"] = line[0]
+                elif f == "inchi":
+                    compound["inchi"] = molecule.inchi
+                    if not molecule.inchi:
+                        warnings.append("Cannot convert to InChI: {}".format(molecule.smiles))
+                elif f == "inchikey":
+                    compound["inchikey"] = molecule.inchikey
+                    if not molecule.inchikey:
+                        warnings.append("Cannot create InChI-key from InChI: {}".format(molecule.smiles))
+                elif f == "sdf":
+                    compound["sdf"] = molecule.molblock
+                elif f == "sdf_osra":
+                    compound["sdf_osra"] = line
+
+            if is_output_sdf:
+                mol_blocks.append(molecule.molblock)
+
+            if osra_output_format in osra_smiles_outputs:
+                compound.update([(x[0], x[1]) for x in zip(list(output_cols.keys()), line[1:])])
+            else:
+                compound["page"] = page if use_gm else custom_page if custom_page else 1
+
+            compounds.append(compound)
+        else:
+            warnings.append("Cannot convert to RDKit mol: {}".format(source.strip()))
+
+    return compounds, mol_blocks, warnings, take_stats()
+
+
 class OSRA(AbstractLinker):
     """
     Represents the OSRA software and acts as a linker between Python and command-line interface of OSRA.
@@ -49,6 +149,14 @@ class OSRA(AbstractLinker):
         Return dict with options having internal names.
     path_to_binary : str
         Path to OSRA binary.
+    cache : DiskCache
+        Cache of OSRA output for page images or None.
+    standardization_cache_path : str
+        Path to cache of standardized molecules or empty string.
+    annotation_cache_path : str
+        Path to cache of PubChem and ChemSpider lookups or empty string.
+    annotation_backend : str
+        "online" or "offline" annotation, see `annotation.Annotator`.
 
     Methods
     -------
@@ -86,6 +194,12 @@ class OSRA(AbstractLinker):
 
     # GraphicsMagick command to convert PDF to numbered PNG images
     GM_COMMAND = "gm convert -density {dpi} {input_file_path} +adjoin {trim} -quality 100 {temp_dir}/{input_file}-%d.png"
+    # DPI of page rendered to find figure regions and margin [inches] added around them, see _figure_regions()
+    FIGURE_DETECTION_DPI = 100
+    FIGURE_MARGIN = 0.15
+    # minimal overlap (relative to the smaller box) of structures from two passes to be taken as the same structure,
+    # see _merge_passes()
+    PASS_OVERLAP = 0.5
     logger = logging.getLogger("osra")
 
     def __init__(self,
@@ -105,6 +219,14 @@ class OSRA(AbstractLinker):
                  rotate: int = 0,
                  superatom_config_path: str = "superatom.txt",
                  spelling_config_path: str = "spelling.txt",
+                 cache_path: str = "",
+                 cache_max_entries: int = 10000,
+                 standardization_cache_path: str = "",
+                 annotation_cache_path: str = "",
+                 annotation_cache_ttl: float = 30,
+                 annotation_cache_negative_ttl: float = 7,
+                 annotation_backend: str = "online",
+                 pubchem_index_path: str = "",
                  verbosity: int = 1):
         """
         Parameters
@@ -138,6 +260,28 @@ class OSRA(AbstractLinker):
             Path to superatom label map to SMILES.
         spelling_config_path : str
             Path to spelling correction dictionary.
+        cache_path : str
+            | Path to SQLite database with cached OSRA output. If set, output for each page image (or input file) is
+              stored under hash of its content and OSRA options (with hashes of superatom and spelling files), so OSRA
+              is not run again for the same image, e.g. in reprocessed PDF or same figure in other document.
+            | Only successful runs are cached.
+        cache_max_entries : int
+            Maximum number of cached images. Least recently used ones are evicted. If 0, the size is not bounded.
+        standardization_cache_path : str
+            Path to SQLite database with cached standardized molecules, see `conversion.MolConverter`. It can be
+            shared with OPSIN and ChemSpot.
+        annotation_cache_path : str
+            Path to SQLite database with cached PubChem and ChemSpider lookups made in annotation, see
+            `annotation.Annotator`. It can be shared by processes and runs.
+        annotation_cache_ttl : float
+            Days after which cached lookup expires. If 0, it doesn't expire.
+        annotation_cache_negative_ttl : float
+            Days after which cached lookup with nothing found expires. If 0, it doesn't expire.
+        annotation_backend : str
+            "online" to annotate in PubChem and ChemSpider APIs, "offline" to annotate in local PubChem index at
+            `pubchem_index_path` (ChemSpider isn't searched then).
+        pubchem_index_path : str
+            Path to PubChem index built by `pubchem_index.build_pubchem_index`.
         verbosity : int
             This class's verbosity. Values: 0, 1, 2
         """
@@ -147,6 +291,7 @@ class OSRA(AbstractLinker):
         elif verbosity not in verbosity_levels:
             verbosity = 1
         self.logger.setLevel(verbosity_levels[verbosity])
+        self.verbosity = verbosity
 
         if superatom_config_path == "superatom.txt" and "OSRA_DATA_PATH" in os.environ:
             superatom_config_path = "{}/{}".format(os.environ["OSRA_DATA_PATH"], "superatom.txt")
@@ -156,6 +301,13 @@ class OSRA(AbstractLinker):
 
         self.path_to_binary = path_to_binary
         _, self.options, self.options_internal = self.build_commands(locals(), self._OPTIONS_REAL, path_to_binary)
+        self.cache = DiskCache(cache_path, max_entries=cache_max_entries, verbosity=verbosity) if cache_path else None
+        self.standardization_cache_path = standardization_cache_path
+        self.annotation_cache_path = annotation_cache_path
+        self.annotation_cache_ttl = annotation_cache_ttl
+        self.annotation_cache_negative_ttl = annotation_cache_negative_ttl
+        self.annotation_backend = annotation_backend
+        self.pubchem_index_path = pubchem_index_path
 
     def set_options(self, options: dict):
         """
@@ -199,7 +351,31 @@ class OSRA(AbstractLinker):
         else:
             return stdout
 
-    def _process(self, input_file: str, commands: list, dry_run: bool = False, page: int = 1):
+    def _cache_options(self, commands: list) -> list:
+        """
+        Return OSRA options from `commands` for cache key. Paths to superatom and spelling files are replaced by hashes
+        of their content.
+        """
+
+        config_options = [self._OPTIONS_REAL[x][0] for x in ["superatom_config_path", "spelling_config_path"]]
+        options = commands[1:]
+        for i, option in enumerate(options[:-1]):
+            if option in config_options and os.path.isfile(options[i + 1]):
+                options[i + 1] = file_hash(options[i + 1])
+        return options
+
+    @staticmethod
+    def _result(page: int, stdout: str = "", stderr: str = "", exit_code: int = 0, cached: bool = False,
+                skipped: bool = False, timeouts: list = None) -> dict:
+        """
+        Return result of processing one image (or page) with OSRA.
+        """
+
+        return {"stdout": stdout, "stderr": stderr, "exit_code": exit_code, "page": page, "cached": cached,
+                "skipped": skipped, "timeouts": timeouts if timeouts else []}
+
+    def _process(self, input_file: str, commands: list, dry_run: bool = False, page: int = 1, cache_options: list = None,
+                 prefilter_threshold: int = 0, image_dpi: int = 300, timeout: float = 0, cpu_time: int = 0):
         """
         Process one file with OSRA.
 
@@ -208,6 +384,17 @@ class OSRA(AbstractLinker):
         input_file : str
         commands : list
         dry_run : bool
+        page : int
+        cache_options : list
+            Options for cache key, see `_cache_options`. Used only if `cache` is set.
+        prefilter_threshold : int
+            If greater than 0, skip image which doesn't likely contain 2D structure, see `prefilter.has_structure`.
+        image_dpi : int
+            Resolution of image for pre-filter.
+        timeout : float
+            Wall-clock timeout [s] of OSRA. If exceeded, OSRA is killed and the timeout is recorded in "timeouts".
+        cpu_time : int
+            CPU time limit [s] of OSRA, handled like `timeout`.
 
         Returns
         -------
@@ -220,8 +407,558 @@ class OSRA(AbstractLinker):
         if dry_run:
             return commands
 
-        output = common_subprocess(commands)
-        return {"stdout": output.stdout, "stderr": output.stderr, "exit_code": output.exit_code, "page": page}
+        key = None
+        if self.cache is not None:
+            key = make_key(file_hash(input_file), cache_options)
+            cached = self.cache.get(key)
+            if cached:
+                return self._result(page, stdout=cached["stdout"], stderr=cached["stderr"], cached=True)
+
+        if prefilter_threshold > 0:
+            try:
+                likely, score = has_structure(input_file, image_dpi=image_dpi, threshold=prefilter_threshold)
+            except RuntimeError as e:
+                self.logger.warning("Pre-filter failed, processing page {} with OSRA: {}".format(page, e))
+            else:
+                if not likely:
+                    self.logger.info("Skipping page {}: no 2D structure likely found (score {}).".format(page, score))
+                    return self._result(page, skipped=True)
+
+        try:
+            output = common_subprocess(commands, timeout=timeout, cpu_time=cpu_time)
+        except SubprocessTimeoutError as e:
+            self.logger.warning("OSRA on page {}: {}".format(page, e))
+            return self._result(page, timeouts=[{"page": page, "tool": "osra", "elapsed": e.elapsed}])
+
+        if key and output.exit_code == 0:
+            self.cache.set(key, {"stdout": output.stdout, "stderr": output.stderr})
+
+        return self._result(page, stdout=output.stdout, stderr=output.stderr, exit_code=output.exit_code)
+
+    def _process_pdf_page(self, input_file: str, page: int, temp_dir: str, commands: list, dpi: int = 300,
+                          trim: bool = True, cache_options: list = None, prefilter_threshold: int = 0,
+                          timeout: float = 0, cpu_time: int = 0, name_suffix: str = ""):
+        """
+        Render one page of PDF to temporary image, process it with OSRA and delete the image.
+
+        Parameters
+        ----------
+        input_file : str
+        page : int
+            Page number, starting from 1.
+        temp_dir : str
+            Directory for temporary image.
+        commands : list
+        dpi : int
+        trim : bool
+        cache_options : list
+        prefilter_threshold : int
+        timeout : float
+            Wall-clock timeout [s] of rendering and of OSRA.
+        cpu_time : int
+        name_suffix : str
+            Suffix of temporary image name, so more images of the same page can be processed at once.
+
+        Returns
+        -------
+        dict
+        """
+
+        image_file = os.path.join(temp_dir, "{}-{}{}.png".format(os.path.basename(input_file), page - 1, name_suffix))
+        try:
+            try:
+                pdf_page_to_image(input_file, page - 1, image_file, dpi=dpi, trim=trim, timeout=timeout)
+            except SubprocessTimeoutError as e:
+                self.logger.warning("Rendering of page {}: {}".format(page, e))
+                return self._result(page, timeouts=[{"page": page, "tool": "gm", "elapsed": e.elapsed}])
+            return self._process(image_file, commands, page=page, cache_options=cache_options,
+                                 prefilter_threshold=prefilter_threshold, image_dpi=dpi, timeout=timeout,
+                                 cpu_time=cpu_time)
+        finally:
+            if os.path.isfile(image_file):
+                os.remove(image_file)
+
+    def _figure_regions(self, input_file: str, page: int, image_boxes: list) -> list:
+        """
+        Find regions of page which can contain 2D structures: embedded raster images and vector drawings looking like
+        structures (see `prefilter.structure_boxes`) found in page rendered at low resolution. Regions are enlarged by
+        `FIGURE_MARGIN` (so atom labels next to bonds are not cut off) and overlapping ones are merged.
+
+        Parameters
+        ----------
+        input_file : str
+        page : int
+            Page number, starting from 1.
+        image_boxes : list
+            Boxes (left, top, width, height) [points] of embedded images on page, see `utils.get_pdf_image_boxes`.
+
+        Returns
+        -------
+        list of tuples
+            Regions (left, top, right, bottom) in points (1/72 inch).
+        """
+
+        dpi = self.FIGURE_DETECTION_DPI
+        image = read_gray_image("{}[{}]".format(input_file, page - 1), density=dpi)
+        page_height, page_width = (x * 72 / dpi for x in image.shape)
+        margin = self.FIGURE_MARGIN * 72
+
+        regions = [(left, top, left + width, top + height) for left, top, width, height in image_boxes]
+        regions.extend((left * 72 / dpi, top * 72 / dpi, right * 72 / dpi, bottom * 72 / dpi)
+                       for top, left, bottom, right in structure_boxes(image, dpi=dpi))
+        regions = [(max(0, left - margin), max(0, top - margin), min(page_width, right + margin), min(page_height, bottom + margin))
+                   for left, top, right, bottom in regions]
+        regions = [x for x in regions if x[2] > x[0] and x[3] > x[1]]
+
+        merged = True
+        while merged:
+            merged = False
+            for i, a in enumerate(regions):
+                for j in range(i + 1, len(regions)):
+                    b = regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        regions[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+
+        return sorted(regions, key=lambda x: (x[1], x[0]))
+
+    @staticmethod
+    def _shift_coordinates(output: str, dx: int, dy: int) -> str:
+        """
+        Shift OSRA's "x1:y1-x2:y2" coordinates (last column of SMILES output) by `dx` and `dy` pixels.
+        """
+
+        lines = []
+        for line in output.splitlines(keepends=True):
+            columns = line.split()
+            match = re.match(r"^(\d+):(\d+)-(\d+):(\d+)$", columns[-1]) if columns else None
+            if match:
+                x1, y1, x2, y2 = (int(x) for x in match.groups())
+                coordinates = "{}:{}-{}:{}".format(x1 + dx, y1 + dy, x2 + dx, y2 + dy)
+                line = line[:line.rindex(columns[-1])] + coordinates + line[line.rindex(columns[-1]) + len(columns[-1]):]
+            lines.append(line)
+        return "".join(lines)
+
+    def _process_pdf_figures(self, input_file: str, page: int, temp_dir: str, commands: list, image_boxes: list,
+                             dpi: int = 300, cache_options: list = None, prefilter_threshold: int = 0,
+                             timeout: float = 0, cpu_time: int = 0):
+        """
+        Render only figure regions of one page of PDF (see `_figure_regions`) and process them with OSRA. Coordinates
+        are mapped back to page rendered at `dpi`. If regions cannot be found, the whole page is processed.
+
+        Parameters
+        ----------
+        input_file : str
+        page : int
+            Page number, starting from 1.
+        temp_dir : str
+        commands : list
+        image_boxes : list
+        dpi : int
+        cache_options : list
+        prefilter_threshold : int
+        timeout : float
+            Wall-clock timeout [s] of rendering and of OSRA for each region.
+        cpu_time : int
+
+        Returns
+        -------
+        dict
+            Results of all regions joined, "figures" is number of regions.
+        """
+
+        try:
+            regions = self._figure_regions(input_file, page, image_boxes)
+        except RuntimeError as e:
+            self.logger.warning("Cannot find figures on page {}, processing whole page: {}".format(page, e))
+            result = self._process_pdf_page(input_file, page, temp_dir, commands, dpi=dpi, trim=False,
+                                            cache_options=cache_options, prefilter_threshold=prefilter_threshold,
+                                            timeout=timeout, cpu_time=cpu_time)
+            result["figures"] = 1
+            return result
+
+        results = []
+        for i, (left, top, right, bottom) in enumerate(regions):
+            crop = (int(left * dpi / 72), int(top * dpi / 72),
+                    math.ceil((right - left) * dpi / 72), math.ceil((bottom - top) * dpi / 72))
+            image_file = os.path.join(temp_dir, "{}-{}-{}.png".format(os.path.basename(input_file), page - 1, i))
+            try:
+                pdf_page_to_image(input_file, page - 1, image_file, dpi=dpi, crop=crop, timeout=timeout)
+                result = self._process(image_file, commands, page=page, cache_options=cache_options,
+                                       prefilter_threshold=prefilter_threshold, image_dpi=dpi, timeout=timeout,
+                                       cpu_time=cpu_time)
+            except SubprocessTimeoutError as e:
+                self.logger.warning("Rendering of figure on page {}: {}".format(page, e))
+                result = self._result(page, timeouts=[{"page": page, "tool": "gm", "elapsed": e.elapsed}])
+            finally:
+                if os.path.isfile(image_file):
+                    os.remove(image_file)
+            result["stdout"] = self._shift_coordinates(result["stdout"], crop[0], crop[1])
+            results.append(result)
+
+        result = self._result(page,
+                              stdout="".join(x["stdout"] for x in results),
+                              stderr="\n".join(x["stderr"] for x in results if x["stderr"]),
+                              exit_code=max([x["exit_code"] for x in results] or [0]),
+                              cached=bool(results) and all(x["cached"] for x in results),
+                              skipped=all(x["skipped"] for x in results),
+                              timeouts=[y for x in results for y in x["timeouts"]])
+        result["figures"] = len(results)
+        return result
+
+    def _set_resolution(self, commands: list, dpi: int) -> list:
+        """
+        Return copy of `commands` with OSRA's resolution set to `dpi`.
+        """
+
+        commands = commands.copy()
+        option = self._OPTIONS_REAL["resolution"][0]
+        if option in commands:
+            commands[commands.index(option) + 1] = str(dpi)
+        else:
+            commands[1:1] = [option, str(dpi)]
+        return commands
+
+    @staticmethod
+    def _parse_structure(line: str) -> tuple:
+        """
+        Return confidence and box (x1, y1, x2, y2) of structure from line of OSRA's SMILES output. Box is None if
+        coordinates are missing.
+        """
+
+        columns = line.split()
+        try:
+            confidence = float(columns[3])
+        except (IndexError, ValueError):
+            confidence = float("-inf")
+        match = re.match(r"^(\d+):(\d+)-(\d+):(\d+)$", columns[-1]) if columns else None
+        box = tuple(int(x) for x in match.groups()) if match else None
+        return confidence, box
+
+    @staticmethod
+    def _scale_output(output: str, from_dpi: int, to_dpi: int) -> str:
+        """
+        Scale bond lengths and "x1:y1-x2:y2" coordinates in OSRA's SMILES output from `from_dpi` to `to_dpi` and set
+        the resolution to `to_dpi`.
+        """
+
+        scale = to_dpi / from_dpi
+        lines = []
+        for line in output.splitlines():
+            columns = line.split()
+            if len(columns) > 1:
+                try:
+                    columns[1] = "{:.2f}".format(float(columns[1]) * scale)
+                except ValueError:
+                    pass
+                if len(columns) > 2 and columns[2].isdigit():
+                    columns[2] = str(to_dpi)
+                match = re.match(r"^(\d+):(\d+)-(\d+):(\d+)$", columns[-1])
+                if match:
+                    columns[-1] = "{}:{}-{}:{}".format(*(int(round(int(x) * scale)) for x in match.groups()))
+            lines.append(" ".join(columns))
+        return "".join("{}\n".format(x) for x in lines if x)
+
+    def _merge_passes(self, low_output: str, high_output: str) -> str:
+        """
+        Merge OSRA's SMILES outputs of the same page from two passes (with coordinates in the same resolution).
+        Structures are taken by descending confidence and a structure overlapping (see `PASS_OVERLAP`) one already
+        taken from the other pass is dropped. If coordinates are missing, output of pass with higher mean confidence
+        is used.
+        """
+
+        structures = []
+        for pass_index, output in enumerate([low_output, high_output]):
+            for line in output.splitlines():
+                if line.strip():
+                    confidence, box = self._parse_structure(line)
+                    structures.append((confidence, pass_index, box, line))
+
+        if any(box is None for _, _, box, _ in structures):
+            def mean_confidence(pass_index):
+                confidences = [x[0] for x in structures if x[1] == pass_index]
+                return sum(confidences) / len(confidences) if confidences else float("-inf")
+            return high_output if mean_confidence(1) >= mean_confidence(0) else low_output
+
+        def overlap(a, b):
+            width = min(a[2], b[2]) - max(a[0], b[0])
+            height = min(a[3], b[3]) - max(a[1], b[1])
+            if width <= 0 or height <= 0:
+                return 0
+            smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+            return width * height / smaller if smaller > 0 else 1
+
+        taken = []
+        for structure in sorted(structures, key=lambda x: (-x[0], -x[1])):
+            if not any(x[1] != structure[1] and overlap(x[2], structure[2]) >= self.PASS_OVERLAP for x in taken):
+                taken.append(structure)
+
+        taken.sort(key=lambda x: (x[2][1], x[2][0]))
+        return "".join("{}\n".format(x[3].strip()) for x in taken)
+
+    def _process_pdf_page_two_pass(self, input_file: str, page: int, temp_dir: str, commands: list,
+                                   low_commands: list, low_dpi: int = 150, dpi: int = 300, trim: bool = True,
+                                   min_confidence: float = 0.2, cache_options: list = None,
+                                   low_cache_options: list = None, prefilter_threshold: int = 0, timeout: float = 0,
+                                   cpu_time: int = 0):
+        """
+        Process one page of PDF at `low_dpi` and, if needed, again at `dpi`. The second pass is run when any structure
+        has confidence lower than `min_confidence` or when no structure was found, but the page likely contains one
+        (see `prefilter.has_structure`). Results of both passes are merged by `_merge_passes`, coordinates and bond
+        lengths are in pixels of page rendered at `dpi`.
+
+        Parameters
+        ----------
+        input_file : str
+        page : int
+            Page number, starting from 1.
+        temp_dir : str
+        commands : list
+            OSRA commands of the second pass.
+        low_commands : list
+            OSRA commands of the first pass, with resolution set to `low_dpi`.
+        low_dpi : int
+        dpi : int
+        trim : bool
+        min_confidence : float
+        cache_options : list
+        low_cache_options : list
+        prefilter_threshold : int
+            If greater than 0, skip page which doesn't likely contain 2D structure, judged from the first pass image.
+        timeout : float
+        cpu_time : int
+
+        Returns
+        -------
+        dict
+            "second_pass" is True if the page was processed again at `dpi`.
+        """
+
+        image_file = os.path.join(temp_dir, "{}-{}-low.png".format(os.path.basename(input_file), page - 1))
+        try:
+            try:
+                pdf_page_to_image(input_file, page - 1, image_file, dpi=low_dpi, trim=trim, timeout=timeout)
+            except SubprocessTimeoutError as e:
+                self.logger.warning("Rendering of page {}: {}".format(page, e))
+                result = self._result(page, timeouts=[{"page": page, "tool": "gm", "elapsed": e.elapsed}])
+                result["second_pass"] = False
+                return result
+
+            try:
+                likely, score = has_structure(image_file, image_dpi=low_dpi, threshold=max(1, prefilter_threshold))
+            except RuntimeError as e:
+                self.logger.warning("Pre-filter failed on page {}: {}".format(page, e))
+                likely = True
+            else:
+                if prefilter_threshold and not likely:
+                    self.logger.info("Skipping page {}: no 2D structure likely found (score {}).".format(page, score))
+                    result = self._result(page, skipped=True)
+                    result["second_pass"] = False
+                    return result
+
+            low = self._process(image_file, low_commands, page=page, cache_options=low_cache_options, timeout=timeout,
+                                cpu_time=cpu_time)
+        finally:
+            if os.path.isfile(image_file):
+                os.remove(image_file)
+
+        confidences = [self._parse_structure(x)[0] for x in low["stdout"].splitlines() if x.strip()]
+        if low["exit_code"] == 0 and not low["timeouts"] and \
+                (confidences and min(confidences) >= min_confidence or not confidences and not likely):
+            low["stdout"] = self._scale_output(low["stdout"], low_dpi, dpi)
+            low["second_pass"] = False
+            return low
+
+        high = self._process_pdf_page(input_file, page, temp_dir, commands, dpi=dpi, trim=trim,
+                                      cache_options=cache_options, timeout=timeout, cpu_time=cpu_time)
+        if low["exit_code"] > 0 or low["timeouts"]:
+            high["timeouts"] = low["timeouts"] + high["timeouts"]
+            high["second_pass"] = True
+            return high
+
+        result = self._result(page,
+                              stdout=self._merge_passes(self._scale_output(low["stdout"], low_dpi, dpi), high["stdout"]),
+                              stderr="\n".join(x for x in [low["stderr"], high["stderr"]] if x),
+                              exit_code=high["exit_code"],
+                              cached=low["cached"] and high["cached"],
+                              timeouts=high["timeouts"])
+        result["second_pass"] = True
+        return result
+
+    def _variant_commands(self, options_internal: dict, variant: dict) -> list:
+        """
+        Return OSRA commands with options of `options_internal` overridden by `variant`.
+        """
+
+        unknown = [k for k in variant if k not in self._OPTIONS_REAL]
+        if unknown:
+            raise ValueError("Unknown OSRA options in ensemble variant: {}. Possible options: {}".format(
+                unknown, list(self._OPTIONS_REAL.keys())))
+        commands, _, _ = self.build_commands(ChainMap(variant, options_internal), self._OPTIONS_REAL, self.path_to_binary)
+        commands.extend(["--bond", "--coordinates", "--page", "--guess", "--print"])
+        return commands
+
+    def _process_variant(self, input_file: str, page: int, temp_dir: str, commands: list, variant: int,
+                         render: bool = True, dpi: int = 300, trim: bool = True, cache_options: list = None,
+                         prefilter_threshold: int = 0, min_confidence: float = 0, timeout: float = 0,
+                         cpu_time: int = 0):
+        """
+        Process one page (rendered from PDF if `render` is True, otherwise `input_file` is the image) with one
+        variant of OSRA options in ensemble. Variant is skipped if another variant of the same page already reached
+        `min_confidence`: then it creates a marker file in `temp_dir`, which is shared by all workers.
+
+        Returns
+        -------
+        dict
+            "variant" is index of variant, "ensemble_skipped" is True if variant wasn't run.
+        """
+
+        marker = os.path.join(temp_dir, "{}-{}.done".format(os.path.basename(input_file), page))
+        if os.path.isfile(marker):
+            result = self._result(page)
+            result.update([("variant", variant), ("ensemble_skipped", True)])
+            return result
+
+        if render:
+            result = self._process_pdf_page(input_file, page, temp_dir, commands, dpi=dpi, trim=trim,
+                                            cache_options=cache_options, prefilter_threshold=prefilter_threshold,
+                                            timeout=timeout, cpu_time=cpu_time, name_suffix="-{}".format(variant))
+        else:
+            result = self._process(input_file, commands, page=page, cache_options=cache_options,
+                                   prefilter_threshold=prefilter_threshold, image_dpi=dpi, timeout=timeout,
+                                   cpu_time=cpu_time)
+
+        confidences = [self._parse_structure(x)[0] for x in result["stdout"].splitlines() if x.strip()]
+        # other variants would skip the same image too
+        if result["skipped"] or min_confidence and confidences and min(confidences) >= min_confidence:
+            open(marker, mode="w").close()
+
+        result.update([("variant", variant), ("ensemble_skipped", False)])
+        return result
+
+    def _merge_variants(self, results: list, standardize_mols: bool = True) -> dict:
+        """
+        Merge OSRA's SMILES outputs of one page from ensemble variants. Structures are identified by InChI key (or by
+        SMILES, if it cannot be created) and page column. A structure drawn more times on the page is kept as many times
+        as the variant which found most of its occurrences, using the lines with the highest confidence from all variants.
+
+        Parameters
+        ----------
+        results : list
+            Results of `_process_variant` for the same page.
+        standardize_mols : bool
+            Standardize molecules before creating InChI key, see `conversion.MolConverter`.
+
+        Returns
+        -------
+        dict
+        """
+
+        converter = get_converter(standardize=standardize_mols, cache_path=self.standardization_cache_path)
+        # structure key -> (confidence, line) from all variants
+        candidates = OrderedDict()
+        # structure key -> the highest number of occurrences found by one variant
+        counts = {}
+        for result in sorted(results, key=lambda x: x["variant"]):
+            variant_counts = {}
+            for line in result["stdout"].splitlines():
+                columns = line.split()
+                if not columns:
+                    continue
+                molecule, _ = converter.convert(columns[0], "smiles")
+                key = (columns[4] if len(columns) > 4 else "", molecule.inchikey if molecule and molecule.inchikey else columns[0])
+                confidence, _ = self._parse_structure(line)
+                candidates.setdefault(key, []).append((confidence, line.strip()))
+                variant_counts[key] = variant_counts.get(key, 0) + 1
+            for key, n in variant_counts.items():
+                counts[key] = max(counts.get(key, 0), n)
+
+        merged = []
+        for key, lines in candidates.items():
+            lines.sort(key=lambda x: -x[0])
+            merged.extend(x[1] for x in lines[:counts[key]])
+
+        run = [x for x in results if not x["ensemble_skipped"]]
+        succeeded = [x for x in run if x["exit_code"] == 0]
+        return self._result(results[0]["page"],
+                            stdout="".join("{}\n".format(x) for x in merged),
+                            stderr="\n".join(x["stderr"] for x in run if x["stderr"]),
+                            exit_code=0 if succeeded or not run else max(x["exit_code"] for x in run),
+                            cached=bool(run) and all(x["cached"] for x in run),
+                            skipped=bool(run) and all(x["skipped"] for x in run),
+                            timeouts=[y for x in run for y in x["timeouts"]])
+
+    def _get_annotator(self, chemspider_token: str = "", n_workers: int = 8) -> Annotator:
+        """
+        Return `Annotator` configured by annotation options of this instance.
+        """
+
+        return Annotator(chemspider_token=chemspider_token, n_workers=n_workers, backend=self.annotation_backend,
+                         index_path=self.pubchem_index_path, cache_path=self.annotation_cache_path,
+                         cache_ttl=self.annotation_cache_ttl, cache_negative_ttl=self.annotation_cache_negative_ttl,
+                         verbosity=self.verbosity)
+
+    @staticmethod
+    def _annotation_key(ent: OrderedDict) -> tuple:
+        """
+        Return identity of compound in annotation: entities with the same key are annotated once, see `process`.
+        """
+
+        if ent.get("inchikey"):
+            return "inchikey", ent["inchikey"]
+        return "structure", ent.get("smiles", ""), ent.get("inchi", "")
+
+    @staticmethod
+    def _annotate_entity(ent: OrderedDict, annotator: Annotator):
+        """
+        Annotate compound in PubChem and ChemSpider, see `process`. Called concurrently by `Annotator.map`.
+        """
+
+        ent.update(OrderedDict([("pch_cids_by_inchikey", ""), ("chs_cids_by_inchikey", ""),
+                                ("pch_cids_by_smiles", ""), ("chs_cids_by_smiles", ""),
+                                ("pch_cids_by_inchi", ""), ("chs_cids_by_inchi", ""),
+                                ("pch_iupac_name", ""), ("chs_common_name", ""),
+                                ("pch_synonyms", "")]))
+
+        # prefer InChI key
+        if "inchikey" in ent and ent["inchikey"]:
+            results = annotator.pubchem.get_compounds(ent["inchikey"], "inchikey")
+            if results:
+                if len(results) == 1:
+                    result = results[0]
+                    synonyms = result.synonyms
+                    if synonyms:
+                        ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
+                    ent["pch_iupac_name"] = result.iupac_name
+                ent["pch_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
+
+            results = annotator.search_chemspider(ent["inchikey"])
+            if results:
+                if len(results) == 1:
+                    result = results[0]
+                    ent["chs_common_name"] = result.common_name
+                ent["chs_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
+        else:
+            for search_field, col_pch, col_chs in [("smiles", "pch_cids_by_smiles", "chs_cids_by_smiles"),
+                                                   ("inchi", "pch_cids_by_inchi", "chs_cids_by_inchi")]:
+                results_pch = []
+                results_chs = []
+
+                if search_field == "smiles" and "smiles" in ent and ent["smiles"] and "*" not in ent["smiles"]:
+                    results_pch = annotator.pubchem.get_compounds(ent["smiles"], "smiles")
+                    results_chs = annotator.search_chemspider(ent["smiles"])
+                elif search_field == "inchi" and "inchi" in ent and ent["inchi"]:
+                    results_pch = annotator.pubchem.get_compounds(ent["inchi"], "inchi")
+                    results_chs = annotator.search_chemspider(ent["inchi"])
+
+                if results_pch:
+                    ent[col_pch] = "\"{}\"".format(",".join([str(c.cid) for c in results_pch]))
+                if results_chs:
+                    ent[col_chs] = "\"{}\"".format(",".join([str(c.csid) for c in results_chs]))
 
     def process(self,
                 input_file: str,
@@ -243,8 +980,19 @@ class OSRA(AbstractLinker):
                 standardize_mols: bool = True,
                 annotate: bool = True,
                 chemspider_token: str = "",
+                annotation_workers: int = 8,
                 custom_page: int = 0,
-                continue_on_failure: bool = False) -> OrderedDict:
+                continue_on_failure: bool = False,
+                figures_only: bool = False,
+                prefilter: bool = False,
+                prefilter_threshold: int = DEFAULT_THRESHOLD,
+                timeout: float = 0,
+                cpu_time: int = 0,
+                two_pass: bool = False,
+                first_pass_dpi: int = 150,
+                min_confidence: float = 0.2,
+                ensemble: list = None,
+                ensemble_min_confidence: float = 0) -> OrderedDict:
         r"""
         Process the input file with OSRA.
 
@@ -325,13 +1073,60 @@ class OSRA(AbstractLinker):
               each identifier, separately for SMILES, InChI etc.
             | If entity has InChI key yet, prefer it in searching.
             | If "*" is present in SMILES, skip annotation.
+            | Each distinct compound (by InChI key, otherwise by SMILES and InChI) is annotated once and its results
+              are copied to its other occurrences.
         chemspider_token : str
             Your personal token for accessing the ChemSpider API. Make account there to obtain it.
+        annotation_workers : int
+            Number of entities annotated concurrently. Requests are rate-limited to published limits of the services.
         custom_page : bool
             When `use_gm` is False, this will set the page for all extracted compounds.
         continue_on_failure : bool
             | If True, continue running even if OSRA returns non-zero exit code.
             | If False and error occurs, print it and return.
+        figures_only : bool
+            | If True and `use_gm` is True, don't process whole pages of PDF, but only regions with embedded images
+              (found by pdftohtml) and vector drawings looking like 2D structures. Only these regions are rendered
+              at `gm_dpi` and processed by OSRA.
+            | Coordinates are then in pixels of untrimmed page rendered at `gm_dpi`.
+            | Pages without figures are returned in "skipped_pages".
+        prefilter : bool
+            | If True, cheaply check each page image (downsampled, with NumPy) for drawings looking like 2D structure
+              and skip OSRA for pages without them. See `molminer.prefilter`.
+            | Numbers of skipped pages are returned in "skipped_pages".
+        prefilter_threshold : int
+            Minimal number of structure-like drawings on page processed by OSRA. Default value favours recall.
+        timeout : float
+            | Wall-clock timeout [s] for each run of OSRA (and rendering of page by gm). Process exceeding it is killed
+              with its children and the page is recorded in "timeouts" instead of failing the whole document.
+            | Commands processing the whole PDF at once (reading of image positions, rendering of all pages when page
+              count is unknown) get it multiplied by number of pages.
+            | If 0, there is no timeout.
+        cpu_time : int
+            CPU time limit [s] for each run of OSRA, handled like `timeout`. If 0, there is no limit.
+        two_pass : bool
+            | If True, `use_gm` is True and input file is PDF, pages are first rendered and processed at `first_pass_dpi`
+              (with OSRA's resolution set to it). Only pages with structures of confidence lower than `min_confidence`
+              or pages likely containing structure (see `prefilter`) with none found are processed again at `gm_dpi`.
+              Structures of both passes are merged by confidence.
+            | Coordinates and bond lengths are in pixels of page rendered at `gm_dpi`. Numbers of pages processed twice
+              are returned in "second_pass_pages".
+            | Works only with "smi" and "can" OSRA output formats and is not used with `figures_only`.
+        first_pass_dpi : int
+            DPI of page images in the first pass of `two_pass`.
+        min_confidence : float
+            Minimal OSRA's confidence of structures accepted from the first pass of `two_pass`.
+        ensemble : list
+            | List of dicts with variants of OSRA options (keys are the same as in __init__), e.g.
+              ``[{"rotate": 90}, {"negate": True}, {"adaptive": True, "unpaper": 1}]``. Options set in __init__ are
+              overridden by each variant and also run as the first variant.
+            | All variants of each page run in the joblib pool of `n_jobs` and their structures are merged by InChI key,
+              keeping the one with the highest confidence. Coordinates are reported by the variant which recognized
+              the structure.
+            | Works only with "smi" and "can" OSRA output formats and is not used with `figures_only` and `two_pass`.
+        ensemble_min_confidence : float
+            If greater than 0, variants of page not yet started are skipped once any variant finds structures all
+            having at least this confidence.
 
         Returns
         -------
@@ -341,6 +1136,9 @@ class OSRA(AbstractLinker):
             - stdout: str ... standard output from OSRA
             - stderr: str ... standard error output from OSRA
             - exit_code: int ... exit code from OSRA
+            - skipped_pages: list ... pages skipped by pre-filter
+            - timeouts: list ... dicts with "page", "tool" and "elapsed" keys for killed processes
+            - second_pass_pages: list ... pages processed again at `gm_dpi` when `two_pass` is True
             - content:
 
                 - list of OrderedDicts ... when `format_output` is True.
@@ -416,7 +1214,7 @@ class OSRA(AbstractLinker):
         #                   options_internal)
 
         if annotate:
-            if not chemspider_token:
+            if not chemspider_token and self.annotation_backend == "online":
                 self.logger.warning("Cannot perform annotation in ChemSpider: 'chemspider_token' is empty.")
             [output_formats.append(x) for x in ["smiles", "inchi", "inchikey"] if x not in output_formats]
             output_formats = sorted(output_formats)
@@ -427,18 +1225,153 @@ class OSRA(AbstractLinker):
         if dry_run:
             return " ".join(commands)
 
+        cache_options = self._cache_options(commands) if self.cache is not None else None
+        prefilter_threshold = max(1, prefilter_threshold) if prefilter else 0
+
+        if two_pass and osra_output_format not in osra_smiles_outputs:
+            self.logger.warning("Two-pass processing needs confidence from OSRA's \"smi\" or \"can\" output format, processing pages once.")
+            two_pass = False
+        elif two_pass and figures_only:
+            self.logger.warning("Two-pass processing is not used with 'figures_only'.")
+            two_pass = False
+        if two_pass:
+            low_commands = self._set_resolution(commands, first_pass_dpi)
+            low_cache_options = self._cache_options(low_commands) if self.cache is not None else None
+
+        if ensemble and osra_output_format not in osra_smiles_outputs:
+            self.logger.warning("Ensemble needs confidence from OSRA's \"smi\" or \"can\" output format, running only base options.")
+            ensemble = None
+        elif ensemble and (figures_only or two_pass):
+            self.logger.warning("Ensemble is not used with 'figures_only' or 'two_pass'.")
+            ensemble = None
+        if ensemble:
+            variant_commands = [commands] + [self._variant_commands(options_internal, x) for x in ensemble]
+            variant_cache_options = [self._cache_options(x) if self.cache is not None else None for x in variant_commands]
+
         osra_output_list = []
-        if input_type == "image" or not use_gm:
-            osra_output_list.append(self._process(input_file, commands, page=custom_page if custom_page else 1))
-        elif input_type == "pdf":
+        if (input_type == "image" or not use_gm) and ensemble:
             with tempfile.TemporaryDirectory() as temp_dir:
-                stdout, stderr, exit_code = pdf_to_images(input_file, temp_dir, dpi=gm_dpi, trim=gm_trim)
                 osra_output_list = Parallel(n_jobs=n_jobs)(
-                    delayed(self._process)(temp_image_file, commands, page=page)
-                                           for temp_image_file, page in get_temp_images(temp_dir))
+                    delayed(self._process_variant)(input_file, custom_page if custom_page else 1, temp_dir, x, i,
+                                                   render=False, dpi=options_internal.get("resolution", 300),
+                                                   cache_options=variant_cache_options[i],
+                                                   prefilter_threshold=prefilter_threshold if input_type == "image" else 0,
+                                                   min_confidence=ensemble_min_confidence, timeout=timeout,
+                                                   cpu_time=cpu_time)
+                    for i, x in enumerate(variant_commands))
+        elif input_type == "image" or not use_gm:
+            osra_output_list.append(self._process(input_file, commands, page=custom_page if custom_page else 1,
+                                                  cache_options=cache_options,
+                                                  prefilter_threshold=prefilter_threshold if input_type == "image" else 0,
+                                                  image_dpi=options_internal.get("resolution", 300), timeout=timeout,
+                                                  cpu_time=cpu_time))
+        elif input_type == "pdf":
+            with tempfile.TemporaryDirectory() as temp_dir:
+                # each page is rendered by the worker which processes it, so OSRA starts as soon as the first page is
+                # rendered and only images of pages being processed are on disk
+                try:
+                    n_pages = get_pdf_page_count(input_file)
+                except RuntimeError as e:
+                    self.logger.warning("{} Rendering all pages at once.".format(e))
+                    n_pages = 0
+
+                image_boxes = {}
+                if n_pages and figures_only:
+                    try:
+                        boxes_timeout, boxes_cpu_time = pdf_limits(input_file, timeout, cpu_time, n_pages)
+                        image_boxes = get_pdf_image_boxes(input_file, temp_dir, timeout=boxes_timeout,
+                                                          cpu_time=boxes_cpu_time)
+                    except RuntimeError as e:
+                        self.logger.warning("{} Looking only for vector figures.".format(e))
+
+                if n_pages and figures_only:
+                    osra_output_list = Parallel(n_jobs=n_jobs)(
+                        delayed(self._process_pdf_figures)(input_file, page, temp_dir, commands, image_boxes.get(page, []),
+                                                           dpi=gm_dpi, cache_options=cache_options,
+                                                           prefilter_threshold=prefilter_threshold, timeout=timeout,
+                                                           cpu_time=cpu_time)
+                        for page in range(1, n_pages + 1))
+                    self.logger.info("OSRA: processed {} figures on {} pages.".format(
+                        sum(x["figures"] for x in osra_output_list), n_pages))
+                elif n_pages and two_pass:
+                    osra_output_list = Parallel(n_jobs=n_jobs)(
+                        delayed(self._process_pdf_page_two_pass)(input_file, page, temp_dir, commands, low_commands,
+                                                                 low_dpi=first_pass_dpi, dpi=gm_dpi, trim=gm_trim,
+                                                                 min_confidence=min_confidence,
+                                                                 cache_options=cache_options,
+                                                                 low_cache_options=low_cache_options,
+                                                                 prefilter_threshold=prefilter_threshold,
+                                                                 timeout=timeout, cpu_time=cpu_time)
+                        for page in range(1, n_pages + 1))
+                elif n_pages and ensemble:
+                    # variants of the same page are dispatched together, so they run concurrently and the rest is
+                    # skipped when one of them reaches ensemble_min_confidence
+                    osra_output_list = Parallel(n_jobs=n_jobs)(
+                        delayed(self._process_variant)(input_file, page, temp_dir, x, i, dpi=gm_dpi, trim=gm_trim,
+                                                       cache_options=variant_cache_options[i],
+                                                       prefilter_threshold=prefilter_threshold,
+                                                       min_confidence=ensemble_min_confidence, timeout=timeout,
+                                                       cpu_time=cpu_time)
+                        for page in range(1, n_pages + 1) for i, x in enumerate(variant_commands))
+                elif n_pages:
+                    osra_output_list = Parallel(n_jobs=n_jobs)(
+                        delayed(self._process_pdf_page)(input_file, page, temp_dir, commands, dpi=gm_dpi, trim=gm_trim,
+                                                        cache_options=cache_options, prefilter_threshold=prefilter_threshold,
+                                                        timeout=timeout, cpu_time=cpu_time)
+                        for page in range(1, n_pages + 1))
+                else:
+                    gm_timeout, gm_cpu_time = pdf_limits(input_file, timeout, cpu_time)
+                    stdout, stderr, exit_code = pdf_to_images(input_file, temp_dir, dpi=gm_dpi, trim=gm_trim,
+                                                              timeout=gm_timeout, cpu_time=gm_cpu_time)
+                    if ensemble:
+                        osra_output_list = Parallel(n_jobs=n_jobs)(
+                            delayed(self._process_variant)(temp_image_file, page, temp_dir, x, i, render=False, dpi=gm_dpi,
+                                                           cache_options=variant_cache_options[i],
+                                                           prefilter_threshold=prefilter_threshold,
+                                                           min_confidence=ensemble_min_confidence, timeout=timeout,
+                                                           cpu_time=cpu_time)
+                            for temp_image_file, page in get_temp_images(temp_dir) for i, x in enumerate(variant_commands))
+                    else:
+                        osra_output_list = Parallel(n_jobs=n_jobs)(
+                            delayed(self._process)(temp_image_file, commands, page=page, cache_options=cache_options,
+                                                   prefilter_threshold=prefilter_threshold, image_dpi=gm_dpi, timeout=timeout,
+                                                   cpu_time=cpu_time)
+                                                   for temp_image_file, page in get_temp_images(temp_dir))
+
+        if ensemble:
+            n_runs = sum(not x["ensemble_skipped"] for x in osra_output_list)
+            self.logger.info("OSRA ensemble: {} of {} variant runs done{}.".format(
+                n_runs, len(osra_output_list),
+                ", the rest skipped after reaching confidence {}".format(ensemble_min_confidence) if n_runs < len(osra_output_list) else ""))
+            pages = OrderedDict()
+            for result in osra_output_list:
+                pages.setdefault(result["page"], []).append(result)
+            osra_output_list = [self._merge_variants(x, standardize_mols=standardize_mols) for x in pages.values()]
+
+        if self.cache is not None:
+            self.logger.info("OSRA cache: {} of {} images found.".format(sum(x["cached"] for x in osra_output_list),
+                                                                         len(osra_output_list)))
+
+        if prefilter_threshold or figures_only:
+            skipped_pages = sorted(x["page"] for x in osra_output_list if x["skipped"])
+            self.logger.info("OSRA: {} of {} pages skipped{}".format(
+                len(skipped_pages), len(osra_output_list), ": {}".format(skipped_pages) if skipped_pages else "."))
+        else:
+            skipped_pages = []
+
+        second_pass_pages = sorted(x["page"] for x in osra_output_list if x.get("second_pass"))
+        if any("second_pass" in x for x in osra_output_list):
+            self.logger.info("OSRA: {} of {} pages needed second pass at {} DPI{}".format(
+                len(second_pass_pages), len(osra_output_list), gm_dpi,
+                ": {}".format(second_pass_pages) if second_pass_pages else "."))
+
+        timeouts = sorted((y for x in osra_output_list for y in x["timeouts"]), key=lambda x: x["page"])
+        if timeouts:
+            self.logger.warning("OSRA: processes killed on pages {}.".format(", ".join(str(x["page"]) for x in timeouts)))
 
         # summarize OSRA results
-        to_return = {"stdout": [], "stderr": [], "exit_code": [], "content": None, "pages": []}
+        to_return = {"stdout": [], "stderr": [], "exit_code": [], "content": None, "pages": [], "skipped_pages": skipped_pages,
+                     "timeouts": timeouts, "second_pass_pages": second_pass_pages}
         for result in osra_output_list:
             if result["stdout"]:
                 to_return["stdout"].append(result["stdout"])
@@ -475,96 +1408,23 @@ class OSRA(AbstractLinker):
             compound_template_dict = OrderedDict.fromkeys(["page"] + output_formats)
 
         if any(to_return["stdout"]):
-            if standardize_mols:
-                standardizer = Standardizer()
+            # RDKit parsing, standardization and conversion run in worker processes, page by page
+            records = Parallel(n_jobs=n_jobs if len(to_return["pages"]) > 1 else 1)(
+                delayed(_format_page)(output, page, osra_output_format, output_formats, output_cols,
+                                      compound_template_dict, standardize_mols, is_output_sdf, use_gm, custom_page,
+                                      self.standardization_cache_path)
+                for output, page in zip(to_return["stdout"], to_return["pages"]))
 
             compounds = []
+            for page_compounds, mol_blocks, warnings, stats in records:
+                for warning in warnings:
+                    self.logger.warning(warning)
+                compounds.extend(page_compounds)
+                add_stats(stats)
 
             if is_output_sdf:
-                if sdf_append:
-                    if not os.path.isfile(output_file_sdf):
-                        open(output_file_sdf, mode="w", encoding="utf-8").close()
-                    writer = SDWriter(open(output_file_sdf, mode="a", encoding="utf-8"))
-                else:
-                    writer = SDWriter(output_file_sdf)
-
-            for output, page in zip(to_return["stdout"], to_return["pages"]):
-                if osra_output_format in osra_smiles_outputs:
-                    lines = [x.strip() for x in output.split("\n") if x]
-                else:
-                    lines = [x for x in output.split("$$$$") if x.strip()]
-
-                for line in lines:
-                    """
-                    # so much problems with --learn
-                    # we can't simply split output by " " when --learn is present, because its output is like "1,2,2,2 1"
-                    if "learn" in filtered_cols:
-                        learn_start = filtered_cols.index("learn") + 1 #  "smiles" col isn't in output_cols
-                        learn_end = filtered_cols.index("learn") + 1 + 3
-                        line[learn_start:learn_end] = [" ".join(line[learn_start:learn_end])]
-                    """
-
-                    if not line:
-                        continue
-
-                    if osra_output_format in osra_smiles_outputs:
-                        line = [x.strip() for x in line.split()]
-                        if custom_page:
-                            line[output_cols["page"]] = custom_page
-                        elif use_gm:
-                            line[output_cols["page"]] = page
-                        mol = MolFromSmiles(line[0], sanitize=False if standardize_mols else True)
-                    elif osra_output_format == "sdf":
-                        line = "\n" + line.strip()
-                        mol = MolFromMolBlock(line, strictParsing=False, sanitize=False if standardize_mols else True,
-                                              removeHs=False if standardize_mols else True)
-
-                    if mol:
-                        compound = compound_template_dict.copy()
-
-                        if standardize_mols:
-                            try:
-                                mol = standardizer.standardize(mol)
-                            except ValueError as e:
-                                self.logger.warning("Cannot standardize '{}': {}".format(MolToSmiles(mol), str(e)))
-
-                        for f in output_formats:
-                            if f == "smiles":
-                                compound["smiles"] = MolToSmiles(mol, isomericSmiles=True)
-                            elif f == "smiles_osra" and osra_output_format == "smi":
-                                compound["smiles_osra"] = line[0]
-                            elif f == "smiles_can_osra" and osra_output_format == "can":
-                                compound["smiles_can_osra"] = line[0]
-                            elif f == "inchi":
-                                inchi = MolToInchi(mol)
-                                if inchi:
-                                    compound["inchi"] = inchi
-                                else:
-                                    compound["inchi"] = ""
-                                    self.logger.warning("Cannot convert to InChI: {}".format(MolToSmiles(mol)))
-                            elif f == "inchikey":
-                                inchi = MolToInchi(mol)
-                                if inchi:
-                                    compound["inchikey"] = InchiToInchiKey(inchi)
-                                else:
-                                    compound["inchikey"] = ""
-                                    self.logger.warning("Cannot create InChI-key from InChI: {}".format(MolToSmiles(mol)))
-                            elif f == "sdf":
-                                compound["sdf"] = MolToMolBlock(mol, includeStereo=True)
-                            elif f == "sdf_osra":
-                                compound["sdf_osra"] = line
-
-                        if is_output_sdf:
-                            writer.write(mol)
-
-                        if osra_output_format in osra_smiles_outputs:
-                            compound.update([(x[0], x[1]) for x in zip(list(output_cols.keys()), line[1:])])
-                        else:
-                            compound["page"] = page if use_gm else custom_page if custom_page else 1
-
-                        compounds.append(compound)
-                    else:
-                        self.logger.warning("Cannot convert to RDKit mol: " + line[0])
+                with open(output_file_sdf, mode="a" if sdf_append else "w", encoding="utf-8") as f:
+                    f.write("".join("{}$$$$\n".format(mol_block) for _, mol_blocks, _, _ in records for mol_block in mol_blocks))
 
             if is_output_sdf_osra:
                 with open(output_file_sdf + "-osra.sdf", mode="w", encoding="utf-8") as f:
@@ -573,70 +1433,16 @@ class OSRA(AbstractLinker):
             to_return["content"] = sorted(compounds, key=lambda x: x["page"])
 
             if annotate:
-                chemspider = ChemSpider(chemspider_token) if chemspider_token else None
-
-                for i, ent in enumerate(to_return["content"]):
-                    self.logger.info("Annotating entity {}/{}...".format(i + 1, len(to_return["content"])))
-                    ent.update(OrderedDict([("pch_cids_by_inchikey", ""), ("chs_cids_by_inchikey", ""),
-                                            ("pch_cids_by_smiles", ""), ("chs_cids_by_smiles", ""),
-                                            ("pch_cids_by_inchi", ""), ("chs_cids_by_inchi", ""),
-                                            ("pch_iupac_name", ""), ("chs_common_name", ""),
-                                            ("pch_synonyms", "")]))
-
-                    results = []
-
-                    # prefer InChI key
-                    if "inchikey" in ent and ent["inchikey"]:
-                        try:
-                            results = get_compounds(ent["inchikey"], "inchikey")
-                            if results:
-                                if len(results) == 1:
-                                    result = results[0]
-                                    synonyms = result.synonyms
-                                    if synonyms:
-                                        ent["pch_synonyms"] = "\"{}\"".format("\",\"".join(synonyms))
-                                    ent["pch_iupac_name"] = result.iupac_name
-                                ent["pch_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.cid) for c in results]))
-                        except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                            pass
-
-                        results = chemspider.search(ent["inchikey"]) if chemspider_token else []
-                        if results:
-                            if len(results) == 1:
-                                result = results[0]
-                                ent["chs_common_name"] = result.common_name
-                            ent["chs_cids_by_inchikey"] = "\"{}\"".format(",".join([str(c.csid) for c in results]))
-                    else:
-                        for search_field, col_pch, col_chs in [("smiles", "pch_cids_by_smiles", "chs_cids_by_smiles"),
-                                                               ("inchi", "pch_cids_by_inchi", "chs_cids_by_inchi")]:
-                            results_pch = []
-                            results_chs = []
-
-                            if search_field == "smiles" and "smiles" in ent and ent["smiles"] and "*" not in ent["smiles"]:
-                                try:
-                                    results_pch = get_compounds(ent["smiles"], "smiles")
-                                except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                    pass
-                                results_chs = chemspider.search(ent["smiles"]) if chemspider_token else []
-                            elif search_field == "inchi" and "inchi" in ent and ent["inchi"]:
-                                try:
-                                    results_pch = get_compounds(ent["inchi"], "inchi")
-                                except (BadRequestError, NotFoundError, PubChemHTTPError, ResponseParseError, ServerError, TimeoutError, PubChemPyError):
-                                    pass
-                                results_chs = chemspider.search(ent["inchi"]) if chemspider_token else []
-
-                            if results_pch:
-                                ent[col_pch] = "\"{}\"".format(",".join([str(c.cid) for c in results_pch]))
-                            if results_chs:
-                                ent[col_chs] = "\"{}\"".format(",".join([str(c.csid) for c in results_chs]))
-
-                            sleep(0.5)
+                annotator = self._get_annotator(chemspider_token, annotation_workers)
+                # InChI keys are resolved in bulk, entities then need requests only for other identifiers
+                annotator.pubchem.prefetch([x["inchikey"] for x in to_return["content"] if x.get("inchikey")])
+                n_distinct = annotator.map_unique(self._annotate_entity, to_return["content"], key=self._annotation_key)
+                self.logger.info("Annotated {} entities ({} distinct) with {} workers.".format(
+                    len(to_return["content"]), n_distinct, annotator.n_workers))
+                annotator.report(self.logger)
 
             if output_file:
                 dict_to_csv(to_return["content"], output_file=output_file, csv_delimiter=csv_delimiter, write_header=write_header)
-
-            if is_output_sdf:
-                writer.close()
         elif not any(to_return["stdout"]) and output_file:
             write_empty_file(output_file, csv_delimiter=csv_delimiter, header=list(compound_template_dict.keys()), write_header=write_header)
 
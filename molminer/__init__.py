@@ -1,5 +1,6 @@
 from .OSRA import OSRA
 from .ChemSpot import ChemSpot
+from .ChemSpotServer import ChemSpotServer
 from .OPSIN import OPSIN
 from .Extractor import Extractor
 
@@ -0,0 +1,805 @@
+from .cache import DiskCache, make_key
+from .conversion import get_converter
+from .pubchem_index import PubChemIndex
+
+import requests
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+import logging
+import os
+import threading
+import time
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+# base URLs can be redirected e.g. to local stand-in server
+PUBCHEM_URL = os.environ.get("MOLMINER_PUBCHEM_URL", "https://pubchem.ncbi.nlm.nih.gov/rest/pug")
+CHEMSPIDER_URL = os.environ.get("MOLMINER_CHEMSPIDER_URL", "https://api.rsc.org/compounds/v1")
+
+# published limits: PubChem PUG REST allows 5 requests per second (and 400 per minute),
+# ChemSpider (RSC Compounds API) 15 requests per second
+PUBCHEM_RATE = 5
+CHEMSPIDER_RATE = 15
+
+# responses meaning the service is throttling or temporarily unavailable
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+# responses meaning the query has no result
+NOT_FOUND_STATUSES = {400, 404}
+
+# token buckets shared by all clients of one service in this process, see get_bucket()
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket rate limiter. Tokens are refilled with `rate` per second up to `capacity` and each
+    request takes one, so at most `capacity` requests are sent in a burst and `rate` per second in the long run.
+    With default `capacity` of 1, requests are evenly spaced and no window of one second contains more than `rate`
+    of them.
+
+    Attributes
+    ----------
+    rate : float
+    capacity : float
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        Parameters
+        ----------
+        rate : float
+            Tokens per second.
+        capacity : float
+            Maximum number of tokens.
+        """
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, tokens: float = 1):
+        """
+        Block until `tokens` are available and take them.
+        """
+
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """
+        Take all tokens so no request is sent by any thread for `seconds`. Used when the service reports throttling.
+        """
+
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
+
+
+def get_bucket(url: str, rate: float) -> TokenBucket:
+    """
+    Return `TokenBucket` of service at `url` shared by all clients in this process, so the rate limit holds also for
+    more wrappers annotating at the same time.
+
+    Parameters
+    ----------
+    url : str
+    rate : float
+        Rate of new bucket.
+
+    Returns
+    -------
+    TokenBucket
+    """
+
+    with _buckets_lock:
+        if url not in _buckets:
+            _buckets[url] = TokenBucket(rate)
+        return _buckets[url]
+
+
+class _Client(object):
+    """
+    Base of rate-limited HTTP clients. Each thread keeps its own `requests.Session`, so connections are kept alive
+    between requests. Requests failing on throttling, server or connection errors are retried with exponential backoff.
+
+    Results of lookups can be stored in `cache` (see `DiskCache`), under key made of `SERVICE`, search field and query.
+    Results with nothing found are stored with `cache_negative_ttl` and failed lookups are not stored.
+    """
+
+    SERVICE = ""
+
+    def __init__(self, url: str, rate: float, max_retries: int = 4, backoff: float = 1.0, timeout: float = 30,
+                 cache: DiskCache = None, cache_ttl: float = 0, cache_negative_ttl: float = 0, verbosity: int = 1):
+        self.url = url.rstrip("/")
+        self.bucket = get_bucket(self.url, rate)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.headers = {}
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        self.cache_negative_ttl = cache_negative_ttl
+        self.n_requests = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(verbosity_levels[verbosity])
+
+    def cache_get_many(self, field: str, queries: list) -> dict:
+        """
+        Returns
+        -------
+        dict
+            Query -> cached result of queries found in `cache`.
+        """
+
+        if self.cache is None or not queries:
+            return {}
+        keys = OrderedDict((make_key(self.SERVICE, field, x), x) for x in queries)
+        return {keys[k]: v for k, v in self.cache.get_many(list(keys)).items()}
+
+    def cache_get(self, field: str, query):
+        return self.cache_get_many(field, [query]).get(query)
+
+    def cache_set_many(self, field: str, results: dict):
+        """
+        Store results (query -> JSON-serializable result) of lookups in `field`. Empty results expire after
+        `cache_negative_ttl`, the others after `cache_ttl`.
+        """
+
+        if self.cache is None:
+            return
+        found = {make_key(self.SERVICE, field, k): v for k, v in results.items() if v}
+        not_found = {make_key(self.SERVICE, field, k): v for k, v in results.items() if not v}
+        self.cache.set_many(found, ttl=self.cache_ttl)
+        self.cache.set_many(not_found, ttl=self.cache_negative_ttl)
+
+    def cache_set(self, field: str, query, result):
+        self.cache_set_many(field, {query: result})
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(self.headers)
+        return self._local.session
+
+    def request(self, method: str, path: str, **kwargs):
+        """
+        Send request to `path` relative to `url`.
+
+        Returns
+        -------
+        requests.Response
+            None if the request failed even after retries.
+        """
+
+        url = "{}/{}".format(self.url, path)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            with self._lock:
+                self.n_requests += 1
+            try:
+                response = self._session().request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                error = str(e)
+                delay = self.backoff * 2 ** attempt
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                error = "HTTP {}".format(response.status_code)
+                delay = self.backoff * 2 ** attempt
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                if response.status_code in THROTTLE_STATUSES:
+                    self.bucket.pause(delay)
+
+            if attempt < self.max_retries:
+                self.logger.info("Request {} {} failed ({}), retrying in {:.1f} s.".format(method, url, error, delay))
+                time.sleep(delay)
+
+        self.logger.warning("Request {} {} failed ({}) after {} retries.".format(method, url, error, self.max_retries))
+        return None
+
+    def get_json(self, method: str, path: str, not_found=None, not_found_statuses=NOT_FOUND_STATUSES, **kwargs):
+        """
+        Parameters
+        ----------
+        not_found
+            Returned if the service responds that the query has no result.
+        not_found_statuses : set
+            Response statuses meaning that the query has no result.
+
+        Returns
+        -------
+        dict or list
+            Parsed JSON response, None on error.
+        """
+
+        response = self.request(method, path, **kwargs)
+        if response is not None and response.status_code in not_found_statuses:
+            return not_found
+        if response is None or not response.ok:
+            return None
+        try:
+            return response.json()
+        except ValueError:
+            self.logger.warning("Cannot parse response of {} {}.".format(method, response.url))
+            return None
+
+
+class PubChemCompound(object):
+    """
+    Compound found in PubChem. Synonyms are requested on first access.
+    """
+
+    def __init__(self, client: "PubChemClient", properties: dict):
+        self._client = client
+        self.properties = properties
+        self.cid = properties.get("CID")
+        self.iupac_name = properties.get("IUPACName", "")
+        # PubChem returns requested CanonicalSMILES as ConnectivitySMILES in newer versions
+        self.canonical_smiles = properties.get("CanonicalSMILES", properties.get("ConnectivitySMILES", ""))
+        self.inchi = properties.get("InChI", "")
+        self.inchikey = properties.get("InChIKey", "")
+        self._synonyms = None
+
+    @property
+    def synonyms(self) -> list:
+        if self._synonyms is None:
+            self._synonyms = self._client.synonyms(self.cid)
+        return self._synonyms
+
+
+class PubChemClient(_Client):
+    """
+    Client of PubChem PUG REST API (https://pubchem.ncbi.nlm.nih.gov/docs/pug-rest).
+
+    Compounds of many InChI keys can be fetched in bulk with `prefetch`, then `get_compounds` answers them without
+    further requests.
+    """
+
+    SERVICE = "pubchem"
+
+    PROPERTIES = "IUPACName,CanonicalSMILES,InChI,InChIKey"
+    NAMESPACES = ["name", "smiles", "inchi", "inchikey", "formula"]
+    # maximum number of identifiers in one batch request
+    BATCH_SIZE = 100
+
+    def __init__(self, url: str = PUBCHEM_URL, rate: float = PUBCHEM_RATE, **kwargs):
+        super().__init__(url, rate, **kwargs)
+        self._prefetched = {}
+        self._prefetched_lock = threading.Lock()
+
+    def get_compounds(self, identifier: str, namespace: str) -> list:
+        """
+        Search compounds, same as `pubchempy.get_compounds`.
+
+        Parameters
+        ----------
+        identifier : str
+        namespace : str
+            One of "name", "smiles", "inchi", "inchikey", "formula".
+
+        Returns
+        -------
+        list of PubChemCompound
+        """
+
+        if namespace not in self.NAMESPACES:
+            raise ValueError("Unknown namespace. Possible values: {}".format(self.NAMESPACES))
+
+        if namespace == "inchikey":
+            with self._prefetched_lock:
+                if identifier in self._prefetched:
+                    return self._prefetched[identifier]
+
+        properties = self.cache_get(namespace, identifier)
+        if properties is None:
+            if namespace == "formula":
+                # synchronous variant of formula search
+                data = self.get_json("GET", "compound/fastformula/{}/property/{}/JSON".format(
+                    quote(identifier, safe=""), self.PROPERTIES), not_found={})
+            else:
+                # identifiers can contain "/" and other characters not allowed in URL path
+                data = self.get_json("POST", "compound/{}/property/{}/JSON".format(namespace, self.PROPERTIES),
+                                     data={namespace: identifier}, not_found={})
+            if data is None:
+                return []
+            properties = [p for p in data.get("PropertyTable", {}).get("Properties", []) if p.get("CID")]
+            self.cache_set(namespace, identifier, properties)
+
+        return [PubChemCompound(self, p) for p in properties]
+
+    def _post_list(self, operation: str, namespace: str, identifiers: list):
+        """
+        POST comma-separated `identifiers` to "compound/`namespace`/`operation`/JSON".
+
+        Returns
+        -------
+        dict
+            Parsed JSON response, empty dict if none of `identifiers` was found and None on error. Bad request (400) is
+            an error, as one malformed identifier fails the whole batch, so its identifiers are left to single requests.
+        """
+
+        return self.get_json("POST", "compound/{}/{}/JSON".format(namespace, operation),
+                             data={namespace: ",".join(str(x) for x in identifiers)}, not_found={},
+                             not_found_statuses={404})
+
+    def get_compounds_batch(self, identifiers: list, namespace: str = "inchikey") -> dict:
+        """
+        Fetch properties of compounds for many InChI keys or CIDs, with one request per `BATCH_SIZE` identifiers.
+
+        Parameters
+        ----------
+        identifiers : list
+        namespace : str
+            "inchikey" or "cid".
+
+        Returns
+        -------
+        dict
+            Identifier -> list of PubChemCompound (empty if not found). Identifiers of failed batches are missing.
+        """
+
+        if namespace not in ["inchikey", "cid"]:
+            raise ValueError("Unknown namespace. Possible values: ['inchikey', 'cid']")
+
+        identifiers = list(OrderedDict.fromkeys(identifiers))
+        found = self.cache_get_many(namespace, identifiers)
+        missing = [x for x in identifiers if x not in found]
+        for i in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[i:i + self.BATCH_SIZE]
+            data = self._post_list("property/{}".format(self.PROPERTIES), namespace, batch)
+            if data is None:
+                self.logger.info("Batch request of {} {}s failed.".format(len(batch), namespace))
+                continue
+            batch_results = OrderedDict((x, []) for x in batch)
+            for p in data.get("PropertyTable", {}).get("Properties", []):
+                # results are distributed back by returned identifier, one InChI key can match more compounds
+                key = p.get("InChIKey") if namespace == "inchikey" else p.get("CID")
+                if p.get("CID") and key in batch_results:
+                    batch_results[key].append(p)
+            self.cache_set_many(namespace, batch_results)
+            found.update(batch_results)
+        return {k: [PubChemCompound(self, p) for p in v] for k, v in found.items()}
+
+    def synonyms_batch(self, cids: list) -> dict:
+        """
+        Fetch synonyms of many CIDs, with one request per `BATCH_SIZE` CIDs.
+
+        Returns
+        -------
+        dict
+            CID -> list of synonyms. CIDs of failed batches are missing.
+        """
+
+        cids = list(OrderedDict.fromkeys(cids))
+        results = self.cache_get_many("synonyms", cids)
+        missing = [x for x in cids if x not in results]
+        for i in range(0, len(missing), self.BATCH_SIZE):
+            batch = missing[i:i + self.BATCH_SIZE]
+            data = self._post_list("synonyms", "cid", batch)
+            if data is None:
+                continue
+            batch_results = OrderedDict((x, []) for x in batch)
+            for info in data.get("InformationList", {}).get("Information", []):
+                if info.get("CID") in batch_results:
+                    batch_results[info["CID"]] = info.get("Synonym", [])
+            self.cache_set_many("synonyms", batch_results)
+            results.update(batch_results)
+        return results
+
+    def prefetch(self, inchikeys: list, synonyms: bool = True) -> int:
+        """
+        Fetch compounds of `inchikeys` (and their synonyms) in bulk, so `get_compounds` of these InChI keys doesn't
+        send any request. InChI keys of failed batches are left to `get_compounds`.
+
+        Parameters
+        ----------
+        inchikeys : list
+        synonyms : bool
+            If True, also fetch synonyms of compounds matching single InChI key (only these are used in annotation).
+
+        Returns
+        -------
+        int
+            Number of requests sent (with retries).
+        """
+
+        with self._prefetched_lock:
+            inchikeys = [x for x in OrderedDict.fromkeys(inchikeys) if x and x not in self._prefetched]
+        if not inchikeys:
+            return 0
+
+        n_requests = self.n_requests
+        found = self.get_compounds_batch(inchikeys, "inchikey")
+
+        if synonyms:
+            single = [x[0] for x in found.values() if len(x) == 1]
+            if single:
+                synonyms_of = self.synonyms_batch([x.cid for x in single])
+                for compound in single:
+                    if compound.cid in synonyms_of:
+                        compound._synonyms = synonyms_of[compound.cid]
+
+        with self._prefetched_lock:
+            self._prefetched.update(found)
+        n_requests = self.n_requests - n_requests
+        self.logger.info("Prefetched PubChem compounds of {} InChI keys ({} found) with {} requests.".format(
+            len(inchikeys), sum(1 for x in found.values() if x), n_requests))
+        return n_requests
+
+    def synonyms(self, cid) -> list:
+        synonyms = self.cache_get("synonyms", cid)
+        if synonyms is None:
+            data = self.get_json("GET", "compound/cid/{}/synonyms/JSON".format(cid), not_found={})
+            if data is None:
+                return []
+            info = data.get("InformationList", {}).get("Information", [])
+            synonyms = info[0].get("Synonym", []) if info else []
+            self.cache_set("synonyms", cid, synonyms)
+        return synonyms
+
+
+class OfflinePubChemClient(object):
+    """
+    Drop-in replacement of `PubChemClient` answering searches from local `PubChemIndex`, without network requests.
+    """
+
+    def __init__(self, index_path: str, verbosity: int = 1):
+        self.index = PubChemIndex(index_path)
+        self.n_lookups = 0
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger(type(self).__name__)
+        self.logger.setLevel(verbosity_levels[verbosity])
+
+    def get_compounds(self, identifier: str, namespace: str) -> list:
+        """
+        Search compounds, see `PubChemClient.get_compounds`.
+
+        Returns
+        -------
+        list of PubChemCompound
+        """
+
+        with self._lock:
+            self.n_lookups += 1
+        return [PubChemCompound(self, p) for p in self.index.search(identifier, namespace)]
+
+    def prefetch(self, inchikeys: list, synonyms: bool = True) -> int:
+        # lookups in index are cheap, nothing to prefetch
+        return 0
+
+    def synonyms(self, cid) -> list:
+        with self._lock:
+            self.n_lookups += 1
+        return self.index.synonyms(cid)
+
+
+class ChemSpiderCompound(object):
+    """
+    Compound found in ChemSpider. Details are requested on first access, InChI and InChI key are computed from its MOL
+    block by RDKit instead of conversion requests.
+    """
+
+    def __init__(self, client: "ChemSpiderClient", csid: int):
+        self._client = client
+        self.csid = csid
+        self._details = None
+        self._molecule = None
+
+    @property
+    def details(self) -> dict:
+        if self._details is None:
+            self._details = self._client.details(self.csid)
+        return self._details
+
+    @property
+    def common_name(self) -> str:
+        return self.details.get("commonName", "")
+
+    @property
+    def smiles(self) -> str:
+        return self.details.get("smiles", "")
+
+    def _get_molecule(self):
+        if self._molecule is None and self.details.get("mol2D"):
+            self._molecule, _ = get_converter(standardize=False).convert(self.details["mol2D"], "molblock")
+        return self._molecule
+
+    @property
+    def stdinchi(self) -> str:
+        molecule = self._get_molecule()
+        return molecule.inchi if molecule else ""
+
+    @property
+    def stdinchikey(self) -> str:
+        molecule = self._get_molecule()
+        return molecule.inchikey if molecule else ""
+
+
+class ChemSpiderClient(_Client):
+    """
+    Client of ChemSpider (RSC Compounds API, https://developer.rsc.org/compounds-v1/apis).
+    """
+
+    SERVICE = "chemspider"
+    FAILED_STATUSES = {"Failed", "Unknown", "Suspended"}
+
+    def __init__(self, token: str, url: str = CHEMSPIDER_URL, rate: float = CHEMSPIDER_RATE, poll_interval: float = 0.2,
+                 max_polls: int = 50, **kwargs):
+        """
+        Parameters
+        ----------
+        token : str
+            ChemSpider API key.
+        poll_interval : float
+            Initial interval between checks of query status, it's doubled up to 2 seconds.
+        max_polls : int
+            Maximum number of checks of query status.
+        """
+
+        super().__init__(url, rate, **kwargs)
+        self.headers = {"apikey": token}
+        self.poll_interval = poll_interval
+        self.max_polls = max_polls
+
+    def search(self, query: str) -> list:
+        """
+        Search compounds, same as `chemspipy.ChemSpider.search`.
+
+        Returns
+        -------
+        list of ChemSpiderCompound
+        """
+
+        csids = self.cache_get("name", query)
+        if csids is None:
+            csids = self._search(query)
+            if csids is None:
+                return []
+            self.cache_set("name", query, csids)
+        return [ChemSpiderCompound(self, csid) for csid in csids]
+
+    def _search(self, query: str) -> list:
+        """
+        Returns
+        -------
+        list
+            CSIDs, None on error.
+        """
+
+        data = self.get_json("POST", "filter/name", json={"name": query}, not_found={})
+        if data is None:
+            return None
+        if "queryId" not in data:
+            return []
+        query_id = data["queryId"]
+
+        interval = self.poll_interval
+        for _ in range(self.max_polls):
+            status = self.get_json("GET", "filter/{}/status".format(query_id))
+            if not status or status.get("status") in self.FAILED_STATUSES:
+                return None
+            if status.get("status") == "Not Found":
+                return []
+            if status.get("status") == "Complete":
+                break
+            time.sleep(interval)
+            interval = min(2.0, interval * 2)
+        else:
+            self.logger.warning("ChemSpider query '{}' didn't complete.".format(query))
+            return None
+
+        results = self.get_json("GET", "filter/{}/results".format(query_id))
+        if results is None:
+            return None
+        return results.get("results", [])
+
+    def details(self, csid: int) -> dict:
+        details = self.cache_get("details", csid)
+        if details is None:
+            details = self.get_json("GET", "records/{}/details".format(csid), params={"fields": "SMILES,CommonName,Mol2D"},
+                                    not_found={})
+            if details is None:
+                return {}
+            self.cache_set("details", csid, details)
+        return details
+
+
+class Annotator(object):
+    """
+    Annotates entities concurrently in PubChem and ChemSpider. Requests of all workers to one service are limited by
+    shared `TokenBucket`. Lookups can be cached in SQLite database shared by processes and runs.
+
+    With "offline" `backend`, PubChem is searched in local `PubChemIndex` and ChemSpider isn't searched.
+
+    **Usage:** ::
+
+        annotator = Annotator(chemspider_token="...")
+        annotator.pubchem.prefetch([x["inchikey"] for x in entities])
+        annotator.map(annotate_entity, entities)  # annotate_entity(entity, annotator)
+        # or once per distinct entity
+        annotator.map_unique(annotate_entity, entities, key=lambda x: x["inchikey"])
+
+    Attributes
+    ----------
+    pubchem : PubChemClient or OfflinePubChemClient
+    chemspider : ChemSpiderClient
+        None if `chemspider_token` is empty or `backend` is "offline".
+    n_workers : int
+    cache : DiskCache
+        Cache of lookups or None.
+    """
+
+    BACKENDS = ["online", "offline"]
+
+    def __init__(self,
+                 chemspider_token: str = "",
+                 n_workers: int = 8,
+                 backend: str = "online",
+                 index_path: str = "",
+                 pubchem_url: str = PUBCHEM_URL,
+                 chemspider_url: str = CHEMSPIDER_URL,
+                 pubchem_rate: float = PUBCHEM_RATE,
+                 chemspider_rate: float = CHEMSPIDER_RATE,
+                 max_retries: int = 4,
+                 backoff: float = 1.0,
+                 timeout: float = 30,
+                 cache_path: str = "",
+                 cache_ttl: float = 30,
+                 cache_negative_ttl: float = 7,
+                 verbosity: int = 1):
+        """
+        Parameters
+        ----------
+        chemspider_token : str
+            Your personal token for accessing the ChemSpider API. If empty, ChemSpider isn't searched.
+        n_workers : int
+            Number of threads annotating entities.
+        backend : str
+            "online" to search PubChem and ChemSpider APIs, "offline" to search PubChem in index at `index_path` (see
+            `pubchem_index.build_pubchem_index`).
+        index_path : str
+            Path to PubChem index for "offline" `backend`.
+        pubchem_url : str
+        chemspider_url : str
+            Base URLs of APIs.
+        pubchem_rate : float
+        chemspider_rate : float
+            Maximum requests per second.
+        max_retries : int
+            How many times to retry request failed on throttling, server or connection error.
+        backoff : float
+            Delay [seconds] before first retry, it's doubled with each next one.
+        timeout : float
+            Timeout [seconds] of one request.
+        cache_path : str
+            Path to SQLite database with cached lookups (compound IDs, names and synonyms). If empty, nothing is cached.
+        cache_ttl : float
+            Days after which cached lookup expires. If 0, it doesn't expire.
+        cache_negative_ttl : float
+            Days after which cached lookup with nothing found expires. If 0, it doesn't expire.
+        verbosity : int
+        """
+
+        if backend not in self.BACKENDS:
+            raise ValueError("Unknown annotation backend. Possible values: {}".format(self.BACKENDS))
+        self.n_workers = max(1, n_workers)
+
+        if backend == "offline":
+            if not index_path:
+                raise ValueError("Path to PubChem index is needed for offline annotation.")
+            self.cache = None
+            self.pubchem = OfflinePubChemClient(index_path, verbosity=verbosity)
+            self.chemspider = None
+            return
+
+        self.cache = DiskCache(cache_path, max_entries=0, verbosity=verbosity) if cache_path else None
+        kwargs = {"max_retries": max_retries, "backoff": backoff, "timeout": timeout, "verbosity": verbosity,
+                  "cache": self.cache, "cache_ttl": cache_ttl * 86400, "cache_negative_ttl": cache_negative_ttl * 86400}
+        self.pubchem = PubChemClient(url=pubchem_url, rate=pubchem_rate, **kwargs)
+        self.chemspider = ChemSpiderClient(chemspider_token, url=chemspider_url, rate=chemspider_rate, **kwargs) \
+            if chemspider_token else None
+
+    def search_chemspider(self, query: str) -> list:
+        """
+        Returns
+        -------
+        list of ChemSpiderCompound
+            Empty if ChemSpider token isn't set.
+        """
+
+        return self.chemspider.search(query) if self.chemspider else []
+
+    def report(self, logger: logging.Logger):
+        """
+        Log number of requests sent and hits of `cache`.
+
+        Parameters
+        ----------
+        logger : logging.Logger
+        """
+
+        if isinstance(self.pubchem, OfflinePubChemClient):
+            logger.info("Annotation: {} lookups in PubChem index.".format(self.pubchem.n_lookups))
+            return
+
+        message = "Annotation: {} requests to PubChem".format(self.pubchem.n_requests)
+        if self.chemspider:
+            message += ", {} to ChemSpider".format(self.chemspider.n_requests)
+        if self.cache:
+            message += ", {hits} lookups found in cache, {misses} not".format(**self.cache.stats)
+        logger.info(message + ".")
+
+    def map(self, func, items: list) -> list:
+        """
+        Call `func(item, self)` for each of `items` in `n_workers` threads.
+
+        Returns
+        -------
+        list
+            Return values in order of `items`.
+        """
+
+        if self.n_workers == 1 or len(items) < 2:
+            return [func(item, self) for item in items]
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            return list(executor.map(lambda item: func(item, self), items))
+
+    def map_unique(self, func, items: list, key) -> int:
+        """
+        Annotate each distinct item once: items are grouped by `key(item)`, `func(item, self)` is called (see `map`) for
+        the first item of each group and fields it changed or added are copied to the other items of the group.
+
+        Parameters
+        ----------
+        func : callable
+            Function updating item (dict) in place.
+        items : list of dicts
+        key : callable
+            Return hashable identity of item. Items with the same key must be annotated the same way by `func`.
+
+        Returns
+        -------
+        int
+            Number of distinct items.
+        """
+
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(key(item), []).append(item)
+
+        representatives = [x[0] for x in groups.values()]
+        before = [dict(x) for x in representatives]
+        self.map(func, representatives)
+
+        for group, old in zip(groups.values(), before):
+            changed = OrderedDict((k, v) for k, v in group[0].items() if k not in old or old[k] != v)
+            for item in group[1:]:
+                item.update(changed)
+        return len(groups)
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+
+def make_key(*parts) -> str:
+    """
+    Make cache key from JSON-serializable parts.
+
+    Returns
+    -------
+    str
+        SHA-1 hex digest of JSON-serialized `parts`.
+    """
+
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class DiskCache(object):
+    """
+    Persistent key-value cache stored in SQLite database. Values must be JSON-serializable.
+
+    Cache can be shared by threads and processes. The number of entries is bounded by `max_entries`: when it's exceeded,
+    least recently used entries are evicted. Entries can be also stored with time to live, expired ones are not returned
+    and are removed on next write.
+
+    **Usage:** ::
+
+        cache = DiskCache("opsin.sqlite", max_entries=100000)
+        cache.set_many({make_key("benzene"): {"smiles": "c1ccccc1"}})
+        cache.get_many([make_key("benzene")])  # {"<key>": {"smiles": "c1ccccc1"}}
+        cache.set(make_key("foo"), [], ttl=3600)  # expires in one hour
+
+    Attributes
+    ----------
+    stats : dict
+        "hits", "misses" and "evictions" of this instance.
+    """
+
+    logger = logging.getLogger("cache")
+
+    def __init__(self,
+                 path: str,
+                 max_entries: int = 100000,
+                 verbosity: int = 1):
+        """
+        Parameters
+        ----------
+        path : str
+            Path to SQLite database. It's created if doesn't exist.
+        max_entries : int
+            Maximum number of entries. If 0, the size is not bounded.
+        verbosity : int
+            This class's verbosity. Values: 0, 1, 2
+        """
+
+        if verbosity > 2:
+            verbosity = 2
+        elif verbosity not in verbosity_levels:
+            verbosity = 1
+        self.logger.setLevel(verbosity_levels[verbosity])
+
+        self.path = os.path.abspath(path)
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._connect()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_connection"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connect().execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def _connect(self) -> sqlite3.Connection:
+        # connection can't be shared with forked or unpickled copy
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS cache "
+                                     "(key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed REAL NOT NULL, "
+                                     "expires REAL NOT NULL DEFAULT 0)")
+            # database created before entries could expire
+            columns = [x[1] for x in self._connection.execute("PRAGMA table_info(cache)")]
+            if "expires" not in columns:
+                try:
+                    self._connection.execute("ALTER TABLE cache ADD COLUMN expires REAL NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    # added meanwhile by other process
+                    pass
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, key: str, default=None):
+        """
+        Parameters
+        ----------
+        key : str
+        default
+            Returned when `key` is not in cache.
+        """
+
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys: list) -> dict:
+        """
+        Parameters
+        ----------
+        keys : list
+
+        Returns
+        -------
+        dict
+            Key -> value of keys found in cache.
+        """
+
+        keys = list(set(keys))
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            connection = self._connect()
+            # SQLite limits number of host parameters
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = connection.execute("SELECT key, value FROM cache WHERE key IN ({}) AND (expires = 0 OR expires > ?)"
+                                          .format(",".join("?" * len(batch))), batch + [now]).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+
+            if found:
+                connection.executemany("UPDATE cache SET accessed = ? WHERE key = ?", [(now, x) for x in found])
+
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    def set(self, key: str, value, ttl: float = 0):
+        self.set_many({key: value}, ttl=ttl)
+
+    def set_many(self, items: dict, ttl: float = 0):
+        """
+        Store items, remove expired entries and evict least recently used entries if the cache is full.
+
+        Parameters
+        ----------
+        items : dict
+            Key -> value.
+        ttl : float
+            Time to live [seconds] of items. If 0, items don't expire.
+        """
+
+        if not items:
+            return
+
+        now = time.time()
+        expires = now + ttl if ttl > 0 else 0
+        with self._lock:
+            connection = self._connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.executemany("INSERT OR REPLACE INTO cache (key, value, accessed, expires) VALUES (?, ?, ?, ?)",
+                                       [(k, json.dumps(v, ensure_ascii=False), now, expires) for k, v in items.items()])
+                connection.execute("DELETE FROM cache WHERE expires > 0 AND expires <= ?", (now,))
+                if self.max_entries:
+                    n_evict = connection.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_entries
+                    if n_evict > 0:
+                        connection.execute("DELETE FROM cache WHERE key IN "
+                                           "(SELECT key FROM cache ORDER BY accessed LIMIT ?)", (n_evict,))
+                        self.stats["evictions"] += n_evict
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+
+        with self._lock:
+            self._connect().execute("DELETE FROM cache")
+
+    def report(self, name: str = "cache"):
+        """
+        Log the summary of `stats`.
+
+        Parameters
+        ----------
+        name : str
+            Name of cache in log message.
+        """
+
+        self.logger.info("{}: {hits} hits, {misses} misses, {evictions} evictions.".format(name, **self.stats))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
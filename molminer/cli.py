@@ -1,5 +1,8 @@
-from . import __version__, ChemSpot, OSRA, OPSIN, Extractor
-from .utils import dict_to_csv, eprint
+from . import __version__, ChemSpot, ChemSpotServer, OSRA, OPSIN, Extractor
+from .scheduler import MemoryScheduler
+from .conversion import report_stats
+from .pubchem_index import build_pubchem_index
+from .utils import dict_to_csv, iter_to_csv, eprint
 
 import click
 
@@ -26,6 +29,9 @@ OPTS_COMMON_ALL = [
                  help="Don't write CSV header."),
     click.option("--no-standardize", show_default=True, default=False, is_flag=True,
                  help="Don't standardize molecules using MolVS (https://github.com/mcs07/MolVS)."),
+    click.option("--std-cache", type=click.STRING, default="", show_default=True,
+                 help="Path to SQLite database with cached standardized molecules. It can be shared by all commands, "
+                      "molecules found there are not standardized again."),
     click.option("-v", "--verbosity", show_default=True, default=1, type=click.IntRange(min=0, max=2, clamp=True),
                  help="0, 1 or 2")
 ]
@@ -50,8 +56,16 @@ OPTS_COMMON_NER_EXTRACT = [
                       "Multiple languages can be specified with '+' character, e.g. 'eng+bul+fra'."),
     click.option("--tessdata-path", type=click.STRING, show_default=True, default="",
                  help="Path to Tesseract language data, if not set in TESSDATA_PREFIX environment variable."),
-    click.option("--annotation-sleep", type=click.INT, default=2, show_default=True,
-                 help="How many seconds to sleep between annotation of each entity. It's for preventing overloading of databases.")
+    click.option("--annotation-sleep", type=click.FLOAT, default=0, show_default=True,
+                 help="How many seconds each annotation worker sleeps after annotation of entity. Requests are already "
+                      "rate-limited to published limits of PubChem and ChemSpider.")
+]
+
+OPTS_COMMON_NER_CONVERT_EXTRACT = [
+    click.option("--memory-budget", type=click.FLOAT, default=0, show_default=True,
+                 help="Total memory [GB] for Java processes (ChemSpot, OPSIN) on this host. If greater than 0, heap sizes "
+                      "are estimated from input size and launches are queued so the sum of heaps stays under budget, also "
+                      "across other MolMiner processes running on this host.")
 ]
 
 OPTS_COMMON_OCSR_CONVERT_EXTRACT = [
@@ -67,7 +81,20 @@ OPTS_COMMON_OCSR_EXTRACT = [
                       "when converting directly from PDF (namely: coordinates, bond length and possibly more ones) and also there are sometimes "
                       "incorrectly recognised structures."),
     click.option("-j", "--jobs", show_default=True, default=-1, type=click.INT,
-                 help="How many jobs to use for processing. '-1' to use all CPU cores. '-2' to use all CPU cores minus one.")
+                 help="How many jobs to use for processing. '-1' to use all CPU cores. '-2' to use all CPU cores minus one."),
+    click.option("--osra-figures-only", show_default=True, is_flag=True, default=False,
+                 help="Process with OSRA only regions of PDF pages with embedded images (found by pdftohtml) and vector "
+                      "drawings looking like 2D structures instead of whole pages. Coordinates are mapped back to page."),
+    click.option("--osra-prefilter", show_default=True, is_flag=True, default=False,
+                 help="Cheaply check each page image for drawings looking like 2D structures and don't run OSRA on pages "
+                      "without them. Skipped pages are reported with '-v 2'."),
+    click.option("--osra-prefilter-threshold", show_default=True, default=1, type=click.IntRange(min=1),
+                 help="Minimal number of structure-like drawings on page processed by OSRA when '--osra-prefilter' is set."),
+    click.option("--timeout", show_default=True, default=0, type=click.FLOAT,
+                 help="Wall-clock timeout in seconds for processing of one page by OSRA (or Tesseract). Processes exceeding "
+                      "it are killed and the page is skipped. '0' for no timeout."),
+    click.option("--cpu-time", show_default=True, default=0, type=click.IntRange(min=0),
+                 help="CPU time limit in seconds for processing of one page by OSRA (or Tesseract). '0' for no limit.")
 ]
 
 OPTS_COMMON_OCSR_CONVERT = [
@@ -79,7 +106,21 @@ OPTS_COMMON_OCSR_NER_EXTRACT = [
     click.option("--chemspider-token", type=click.STRING, default="", show_default=True,
                  help="Your personal token for accessing the ChemSpider API (needed for annotation). Make account there to obtain it."),
     click.option("--no-annotation", show_default=True, is_flag=True, default=False,
-                 help="Don't do annotation of entities in PubChem and ChemSpider.")
+                 help="Don't do annotation of entities in PubChem and ChemSpider."),
+    click.option("--annotation-workers", type=click.IntRange(min=1), default=8, show_default=True,
+                 help="Number of entities annotated concurrently."),
+    click.option("--annotation-cache", type=click.STRING, default="", show_default=True,
+                 help="Path to SQLite database with cached PubChem and ChemSpider lookups. It can be shared by all "
+                      "commands and processes, lookups found there are not sent again."),
+    click.option("--annotation-cache-ttl", type=click.FLOAT, default=30, show_default=True,
+                 help="Days after which cached lookup expires. '0' for no expiration."),
+    click.option("--annotation-cache-negative-ttl", type=click.FLOAT, default=7, show_default=True,
+                 help="Days after which cached lookup with nothing found expires. '0' for no expiration."),
+    click.option("--annotation-backend", type=click.Choice(["online", "offline"]), default="online", show_default=True,
+                 help="'online' to annotate in PubChem and ChemSpider APIs, 'offline' to annotate in local PubChem index "
+                      "(see '--pubchem-index'). ChemSpider isn't searched offline."),
+    click.option("--pubchem-index", type=click.STRING, default="", show_default=True,
+                 help="Path to PubChem index built by 'molminer pubchem-index', used with '--annotation-backend offline'.")
 ]
 
 OPTS_CONVERT_INIT = [
@@ -95,13 +136,28 @@ OPTS_CONVERT_INIT = [
     click.option("--opsin-no-allow-uninterpretable-stereo", show_default=True, is_flag=True, default=False,
                  help="Don't allow stereochemistry uninterpretable by OPSIN to be ignored."),
     click.option("--opsin-wildcard-radicals", show_default=True, is_flag=True, default=False,
-                 help="Radicals are output as wildcard atoms.")
+                 help="Radicals are output as wildcard atoms."),
+    click.option("--opsin-persistent", show_default=True, is_flag=True, default=False,
+                 help="Keep one OPSIN process alive and stream names to it instead of starting new Java VM for each batch."),
+    click.option("--opsin-cache", type=click.STRING, default="", show_default=True,
+                 help="Path to SQLite database with cached OPSIN conversions. Only names not found in cache are converted by OPSIN."),
+    click.option("--opsin-cache-size", type=click.INT, default=100000, show_default=True,
+                 help="Maximum number of names in OPSIN cache. Least recently used ones are evicted. If 0, size is not bounded.")
 ]
 
 OPTS_CONVERT_PROCESS = [
     # PROCESS
     click.option("--no-normalize-plurals", show_default=True, is_flag=True, default=False,
-                 help="Don't normalize some plurals before converting to linear notation, e.g. 'nitrates' -> 'nitrate'.")
+                 help="Don't normalize some plurals before converting to linear notation, e.g. 'nitrates' -> 'nitrate'."),
+    click.option("-j", "--jobs", show_default=True, default=1, type=click.INT,
+                 help="How many OPSIN processes and post-processing workers to use for large inputs. '-1' to use all CPU cores."),
+    click.option("--chunk-size", show_default=True, default=10000, type=click.INT,
+                 help="Number of names converted by one worker at once when '--jobs' is not 1."),
+    click.option("--stream", show_default=True, is_flag=True, default=False,
+                 help="Read names lazily from input file or stdin, convert them in batches with one persistent OPSIN "
+                      "process and write CSV rows as each batch is done. Memory usage doesn't depend on input size."),
+    click.option("--batch-size", show_default=True, default=1000, type=click.INT,
+                 help="Number of names converted at once with '--stream'.")
 ]
 
 KWARGS_OPSIN_INIT = {
@@ -111,6 +167,10 @@ KWARGS_OPSIN_INIT = {
     "opsin_no_allow_radicals": "allow_radicals",
     "opsin_no_allow_uninterpretable_stereo": "allow_uninterpretable_stereo",
     "opsin_wildcard_radicals": "wildcard_radicals",
+    "opsin_persistent": "persistent",
+    "opsin_cache": "cache_path",
+    "opsin_cache_size": "cache_max_entries",
+    "std_cache": "standardization_cache_path",
     "verbosity": "verbosity"
 }
 
@@ -123,7 +183,9 @@ KWARGS_OPSIN_PROCESS = {
     "dry_run": "dry_run",
     "delimiter": "csv_delimiter",
     "no_standardize": "standardize_mols",
-    "no_normalize_plurals": "normalize_plurals"
+    "no_normalize_plurals": "normalize_plurals",
+    "jobs": "n_jobs",
+    "chunk_size": "chunk_size"
 }
 
 OPTS_NER_INIT = [
@@ -143,7 +205,24 @@ OPTS_NER_INIT = [
     click.option("--chs-iob", show_default=True, is_flag=True, default=False,
                  help="If this flag is set, the output will be converted into the IOB format."),
     click.option("--chs-memory", type=click.INT, default=8, show_default=True,
-                 help="Maximum amount of memory [GB] which can be allocated for ChemSpot.")
+                 help="Maximum amount of memory [GB] which can be allocated for ChemSpot."),
+    click.option("--chs-threads", type=click.STRING, default="0", show_default=True,
+                 help="Number of threads used by ChemSpot. If 0, ChemSpot's default is used. If 'auto', use all CPUs."),
+    click.option("--chs-server", type=click.STRING, default="", show_default=True,
+                 help="Path to UNIX socket of running ChemSpot server (see 'molminer ner-server'). Texts will be tagged by "
+                      "this server instead of starting new ChemSpot process."),
+    click.option("--chs-chunk-size", type=click.INT, default=0, show_default=True,
+                 help="If greater than 0, split longer texts at page or sentence boundaries into windows of about this number "
+                      "of characters and tag them concurrently. Use it for very large texts which don't fit to ChemSpot memory."),
+    click.option("--chs-chunk-overlap", type=click.INT, default=500, show_default=True,
+                 help="Number of characters shared by neighbouring windows. Entities found twice are deduplicated."),
+    click.option("--chs-chunk-jobs", type=click.INT, default=2, show_default=True,
+                 help="Maximum number of ChemSpot processes tagging the windows concurrently."),
+    click.option("--chs-chunk-memory", type=click.INT, default=0, show_default=True,
+                 help="Maximum amount of memory [GB] for each ChemSpot process tagging one window. If 0, '--chs-memory' is used."),
+    click.option("--chs-opsin-cache", type=click.STRING, default="", show_default=True,
+                 help="Path to SQLite database with cached OPSIN conversions of entities. Only entities not found in cache "
+                      "are converted by OPSIN.")
 ]
 
 OPTS_NER_PROCESS = [
@@ -166,6 +245,65 @@ KWARGS_CHS_INIT = {
     "chs_multiclass": "path_to_multiclass",
     "tessdata_path": "tessdata_path",
     "chs_memory": "max_memory",
+    "chs_threads": "n_threads",
+    "chs_server": "server_address",
+    "chs_chunk_size": "chunk_size",
+    "chs_chunk_overlap": "chunk_overlap",
+    "chs_chunk_jobs": "chunk_jobs",
+    "chs_chunk_memory": "chunk_max_memory",
+    "chs_opsin_cache": "opsin_cache_path",
+    "std_cache": "standardization_cache_path",
+    "annotation_cache": "annotation_cache_path",
+    "annotation_cache_ttl": "annotation_cache_ttl",
+    "annotation_cache_negative_ttl": "annotation_cache_negative_ttl",
+    "annotation_backend": "annotation_backend",
+    "pubchem_index": "pubchem_index_path",
+    "verbosity": "verbosity"
+}
+
+OPTS_NER_SERVER = [
+    click.option("--chs-jar", type=click.STRING, default="", show_default=True,
+                 help="Path to ChemSpot JAR file. If not set, CHEMSPOT_JAR environment variable is used or 'chemspot.jar' "
+                      "is searched next to 'chemspot' run script."),
+    click.option("--chs-crf", type=click.STRING, default="", show_default=True,
+                 help="Path to a CRF model file (internal default model file will be used if not provided)."),
+    click.option("--chs-nlp", type=click.STRING, default="", show_default=True,
+                 help="Path to a OpenNLP sentence model file (internal default model file will be used if not provided)."),
+    click.option("--chs-dict", type=click.STRING, default="", show_default=True,
+                 help="Path to a zipped set of brics dictionary automata. Disabled by default, use 'dict.zip' for default dictionary."),
+    click.option("--chs-ids", type=click.STRING, default="", show_default=True,
+                 help="Path to a zipped tab-separated text file representing a map of terms to ids. Disabled by default, use 'ids.zip' for default ids."),
+    click.option("--chs-multiclass", type=click.STRING, default="multiclass.bin", show_default=True,
+                 help="Path to a multi-class model file. Enabled by default."),
+    click.option("--chs-memory", type=click.INT, default=8, show_default=True,
+                 help="Maximum amount of memory [GB] which can be allocated for ChemSpot."),
+    click.option("-v", "--verbosity", show_default=True, default=1, type=click.IntRange(min=0, max=2, clamp=True),
+                 help="0, 1 or 2")
+]
+
+OPTS_PUBCHEM_INDEX = [
+    click.option("--inchikey", "inchikey_file", type=click.Path(exists=True, dir_okay=False), required=True,
+                 help="'CID-InChI-Key' file (CID, InChI, InChI key)."),
+    click.option("--smiles", "smiles_file", type=click.Path(exists=True, dir_okay=False), default=None,
+                 help="'CID-SMILES' file (CID, SMILES)."),
+    click.option("--iupac", "iupac_file", type=click.Path(exists=True, dir_okay=False), default=None,
+                 help="'CID-IUPAC' file (CID, IUPAC name)."),
+    click.option("--synonyms", "synonym_file", type=click.Path(exists=True, dir_okay=False), default=None,
+                 help="'CID-Synonym-filtered' file (CID, synonym)."),
+    click.option("--formula", "formula_file", type=click.Path(exists=True, dir_okay=False), default=None,
+                 help="'CID-Mass' file (CID, formula, masses)."),
+    click.option("-v", "--verbosity", show_default=True, default=1, type=click.IntRange(min=0, max=2, clamp=True),
+                 help="0, 1 or 2")
+]
+
+KWARGS_CHS_SERVER = {
+    "chs_jar": "path_to_jar",
+    "chs_crf": "path_to_crf",
+    "chs_nlp": "path_to_nlp",
+    "chs_dict": "path_to_dict",
+    "chs_ids": "path_to_ids",
+    "chs_multiclass": "path_to_multiclass",
+    "chs_memory": "max_memory",
     "verbosity": "verbosity"
 }
 
@@ -186,7 +324,8 @@ KWARGS_CHS_PROCESS = {
     "remove_duplicates": "remove_duplicates",
     "no_annotation": "annotate",
     "annotation_sleep": "annotation_sleep",
-    "chemspider_token": "chemspider_token"
+    "chemspider_token": "chemspider_token",
+    "annotation_workers": "annotation_workers"
 }
 
 OPTS_OCSR_INIT = [
@@ -212,7 +351,12 @@ OPTS_OCSR_INIT = [
     click.option("--osra-superatom-file", type=click.STRING, default="superatom.txt", show_default=True,
                  help="Path to superatom label map to SMILES."),
     click.option("--osra-spelling-file", type=click.STRING, default="spelling.txt", show_default=True,
-                 help="Path to spelling correction dictionary.")
+                 help="Path to spelling correction dictionary."),
+    click.option("--osra-cache", type=click.STRING, default="", show_default=True,
+                 help="Path to SQLite database with cached OSRA output. Page images with the same content and OSRA options "
+                      "are not processed again."),
+    click.option("--osra-cache-size", type=click.INT, default=10000, show_default=True,
+                 help="Maximum number of page images in OSRA cache. Least recently used ones are evicted. If 0, size is not bounded.")
 ]
 
 OPTS_OCSR_PROCESS = [
@@ -220,7 +364,22 @@ OPTS_OCSR_PROCESS = [
     click.option("--gm-dpi", type=click.INT, default=300, show_default=True,
                  help="How many DPI will temporary PNG images have."),
     click.option("--no-gm-trim", show_default=True, is_flag=True, default=False,
-                 help="Don't trim the temporary PNG images.")
+                 help="Don't trim the temporary PNG images."),
+    click.option("--two-pass", show_default=True, is_flag=True, default=False,
+                 help="Process PDF pages at --first-pass-dpi first and again at --gm-dpi only pages with low-confidence "
+                      "structures or with likely structures but none found. Needs 'smi' or 'can' OSRA output format."),
+    click.option("--first-pass-dpi", type=click.IntRange(min=1), default=150, show_default=True,
+                 help="DPI of temporary PNG images in the first pass of --two-pass."),
+    click.option("--min-confidence", type=click.FLOAT, default=0.2, show_default=True,
+                 help="Minimal OSRA's confidence of structures accepted from the first pass of --two-pass."),
+    click.option("--osra-variant", type=click.STRING, multiple=True,
+                 help="Variant of OSRA options for ensemble recognition, e.g. 'rotate=90' or 'negate,adaptive,unpaper=1'. "
+                      "Can be used multiple times. Option names are those of OSRA class (see --osra-* options). Each page is "
+                      "processed with base options and all variants, structures are merged by InChI key keeping the most "
+                      "confident ones. Needs 'smi' or 'can' OSRA output format."),
+    click.option("--osra-ensemble-confidence", type=click.FLOAT, default=0, show_default=True,
+                 help="Skip remaining variants of page once one finds structures all having at least this confidence. "
+                      "If 0, all variants are run.")
 ]
 
 KWARGS_OSRA_INIT = {
@@ -235,6 +394,14 @@ KWARGS_OSRA_INIT = {
     "osra_rotate": "rotate",
     "osra_superatom_file": "superatom_config_path",
     "osra_spelling_file": "spelling_config_path",
+    "osra_cache": "cache_path",
+    "osra_cache_size": "cache_max_entries",
+    "std_cache": "standardization_cache_path",
+    "annotation_cache": "annotation_cache_path",
+    "annotation_cache_ttl": "annotation_cache_ttl",
+    "annotation_cache_negative_ttl": "annotation_cache_negative_ttl",
+    "annotation_backend": "annotation_backend",
+    "pubchem_index": "pubchem_index_path",
     "verbosity": "verbosity"
 }
 
@@ -249,11 +416,22 @@ KWARGS_OSRA_PROCESS = {
     "no_use_gm": "use_gm",
     "gm_dpi": "gm_dpi",
     "no_gm_trim": "gm_trim",
+    "two_pass": "two_pass",
+    "first_pass_dpi": "first_pass_dpi",
+    "min_confidence": "min_confidence",
+    "osra_variant": "ensemble",
+    "osra_ensemble_confidence": "ensemble_min_confidence",
     "jobs": "n_jobs",
+    "osra_figures_only": "figures_only",
+    "osra_prefilter": "prefilter",
+    "osra_prefilter_threshold": "prefilter_threshold",
+    "timeout": "timeout",
+    "cpu_time": "cpu_time",
     "input_type": "input_type",
     "no_standardize": "standardize_mols",
     "no_annotation": "annotate",
-    "chemspider_token": "chemspider_token"
+    "chemspider_token": "chemspider_token",
+    "annotation_workers": "annotation_workers"
 }
 
 OPTS_EXTRACT = [
@@ -267,6 +445,7 @@ OPTS_EXTRACT = [
 
 KWARGS_EXTRACT_INIT = {
     "tessdata_path": "tessdata_path",
+    "memory_budget": "memory_budget",
     "verbosity": "verbosity",
     "verbosity_classes": "verbosity_classes"
 }
@@ -282,13 +461,19 @@ KWARGS_EXTRACT_PROCESS = {
     "lang": "lang",
     "no_use_gm": "use_gm",
     "jobs": "n_jobs",
+    "osra_figures_only": "osra_figures_only",
+    "osra_prefilter": "osra_prefilter",
+    "osra_prefilter_threshold": "osra_prefilter_threshold",
+    "timeout": "timeout",
+    "cpu_time": "cpu_time",
     "opsin_types": "opsin_types",
     "no_standardize": "standardize_mols",
     "remove_duplicates": "remove_entity_duplicates",
     "delimiter": "csv_delimiter",
     "no_annotation": "annotate",
     "annotation_sleep": "annotation_sleep",
-    "chemspider_token": "chemspider_token"
+    "chemspider_token": "chemspider_token",
+    "annotation_workers": "annotation_workers"
 }
 
 ARG_INPUT_FILE_REQUIRED = click.argument("input_file", type=click.STRING, required=True)
@@ -312,6 +497,7 @@ def cli(**kwargs):
                    "cannot be determined automatically.")
 @add_options(OPTS_COMMON_OCSR_NER_CONVERT)
 @add_options(OPTS_COMMON_NER_EXTRACT)
+@add_options(OPTS_COMMON_NER_CONVERT_EXTRACT)
 @add_options(OPTS_COMMON_OCSR_NER_EXTRACT)
 @add_options(OPTS_COMMON_ALL)
 @ARG_INPUT_FILE
@@ -333,13 +519,21 @@ def ner(**kwargs):
             raise click.UsageError("Cannot perform NER: stdin is empty and input file is not provided.")
 
     kwargs["opsin_types"] = get_opsin_types(kwargs["opsin_types"])
+    kwargs["chs_threads"] = get_n_threads(kwargs["chs_threads"])
 
     init_kwargs = get_kwargs(kwargs, KWARGS_CHS_INIT)
     process_kwargs = get_kwargs(kwargs, KWARGS_CHS_PROCESS)
 
+    if kwargs["memory_budget"] > 0:
+        init_kwargs["scheduler"] = MemoryScheduler(kwargs["memory_budget"], verbosity=kwargs["verbosity"])
+
     chemspot = ChemSpot(**init_kwargs)
     result = chemspot.process(input_text=input_text, **process_kwargs)
 
+    if chemspot.scheduler:
+        chemspot.scheduler.report()
+    report_stats(chemspot.logger)
+
     if kwargs["dry_run"]:
         print(result)
         exit(0)
@@ -353,6 +547,27 @@ def ner(**kwargs):
         print(dict_to_csv(result["content"], csv_delimiter=kwargs["delimiter"], write_header=kwargs["no_header"]))
 
 
+@cli.command(name="ner-server",
+             help="Start long-lived ChemSpot worker listening on UNIX socket ADDRESS. ChemSpot models are loaded only once "
+                  "and then used for all texts sent by 'molminer ner --chs-server ADDRESS' or 'molminer extract --chs-server ADDRESS'.")
+@add_options(OPTS_NER_SERVER)
+@click.argument("address", type=click.STRING, required=True)
+def ner_server(**kwargs):
+    server = ChemSpotServer(**get_kwargs(kwargs, KWARGS_CHS_SERVER))
+    server.serve(kwargs["address"])
+
+
+@cli.command(name="pubchem-index",
+             help="Build PubChem index OUTPUT for offline annotation ('--annotation-backend offline') from PubChem bulk "
+                  "files (https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/, can be gzipped). Existing index is updated.")
+@add_options(OPTS_PUBCHEM_INDEX)
+@click.argument("output", type=click.STRING, required=True)
+def pubchem_index(**kwargs):
+    build_pubchem_index(kwargs["output"], kwargs["inchikey_file"], smiles_file=kwargs["smiles_file"] or "",
+                        iupac_file=kwargs["iupac_file"] or "", synonym_file=kwargs["synonym_file"] or "",
+                        formula_file=kwargs["formula_file"] or "", verbosity=kwargs["verbosity"])
+
+
 @cli.command(help="Use OSRA to extract 2D structures from document.")
 @add_options(OPTS_OCSR_INIT)
 @add_options(OPTS_OCSR_PROCESS)
@@ -371,6 +586,7 @@ def ocsr(**kwargs):
     kwargs["no_gm_trim"] = not kwargs["no_gm_trim"]
     kwargs["no_standardize"] = not kwargs["no_standardize"]
     kwargs["no_annotation"] = not kwargs["no_annotation"]
+    kwargs["osra_variant"] = get_osra_variants(kwargs["osra_variant"])
 
     is_output_file = bool(kwargs["output"])
 
@@ -379,6 +595,7 @@ def ocsr(**kwargs):
 
     osra = OSRA(**init_kwargs)
     result = osra.process(output_formats=["smiles", "inchi", "inchikey"], **process_kwargs)
+    report_stats(osra.logger)
 
     if kwargs["dry_run"]:
         print(result)
@@ -399,6 +616,7 @@ def ocsr(**kwargs):
 @add_options(OPTS_COMMON_OCSR_CONVERT)
 @add_options(OPTS_COMMON_OCSR_CONVERT_EXTRACT)
 @add_options(OPTS_COMMON_OCSR_NER_CONVERT)
+@add_options(OPTS_COMMON_NER_CONVERT_EXTRACT)
 @add_options(OPTS_COMMON_ALL)
 @ARG_INPUT_FILE
 def convert(**kwargs):
@@ -412,6 +630,10 @@ def convert(**kwargs):
 
     is_output_file = bool(kwargs["output"])
 
+    if kwargs["stream"]:
+        convert_stream(kwargs)
+        return
+
     stdin = click.get_text_stream("stdin")
     input_text = ""
     if not stdin.isatty():
@@ -423,9 +645,18 @@ def convert(**kwargs):
     init_kwargs = get_kwargs(kwargs, KWARGS_OPSIN_INIT)
     process_kwargs = get_kwargs(kwargs, KWARGS_OPSIN_PROCESS)
 
+    if kwargs["memory_budget"] > 0:
+        init_kwargs["scheduler"] = MemoryScheduler(kwargs["memory_budget"], verbosity=kwargs["verbosity"])
+
     opsin = OPSIN(**init_kwargs)
     result = opsin.process(input=input_text, output_formats=["smiles", "inchi", "inchikey"], **process_kwargs)
 
+    if opsin.scheduler:
+        opsin.scheduler.report()
+    if opsin.cache:
+        opsin.cache.report("OPSIN cache")
+    report_stats(opsin.logger)
+
     if kwargs["dry_run"]:
         print(result)
         exit(0)
@@ -439,6 +670,45 @@ def convert(**kwargs):
         print(dict_to_csv(result["content"], csv_delimiter=kwargs["delimiter"], write_header=kwargs["no_header"]))
 
 
+def convert_stream(kwargs):
+    if kwargs["dry_run"] or kwargs["raw_output"]:
+        raise click.UsageError("'--dry-run' and '--raw-output' cannot be used with '--stream'.")
+
+    stdin = click.get_text_stream("stdin")
+    if kwargs["input_file"]:
+        names = open(kwargs["input_file"], mode="r", encoding="utf-8")
+    elif not stdin.isatty():
+        names = stdin
+    else:
+        raise click.UsageError("Cannot do conversion: stdin is empty and input file is not provided.")
+
+    init_kwargs = get_kwargs(kwargs, KWARGS_OPSIN_INIT)
+    init_kwargs["persistent"] = True
+    if kwargs["memory_budget"] > 0:
+        init_kwargs["scheduler"] = MemoryScheduler(kwargs["memory_budget"], verbosity=kwargs["verbosity"])
+
+    opsin = OPSIN(**init_kwargs)
+    compounds = opsin.iter_process(names, batch_size=kwargs["batch_size"], output_file_sdf=kwargs["sdf_output"],
+                                   sdf_append=kwargs["sdf_append"], output_formats=["smiles", "inchi", "inchikey"],
+                                   standardize_mols=kwargs["no_standardize"], normalize_plurals=kwargs["no_normalize_plurals"],
+                                   n_jobs=kwargs["jobs"], chunk_size=kwargs["chunk_size"])
+
+    output = open(kwargs["output"], mode="w", encoding="utf-8") if kwargs["output"] else click.get_text_stream("stdout")
+    try:
+        iter_to_csv(compounds, output=output, csv_delimiter=kwargs["delimiter"], write_header=kwargs["no_header"],
+                    flush_every=kwargs["batch_size"])
+    finally:
+        names.close()
+        if kwargs["output"]:
+            output.close()
+
+    if opsin.scheduler:
+        opsin.scheduler.report()
+    if opsin.cache:
+        opsin.cache.report("OPSIN cache")
+    report_stats(opsin.logger)
+
+
 @cli.command(help="Combine OSRA, ChemSpot and OPSIN to extract chemical compounds from document.")
 @add_options(OPTS_EXTRACT)
 @click.option("-i", "--input-type", type=click.Choice(["pdf", "pdf_scan", "image"]), show_default=True,
@@ -450,6 +720,7 @@ def convert(**kwargs):
 @add_options(OPTS_COMMON_OCSR_EXTRACT)
 @add_options(OPTS_COMMON_OCSR_CONVERT_EXTRACT)
 @add_options(OPTS_COMMON_NER_EXTRACT)
+@add_options(OPTS_COMMON_NER_CONVERT_EXTRACT)
 @add_options(OPTS_COMMON_OCSR_NER_EXTRACT)
 @add_options(OPTS_COMMON_ALL)
 @ARG_INPUT_FILE_REQUIRED
@@ -464,6 +735,7 @@ def extract(**kwargs):
     kwargs["no_annotation"] = not kwargs["no_annotation"]
 
     kwargs["opsin_types"] = get_opsin_types(kwargs["opsin_types"])
+    kwargs["chs_threads"] = get_n_threads(kwargs["chs_threads"])
 
     is_output_file = bool(kwargs["output"])
 
@@ -493,5 +765,33 @@ def get_opsin_types(types):
 
     return opsin_types
 
+
+def get_osra_variants(variants):
+    parsed = []
+    for variant in variants:
+        options = {}
+        for option in (_.strip() for _ in variant.split(",")):
+            if not option:
+                continue
+            name, _, value = option.partition("=")
+            name = name.strip().replace("-", "_")
+            value = value.strip()
+            if name not in OSRA._OPTIONS_REAL:
+                raise click.BadParameter("Unknown OSRA option '{}'.".format(name), param_hint="--osra-variant")
+            options[name] = False if value.lower() in ["0", "false", "no"] else value if value else True
+        if options:
+            parsed.append(options)
+    return parsed
+
+
+def get_n_threads(n_threads):
+    if n_threads == "auto":
+        return n_threads
+
+    try:
+        return max(0, int(n_threads))
+    except ValueError:
+        raise click.BadParameter("Number of ChemSpot threads must be integer or 'auto'.", param_hint="--chs-threads")
+
 if __name__ == "__main__":
     cli()
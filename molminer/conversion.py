@@ -0,0 +1,281 @@
+from .cache import DiskCache, make_key
+
+from rdkit.Chem import MolFromSmiles, MolFromInchi, MolFromMolBlock, MolToSmiles, MolToInchi, InchiToInchiKey, MolToMolBlock
+import molvs
+from molvs import Standardizer
+
+from collections import OrderedDict
+import logging
+import threading
+
+
+# shared converters of this process, see get_converter()
+_converters = {}
+_converters_lock = threading.Lock()
+# statistics taken from converters (also of worker processes), see take_stats() and report_stats()
+_collected_stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+
+class Molecule(object):
+    """
+    RDKit molecule with its identifiers. Each identifier is computed on first access only, so a molecule is converted
+    at most once to each format and only to requested formats.
+
+    Attributes
+    ----------
+    mol : rdkit.Chem.Mol
+    source : str
+        Input the molecule was created from.
+    smiles : str
+        Canonical isomeric SMILES.
+    inchi : str
+        InChI, empty if it cannot be created.
+    inchikey : str
+        InChI key, empty if InChI cannot be created.
+    molblock : str
+        MOL block with stereo information.
+    """
+
+    def __init__(self, mol, source: str, smiles: str = None):
+        """
+        Parameters
+        ----------
+        mol : rdkit.Chem.Mol
+            If None, it's parsed from `smiles` on first access.
+        source : str
+        smiles : str
+            Canonical isomeric SMILES of `mol`, if known.
+        """
+
+        self._mol = mol
+        self.source = source
+        self._smiles = smiles
+        self._inchi = None
+        self._inchikey = None
+        self._molblock = None
+
+    @property
+    def mol(self):
+        if self._mol is None:
+            # SMILES of molecule which failed to standardize can be unsanitizable
+            self._mol = MolFromSmiles(self._smiles) or MolFromSmiles(self._smiles, sanitize=False)
+        return self._mol
+
+    @property
+    def smiles(self) -> str:
+        if self._smiles is None:
+            self._smiles = MolToSmiles(self.mol, isomericSmiles=True)
+        return self._smiles
+
+    @property
+    def inchi(self) -> str:
+        if self._inchi is None:
+            self._inchi = MolToInchi(self.mol) or ""
+        return self._inchi
+
+    @property
+    def inchikey(self) -> str:
+        if self._inchikey is None:
+            self._inchikey = InchiToInchiKey(self.inchi) if self.inchi else ""
+        return self._inchikey
+
+    @property
+    def molblock(self) -> str:
+        if self._molblock is None:
+            self._molblock = MolToMolBlock(self.mol, includeStereo=True)
+        return self._molblock
+
+
+class MolConverter(object):
+    """
+    Creates (optionally standardized) `Molecule` from SMILES, InChI or MOL block. Molecules are memoized on their
+    input, so the same structure found many times (e.g. on every page or by more tools) is parsed, standardized and
+    converted only once.
+
+    Standardized canonical SMILES of SMILES and InChI inputs can be also stored in `cache` (see `DiskCache`) shared
+    by processes and runs. Molecule found there is created from the stored SMILES without RDKit round trip.
+
+    **Usage:** ::
+
+        converter = MolConverter()
+        molecule, warnings = converter.convert("C1=CC=CC=C1", "smiles")
+        molecule.inchikey  # "UHOVQNZJYSORNB-UHFFFAOYSA-N"
+
+    Attributes
+    ----------
+    standardize : bool
+    max_entries : int
+    cache : DiskCache
+        Persistent cache of standardized SMILES or None.
+    stats : dict
+        "hits" (in memory), "disk_hits" and "misses" of this instance.
+    """
+
+    INPUT_FORMATS = ["smiles", "inchi", "molblock"]
+
+    def __init__(self, standardize: bool = True, max_entries: int = 10000, cache_path: str = "",
+                 cache_max_entries: int = 100000):
+        """
+        Parameters
+        ----------
+        standardize : bool
+            If True, use molvs (https://github.com/mcs07/MolVS) to standardize molecules. Otherwise molecules are
+            sanitized by RDKit.
+        max_entries : int
+            Maximum number of memoized molecules. Least recently used ones are dropped. If 0, nothing is memoized.
+        cache_path : str
+            Path to SQLite database with standardized SMILES. If empty, molecules are memoized only in memory.
+        cache_max_entries : int
+            Maximum number of molecules in `cache`. If 0, the size is not bounded.
+        """
+
+        self.standardize = standardize
+        self.max_entries = max_entries
+        self.cache = DiskCache(cache_path, max_entries=cache_max_entries) if cache_path else None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        self._standardizer = Standardizer() if standardize else None
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _parse(self, source: str, input_format: str):
+        sanitize = not self.standardize
+        if input_format == "smiles":
+            return MolFromSmiles(source, sanitize=sanitize)
+        elif input_format == "inchi":
+            return MolFromInchi(source, sanitize=sanitize, removeHs=sanitize)
+        elif input_format == "molblock":
+            return MolFromMolBlock(source, strictParsing=False, sanitize=sanitize, removeHs=sanitize)
+        else:
+            raise ValueError("Unknown input format. Possible values: {}".format(self.INPUT_FORMATS))
+
+    def convert(self, source: str, input_format: str = "smiles") -> tuple:
+        """
+        Parameters
+        ----------
+        source : str
+            SMILES, InChI or MOL block.
+        input_format : str
+            One of "smiles", "inchi", "molblock".
+
+        Returns
+        -------
+        tuple
+            `Molecule` (None if RDKit cannot parse `source`) and list of warnings. Warnings aren't returned again for
+            `source` memoized in memory.
+        """
+
+        key = (input_format, source)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._memo[key], []
+
+        disk_key = None
+        if self.cache is not None and input_format != "molblock":
+            # MOL block isn't cached, it would lose its coordinates
+            disk_key = make_key("standardization", molvs.__version__, self.standardize, input_format, source)
+            cached = self.cache.get(disk_key)
+        else:
+            cached = None
+
+        if cached is not None:
+            molecule = Molecule(None, source, smiles=cached["smiles"]) if cached["smiles"] else None
+            warnings = cached["warnings"]
+            self.stats["disk_hits"] += 1
+        else:
+            warnings = []
+            mol = self._parse(source, input_format)
+            if mol and self.standardize:
+                try:
+                    mol = self._standardizer.standardize(mol)
+                except ValueError as e:
+                    warnings.append("Cannot standardize '{}': {}".format(source.strip(), str(e)))
+            molecule = Molecule(mol, source) if mol else None
+            self.stats["misses"] += 1
+            if disk_key:
+                self.cache.set(disk_key, {"smiles": molecule.smiles if molecule else "", "warnings": warnings})
+
+        if self.max_entries:
+            with self._lock:
+                self._memo[key] = molecule
+                while len(self._memo) > self.max_entries:
+                    self._memo.popitem(last=False)
+
+        return molecule, warnings
+
+
+def get_converter(standardize: bool = True, cache_path: str = "", cache_max_entries: int = 100000) -> MolConverter:
+    """
+    Return `MolConverter` shared by all callers in this process (e.g. in worker of joblib), so molecules converted
+    by one wrapper are reused by the others.
+
+    Parameters
+    ----------
+    standardize : bool
+    cache_path : str
+    cache_max_entries : int
+        See `MolConverter`.
+
+    Returns
+    -------
+    MolConverter
+    """
+
+    with _converters_lock:
+        key = (standardize, cache_path)
+        if key not in _converters:
+            _converters[key] = MolConverter(standardize=standardize, cache_path=cache_path,
+                                            cache_max_entries=cache_max_entries)
+        return _converters[key]
+
+
+def take_stats() -> dict:
+    """
+    Return summed `stats` of converters of this process and reset them. Worker processes return these to the caller,
+    which passes them to `add_stats`.
+
+    Returns
+    -------
+    dict
+    """
+
+    stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+    with _converters_lock:
+        for converter in _converters.values():
+            for k in stats:
+                stats[k] += converter.stats[k]
+                converter.stats[k] = 0
+    return stats
+
+
+def add_stats(stats: dict):
+    """
+    Add `stats` (see `take_stats`) to statistics reported by `report_stats`.
+    """
+
+    with _converters_lock:
+        for k in _collected_stats:
+            _collected_stats[k] += stats[k]
+
+
+def report_stats(logger: logging.Logger):
+    """
+    Log hit rate of molecule conversion (standardization) cache since the last report and reset it.
+
+    Parameters
+    ----------
+    logger : logging.Logger
+    """
+
+    add_stats(take_stats())
+    with _converters_lock:
+        stats = _collected_stats.copy()
+        for k in _collected_stats:
+            _collected_stats[k] = 0
+
+    total = sum(stats.values())
+    if total:
+        logger.info("Standardization cache: {} of {} molecules found ({:.1%}), {} in memory, {} on disk.".format(
+            stats["hits"] + stats["disk_hits"], total, (stats["hits"] + stats["disk_hits"]) / total, stats["hits"],
+            stats["disk_hits"]))
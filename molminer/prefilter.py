@@ -0,0 +1,238 @@
+import numpy as np
+
+import re
+import subprocess
+
+
+# default minimal number of components likely being 2D structure, low to favour recall
+DEFAULT_THRESHOLD = 1
+
+_PGM_HEADER = re.compile(rb"^P5\s+(?:#[^\n]*\s+)*(\d+)\s+(?:#[^\n]*\s+)*(\d+)\s+(?:#[^\n]*\s+)*(\d+)\s")
+
+
+def read_gray_image(input_file: str, scale: float = 1.0, density: int = 0) -> np.ndarray:
+    """
+    Read image as 8-bit grayscale array, downsampled by GraphicsMagick.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to image. Page of PDF can be read with "file.pdf[<zero-based page>]" and `density`.
+    scale : float
+        Resize factor, e.g. 0.25 to shrink 300 DPI image to 75 DPI.
+    density : int
+        If set, DPI used to render vector input (PDF).
+
+    Returns
+    -------
+    numpy.ndarray
+        2D array of uint8, 0 is black.
+    """
+
+    commands = ["gm", "convert"]
+    if density:
+        commands.extend(["-density", str(density)])
+    commands.extend([input_file, "-colorspace", "Gray"])
+    if scale != 1.0:
+        commands.extend(["-resize", "{:.2f}%".format(scale * 100)])
+    commands.extend(["-depth", "8", "pgm:-"])
+
+    p = subprocess.run(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    match = _PGM_HEADER.match(p.stdout)
+    if p.returncode > 0 or not match:
+        raise RuntimeError("Error when reading image {} with GraphicsMagick. Stderr: {}".format(input_file, p.stderr.decode()))
+
+    width, height, max_value = (int(x) for x in match.groups())
+    if max_value > 255:
+        raise RuntimeError("Unsupported PGM depth of image {}.".format(input_file))
+
+    return np.frombuffer(p.stdout, dtype=np.uint8, count=width * height, offset=match.end()).reshape(height, width)
+
+
+def _shift(array: np.ndarray, dy: int, dx: int) -> np.ndarray:
+    """
+    Return array `out` where out[y, x] = array[y + dy, x + dx]. Pixels outside of `array` are False.
+    """
+
+    height, width = array.shape
+    out = np.zeros_like(array)
+    if abs(dy) >= height or abs(dx) >= width:
+        return out
+    out[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)] = \
+        array[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)]
+    return out
+
+
+def _runs(mask: np.ndarray) -> tuple:
+    """
+    Return rows, starts and (exclusive) ends of horizontal runs of True pixels, sorted by row and start.
+    """
+
+    height, width = mask.shape
+    padded = np.zeros((height, width + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    diff = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(diff == 1)
+    _, ends = np.nonzero(diff == -1)
+    return rows, starts, ends
+
+
+def _label_runs(rows: np.ndarray, starts: np.ndarray, ends: np.ndarray, width: int) -> np.ndarray:
+    """
+    Label 8-connected components of runs from `_runs`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Component label of each run, labels are not consecutive.
+    """
+
+    stride = width + 2
+    starts_flat = rows * stride + starts
+    ends_flat = rows * stride + ends
+
+    # runs in previous row which touch the run (also diagonally)
+    lo = np.searchsorted(ends_flat, (rows - 1) * stride + starts, side="left")
+    hi = np.searchsorted(starts_flat, (rows - 1) * stride + ends, side="right")
+    counts = np.clip(hi - lo, 0, None)
+    offsets = np.cumsum(counts) - counts
+    a = np.repeat(np.arange(len(rows)), counts)
+    b = np.repeat(lo - offsets, counts) + np.arange(counts.sum())
+
+    # propagate minimal label over touching runs, with pointer jumping
+    labels = np.arange(len(rows))
+    while True:
+        new_labels = labels.copy()
+        minimum = np.minimum(labels[a], labels[b])
+        np.minimum.at(new_labels, a, minimum)
+        np.minimum.at(new_labels, b, minimum)
+        new_labels = new_labels[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def structure_boxes(image: np.ndarray,
+                    dpi: int = 100,
+                    ink_threshold: int = 220,
+                    min_size: float = 0.2,
+                    max_fill: float = 0.3,
+                    min_oblique: float = 0.25,
+                    axis_run: float = 0.1) -> list:
+    """
+    Find connected components of ink which look like 2D structure: bonds connect the whole structure to one large
+    and sparse component with many oblique lines. Glyphs of text are small, table grids and plot axes consist of
+    horizontal and vertical lines and photos are dense.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        2D grayscale array, 0 is black.
+    dpi : int
+        Resolution of `image`.
+    ink_threshold : int
+        Pixels darker than this are ink. Thin lines are light gray in downsampled image.
+    min_size : float
+        Minimal size [inches] of component in larger dimension, in smaller one it's a half.
+    max_fill : float
+        Maximal fraction of component's bounding box covered by its pixels.
+    min_oblique : float
+        Minimal fraction of component's pixels not lying in horizontal or vertical lines.
+    axis_run : float
+        Minimal length [inches] of horizontal or vertical line.
+
+    Returns
+    -------
+    list of tuples
+        Bounding boxes (top, left, bottom, right) of components likely being 2D structure, in pixels. Bottom and right
+        are exclusive.
+    """
+
+    ink = image < ink_threshold
+    height, width = ink.shape
+
+    rows, starts, ends = _runs(ink)
+    if not len(rows):
+        return []
+
+    # pixels in horizontal or vertical runs of at least `axis_run` length
+    run_length = max(3, int(round(axis_run * dpi)))
+    horizontal = ink.copy()
+    vertical = ink.copy()
+    for k in range(1, run_length):
+        horizontal &= _shift(ink, 0, k)
+        vertical &= _shift(ink, k, 0)
+    axis = horizontal | vertical
+    for k in range(1, run_length):
+        axis |= _shift(horizontal, 0, -k) | _shift(vertical, -k, 0)
+    oblique_sum = np.concatenate([[0], np.cumsum((ink & ~axis).ravel())])
+
+    labels = _label_runs(rows, starts, ends, width)
+    n = len(labels)
+    pixels = np.bincount(labels, weights=ends - starts, minlength=n)
+    oblique = np.bincount(labels, weights=oblique_sum[rows * width + ends] - oblique_sum[rows * width + starts], minlength=n)
+    top = np.full(n, height)
+    bottom = np.full(n, -1)
+    left = np.full(n, width)
+    right = np.zeros(n, dtype=int)
+    np.minimum.at(top, labels, rows)
+    np.maximum.at(bottom, labels, rows)
+    np.minimum.at(left, labels, starts)
+    np.maximum.at(right, labels, ends)
+    box_height = bottom - top + 1
+    box_width = right - left
+
+    size = min_size * dpi
+    candidates = (np.maximum(box_height, box_width) >= size) & (np.minimum(box_height, box_width) >= size / 2) \
+        & (pixels <= max_fill * box_height * box_width) & (oblique >= min_oblique * pixels)
+    return [(int(top[i]), int(left[i]), int(bottom[i]) + 1, int(right[i])) for i in np.nonzero(candidates)[0]]
+
+
+def structure_score(image: np.ndarray, dpi: int = 100, **kwargs) -> int:
+    """
+    Return number of components likely being 2D structure. See `structure_boxes` for parameters.
+
+    Returns
+    -------
+    int
+    """
+
+    return len(structure_boxes(image, dpi=dpi, **kwargs))
+
+
+def has_structure(input_file: str,
+                  image_dpi: int = 300,
+                  threshold: int = DEFAULT_THRESHOLD,
+                  target_dpi: int = 100,
+                  max_ink_fraction: float = 0.3) -> tuple:
+    """
+    Cheaply estimate if image of page likely contains 2D structure. The estimate is tuned for recall: pages which can't
+    be judged (e.g. photos or scans with dark background) are reported as likely containing structure.
+
+    Parameters
+    ----------
+    input_file : str
+        Path to image.
+    image_dpi : int
+        Resolution of image.
+    threshold : int
+        Minimal score (see `structure_score`) of page likely containing structure.
+    target_dpi : int
+        Image is downsampled to this resolution before computing the score.
+    max_ink_fraction : float
+        Pages with higher fraction of dark pixels are always reported as likely containing structure.
+
+    Returns
+    -------
+    bool, int
+        If the page likely contains structure and its score. Score is -1 for too dark pages.
+    """
+
+    scale = min(1.0, target_dpi / image_dpi)
+    image = read_gray_image(input_file, scale=scale)
+
+    if np.count_nonzero(image < 128) > max_ink_fraction * image.size:
+        return True, -1
+
+    score = structure_score(image, dpi=int(round(image_dpi * scale)))
+    return score >= threshold, score
@@ -0,0 +1,273 @@
+from .conversion import get_converter
+
+from rdkit.Chem import InchiToInchiKey
+
+import gzip
+import logging
+import os
+import sqlite3
+import threading
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+# tables of index, each keyed by CID: table -> (columns, name of PubChem bulk file)
+TABLES = {
+    "inchikey": (["inchi", "inchikey"], "CID-InChI-Key"),
+    "smiles": (["smiles"], "CID-SMILES"),
+    "iupac": (["name"], "CID-IUPAC"),
+    "formula": (["formula"], "CID-Mass")
+}
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS inchikey (cid INTEGER PRIMARY KEY, inchi TEXT NOT NULL, inchikey TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS smiles (cid INTEGER PRIMARY KEY, smiles TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS iupac (cid INTEGER PRIMARY KEY, name TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS formula (cid INTEGER PRIMARY KEY, formula TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS synonym (cid INTEGER NOT NULL, rank INTEGER NOT NULL, name TEXT NOT NULL COLLATE NOCASE)"
+]
+
+# covering indexes, so lookups don't touch tables
+_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS inchikey_inchikey ON inchikey (inchikey, cid)",
+    "CREATE INDEX IF NOT EXISTS formula_formula ON formula (formula, cid)",
+    "CREATE INDEX IF NOT EXISTS synonym_name ON synonym (name COLLATE NOCASE, cid)",
+    "CREATE INDEX IF NOT EXISTS synonym_cid ON synonym (cid, rank, name)"
+]
+
+
+def _read_tsv(path: str):
+    """
+    Yield split lines of tab-separated (optionally gzipped) PubChem bulk file.
+    """
+
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, mode="rt", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            columns = line.rstrip("\n").split("\t")
+            if len(columns) > 1 and columns[0].isdigit():
+                yield columns
+
+
+def build_pubchem_index(path: str,
+                        inchikey_file: str,
+                        smiles_file: str = "",
+                        iupac_file: str = "",
+                        synonym_file: str = "",
+                        formula_file: str = "",
+                        batch_size: int = 100000,
+                        verbosity: int = 1):
+    """
+    Build SQLite index for `PubChemIndex` from PubChem bulk files (https://ftp.ncbi.nlm.nih.gov/pubchem/Compound/Extras/).
+    Files can be gzipped. Existing index is updated.
+
+    Parameters
+    ----------
+    path : str
+        Path to SQLite database of index.
+    inchikey_file : str
+        "CID-InChI-Key" file: CID, InChI and InChI key.
+    smiles_file : str
+        "CID-SMILES" file: CID and SMILES.
+    iupac_file : str
+        "CID-IUPAC" file: CID and IUPAC name.
+    synonym_file : str
+        "CID-Synonym-filtered" file: CID and synonym, one per line, in order of relevance.
+    formula_file : str
+        "CID-Mass" file: CID, molecular formula and masses.
+    batch_size : int
+        Number of rows inserted in one transaction.
+    verbosity : int
+    """
+
+    logger = logging.getLogger("pubchem_index")
+    logger.setLevel(verbosity_levels[min(max(verbosity, 0), 2)])
+
+    connection = sqlite3.connect(path, isolation_level=None)
+    # the index can be rebuilt from files, so durability isn't needed
+    connection.execute("PRAGMA journal_mode=OFF")
+    connection.execute("PRAGMA synchronous=OFF")
+    for statement in _SCHEMA:
+        connection.execute(statement)
+
+    def insert(sql: str, rows, name: str):
+        n = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                connection.execute("BEGIN")
+                connection.executemany(sql, batch)
+                connection.execute("COMMIT")
+                n += len(batch)
+                batch = []
+                logger.info("{}: {} rows...".format(name, n))
+        if batch:
+            connection.execute("BEGIN")
+            connection.executemany(sql, batch)
+            connection.execute("COMMIT")
+            n += len(batch)
+        logger.info("{}: {} rows.".format(name, n))
+
+    for table, input_file in [("inchikey", inchikey_file), ("smiles", smiles_file), ("iupac", iupac_file),
+                              ("formula", formula_file)]:
+        if not input_file:
+            continue
+        columns = TABLES[table][0]
+        insert("INSERT OR REPLACE INTO {} (cid, {}) VALUES (?, {})".format(table, ", ".join(columns),
+                                                                           ", ".join("?" * len(columns))),
+               ((int(x[0]),) + tuple(x[1:len(columns) + 1]) for x in _read_tsv(input_file) if len(x) > len(columns)),
+               table)
+
+    if synonym_file:
+        def synonyms():
+            cid = None
+            rank = 0
+            for x in _read_tsv(synonym_file):
+                rank = rank + 1 if x[0] == cid else 0
+                cid = x[0]
+                yield int(cid), rank, x[1]
+
+        connection.execute("DELETE FROM synonym")
+        connection.execute("DROP INDEX IF EXISTS synonym_name")
+        connection.execute("DROP INDEX IF EXISTS synonym_cid")
+        insert("INSERT INTO synonym (cid, rank, name) VALUES (?, ?, ?)", synonyms(), "synonym")
+
+    logger.info("Creating indexes...")
+    for statement in _INDEXES:
+        connection.execute(statement)
+    connection.execute("ANALYZE")
+    connection.close()
+
+
+class PubChemIndex(object):
+    """
+    Offline lookup of PubChem compounds in index built by `build_pubchem_index`. It answers the same searches as PubChem
+    PUG REST used in annotation: by InChI key, name (synonym, case-insensitive), SMILES, InChI and formula. SMILES and
+    InChI are searched by their InChI key computed by RDKit, i.e. by structure as in PubChem.
+
+    Index can be shared by threads (each one has its own read-only connection) and processes.
+
+    **Usage:** ::
+
+        index = PubChemIndex("pubchem.sqlite")
+        index.search("benzene", "name")  # [{"CID": 241, "IUPACName": "benzene", ...}]
+        index.synonyms(241)
+
+    Attributes
+    ----------
+    path : str
+    """
+
+    NAMESPACES = ["name", "smiles", "inchi", "inchikey", "formula"]
+
+    def __init__(self, path: str):
+        """
+        Parameters
+        ----------
+        path : str
+            Path to SQLite database of index.
+        """
+
+        if not os.path.isfile(path):
+            raise FileNotFoundError("PubChem index not found: {}".format(path))
+        self.path = os.path.abspath(path)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "connection"):
+            self._local.connection = sqlite3.connect("file:{}?mode=ro".format(self.path), uri=True)
+        return self._local.connection
+
+    def _to_inchikey(self, identifier: str, namespace: str) -> str:
+        if namespace == "inchi":
+            return InchiToInchiKey(identifier) or ""
+        molecule, _ = get_converter(standardize=False).convert(identifier, "smiles")
+        return molecule.inchikey if molecule else ""
+
+    def search_cids(self, identifier: str, namespace: str) -> list:
+        """
+        Parameters
+        ----------
+        identifier : str
+        namespace : str
+            One of "name", "smiles", "inchi", "inchikey", "formula".
+
+        Returns
+        -------
+        list of int
+            CIDs ordered by CID.
+        """
+
+        if namespace not in self.NAMESPACES:
+            raise ValueError("Unknown namespace. Possible values: {}".format(self.NAMESPACES))
+
+        if namespace in ["smiles", "inchi"]:
+            identifier = self._to_inchikey(identifier, namespace)
+            namespace = "inchikey"
+        if not identifier:
+            return []
+
+        connection = self._connect()
+        if namespace == "inchikey":
+            rows = connection.execute("SELECT cid FROM inchikey WHERE inchikey = ? ORDER BY cid", (identifier,))
+        elif namespace == "formula":
+            rows = connection.execute("SELECT cid FROM formula WHERE formula = ? ORDER BY cid", (identifier,))
+        else:
+            rows = connection.execute("SELECT DISTINCT cid FROM synonym WHERE name = ? ORDER BY cid", (identifier,))
+        return [x[0] for x in rows]
+
+    def properties(self, cids: list) -> list:
+        """
+        Returns
+        -------
+        list of dicts
+            Properties of `cids` with the same keys as in PubChem PUG REST: "CID", "IUPACName", "CanonicalSMILES",
+            "InChI", "InChIKey". Missing properties are empty strings.
+        """
+
+        connection = self._connect()
+        properties = [{"CID": cid, "IUPACName": "", "CanonicalSMILES": "", "InChI": "", "InChIKey": ""} for cid in cids]
+        by_cid = {x["CID"]: x for x in properties}
+        # SQLite limits number of host parameters
+        for i in range(0, len(cids), 500):
+            batch = cids[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            for table, sql, keys in [
+                    ("inchikey", "SELECT cid, inchi, inchikey FROM inchikey WHERE cid IN ({})", ["InChI", "InChIKey"]),
+                    ("smiles", "SELECT cid, smiles FROM smiles WHERE cid IN ({})", ["CanonicalSMILES"]),
+                    ("iupac", "SELECT cid, name FROM iupac WHERE cid IN ({})", ["IUPACName"])]:
+                for row in connection.execute(sql.format(placeholders), batch):
+                    by_cid[row[0]].update(zip(keys, row[1:]))
+        return properties
+
+    def search(self, identifier: str, namespace: str) -> list:
+        """
+        Returns
+        -------
+        list of dicts
+            Properties of found compounds, see `properties`.
+        """
+
+        return self.properties(self.search_cids(identifier, namespace))
+
+    def synonyms(self, cid: int) -> list:
+        """
+        Returns
+        -------
+        list of str
+            Synonyms in order of relevance.
+        """
+
+        return [x[0] for x in self._connect().execute("SELECT name FROM synonym WHERE cid = ? ORDER BY rank", (cid,))]
@@ -0,0 +1,229 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+
+logging.basicConfig(format="[%(levelname)s - %(filename)s:%(funcName)s:%(lineno)s] %(message)s")
+verbosity_levels = {
+    0: 100,
+    1: logging.WARNING,
+    2: logging.INFO
+}
+
+
+class MemoryScheduler(object):
+    """
+    Node-level scheduler of Java processes (ChemSpot, OPSIN) which keeps the sum of their maximum heap sizes under
+    the memory budget. Launch which doesn't fit to the budget waits until other processes finish.
+
+    Reservations are kept in a JSON state file guarded by file lock, so the budget is shared by all threads and
+    processes on one host which use the same `state_file`. Reservations of dead processes are released automatically.
+
+    **Usage:** ::
+
+        scheduler = MemoryScheduler(budget=32)
+        memory = scheduler.heap_size("chemspot", input_size=len(text), max_memory=8)
+        with scheduler.reserve(memory, tool="chemspot"):
+            ...  # launch Java process with -Xmx{memory}G
+
+    Attributes
+    ----------
+    HEAP_MODELS : dict
+        | Tool name -> (base heap [GB], additional heap [GB] per MB of input).
+        | Base heap is needed to load models or dictionaries.
+    stats : dict
+        "launches", "queued" (launches which had to wait), "wait_time" and "max_wait_time" [s] of this instance.
+    """
+
+    HEAP_MODELS = {
+        "chemspot": (3, 1.0),
+        "chemspot_dict": (12, 1.0),
+        "opsin": (1, 0.5)
+    }
+
+    logger = logging.getLogger("scheduler")
+
+    def __init__(self,
+                 budget: float,
+                 state_file: str = "",
+                 poll_interval: float = 0.5,
+                 verbosity: int = 1):
+        """
+        Parameters
+        ----------
+        budget : float
+            Total memory [GB] which can be used by Java processes on this host.
+        state_file : str
+            Path to file with reservations. All schedulers sharing the budget must use the same file.
+            Default is "molminer-memory.json" in temporary directory.
+        poll_interval : float
+            How many seconds to wait between checks of free memory when launch is queued.
+        verbosity : int
+            This class's verbosity. Values: 0, 1, 2
+        """
+
+        if verbosity > 2:
+            verbosity = 2
+        elif verbosity not in verbosity_levels:
+            verbosity = 1
+        self.logger.setLevel(verbosity_levels[verbosity])
+
+        if budget <= 0:
+            raise ValueError("Memory budget must be positive.")
+
+        self.budget = budget
+        self.state_file = state_file or os.path.join(tempfile.gettempdir(), "molminer-memory.json")
+        self.lock_file = self.state_file + ".lock"
+        self.poll_interval = poll_interval
+        self.stats = {"launches": 0, "queued": 0, "wait_time": 0.0, "max_wait_time": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_stats_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+
+    def heap_size(self, tool: str, input_size: int = 0, max_memory: int = 0) -> int:
+        """
+        Estimate the maximum heap size of Java process from size of its input.
+
+        Parameters
+        ----------
+        tool : str
+            One of `HEAP_MODELS` keys.
+        input_size : int
+            Size of input in bytes (or characters).
+        max_memory : int
+            Upper limit [GB], e.g. the one set by user. 0 means no limit.
+
+        Returns
+        -------
+        int
+            Heap size [GB]. It never exceeds the budget.
+        """
+
+        base, per_mb = self.HEAP_MODELS[tool]
+        memory = int(math.ceil(base + per_mb * input_size / 1e6))
+        if max_memory:
+            memory = min(memory, max_memory)
+        return max(1, min(memory, int(self.budget)))
+
+    @contextmanager
+    def reserve(self, memory: float, tool: str = ""):
+        """
+        Context manager which waits until `memory` fits to the budget and holds the reservation until exit.
+
+        Parameters
+        ----------
+        memory : float
+            Memory [GB] to reserve. If larger than budget, the whole budget is reserved.
+        tool : str
+            Name of tool, only for information in state file and log.
+
+        Yields
+        ------
+        float
+            Time [s] spent waiting in queue.
+        """
+
+        if memory > self.budget:
+            self.logger.warning("Requested memory for {} ({} GB) is larger than the budget ({} GB).".format(tool, memory, self.budget))
+            memory = self.budget
+
+        reservation_id = uuid.uuid4().hex
+        start = time.monotonic()
+        queued = False
+
+        while not self._try_reserve(reservation_id, memory, tool):
+            if not queued:
+                queued = True
+                self.logger.info("Waiting for {} GB of memory for {}...".format(memory, tool))
+            time.sleep(self.poll_interval)
+
+        wait_time = time.monotonic() - start
+        with self._stats_lock:
+            self.stats["launches"] += 1
+            self.stats["queued"] += int(queued)
+            self.stats["wait_time"] += wait_time
+            self.stats["max_wait_time"] = max(self.stats["max_wait_time"], wait_time)
+        if queued:
+            self.logger.info("{} waited {:.1f} s for {} GB of memory.".format(tool, wait_time, memory))
+
+        try:
+            yield wait_time
+        finally:
+            self._release(reservation_id)
+
+    def report(self):
+        """
+        Log the summary of `stats`.
+        """
+
+        self.logger.info("Memory scheduler: {launches} Java launches, {queued} queued, total wait {wait_time:.1f} s, "
+                         "max wait {max_wait_time:.1f} s.".format(**self.stats))
+
+    def used(self) -> float:
+        """
+        Returns
+        -------
+        float
+            Memory [GB] currently reserved by all live processes.
+        """
+
+        with self._locked_state() as reservations:
+            return sum(x["memory"] for x in reservations)
+
+    def _try_reserve(self, reservation_id: str, memory: float, tool: str) -> bool:
+        with self._locked_state() as reservations:
+            if sum(x["memory"] for x in reservations) + memory > self.budget:
+                return False
+            reservations.append({"id": reservation_id, "pid": os.getpid(), "memory": memory, "tool": tool})
+            return True
+
+    def _release(self, reservation_id: str):
+        with self._locked_state() as reservations:
+            reservations[:] = [x for x in reservations if x["id"] != reservation_id]
+
+    @contextmanager
+    def _locked_state(self):
+        """
+        Lock the state file, yield list of live reservations and write it back.
+        """
+
+        with open(self.lock_file, mode="a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.state_file, mode="r", encoding="utf-8") as f:
+                        reservations = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    reservations = []
+
+                reservations = [x for x in reservations if self._is_alive(x["pid"])]
+                yield reservations
+
+                with open(self.state_file, mode="w", encoding="utf-8") as f:
+                    json.dump(reservations, f)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _is_alive(pid: int) -> bool:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
@@ -3,24 +3,56 @@ import magic
 import sys
 from collections import namedtuple
 import subprocess
-from typing import Union
+import signal
+import resource
+import time
+from typing import Union, Iterable
 from tempfile import TemporaryDirectory
-from typing import Union
 import os
 from glob import glob
 import csv
 from io import StringIO
 import re
+import hashlib
 
 
 Output = namedtuple("Output", ["stdout", "stderr", "exit_code"])
 
 
+class SubprocessTimeoutError(RuntimeError):
+    """
+    Raised by `common_subprocess` when the process was killed after exceeding its wall-clock timeout or CPU time limit.
+
+    Attributes
+    ----------
+    commands : list
+    elapsed : float
+        Wall-clock time [s] until the process was killed.
+    limit : str
+        Description of exceeded limit.
+    """
+
+    def __init__(self, commands: list, elapsed: float, limit: str):
+        self.commands = commands
+        self.elapsed = elapsed
+        self.limit = limit
+        super().__init__("'{}' was killed after {:.1f} s: exceeded {}.".format(commands[0], elapsed, limit))
+
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-def common_subprocess(commands: Union[list, str], stdin: str = "", stdin_encoding: str = "utf-8") -> namedtuple:
+def _kill_process_group(p: subprocess.Popen):
+    try:
+        os.killpg(p.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    p.communicate()
+
+
+def common_subprocess(commands: Union[list, str], stdin: str = "", stdin_encoding: str = "utf-8", env: dict = None,
+                      timeout: float = 0, cpu_time: int = 0) -> namedtuple:
     """
     Return the namedtuple with stdout, stderr and exit code from shell command.
 
@@ -31,6 +63,16 @@ def common_subprocess(commands: Union[list, str], stdin: str = "", stdin_encodin
     stdin : str
         Stdin to send to shell.
     stdin_encoding : str
+    env : dict
+        Environment variables of the process. If None, the current environment is inherited.
+    timeout : float
+        | Wall-clock timeout [s]. If exceeded, the process and all its children are killed and `SubprocessTimeoutError`
+          is raised.
+        | If 0, wait until the process ends.
+    cpu_time : int
+        | CPU time limit [s] of the process (RLIMIT_CPU). If exceeded, the process is killed by the system and
+          `SubprocessTimeoutError` is raised.
+        | If 0, CPU time is not limited.
 
     Returns
     -------
@@ -41,12 +83,29 @@ def common_subprocess(commands: Union[list, str], stdin: str = "", stdin_encodin
     if isinstance(commands, str):
         commands = commands.split()
 
-    p = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
-    if stdin:
-        stdout, stderr = p.communicate(input=bytes(stdin, encoding=stdin_encoding))
-    else:
-        stdout, stderr = p.communicate()
-    p.wait()
+    def set_cpu_limit():
+        # soft limit sends SIGXCPU, hard limit SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_time, cpu_time + 1))
+
+    # with limits the process gets its own process group, so its children (e.g. Ghostscript run by gm) are killed too
+    limited = bool(timeout or cpu_time)
+    start = time.time()
+    p = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, env=env,
+                         preexec_fn=set_cpu_limit if cpu_time else None, start_new_session=limited)
+    try:
+        stdout, stderr = p.communicate(input=bytes(stdin, encoding=stdin_encoding) if stdin else None,
+                                       timeout=timeout if timeout else None)
+    except subprocess.TimeoutExpired:
+        _kill_process_group(p)
+        raise SubprocessTimeoutError(commands, time.time() - start, "timeout of {} s".format(timeout))
+    except BaseException:
+        # process in own process group doesn't get e.g. SIGINT from terminal
+        if limited:
+            _kill_process_group(p)
+        raise
+
+    if cpu_time and p.returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+        raise SubprocessTimeoutError(commands, time.time() - start, "CPU time limit of {} s".format(cpu_time))
     stdout = stdout.decode()
     stderr = stderr.decode()
     return Output(stdout=stdout, stderr=stderr, exit_code=p.returncode)
@@ -75,7 +134,10 @@ def get_text_from_pdf_scan(input_file: str,
                            lang: str = "eng",
                            tessdata_prefix: str = "",
                            tesseract_engine: int = 2,
-                           as_page_list: bool = False)-> Union[str, TemporaryDirectory]:
+                           as_page_list: bool = False,
+                           timeout: float = 0,
+                           cpu_time: int = 0,
+                           timeouts: list = None) -> Union[str, TemporaryDirectory]:
     """
     Get text from PDF which consists of scanned pages (images). First convert PDF to PNG images (one image per page) and
     then apply Tesseract OCR to get text.
@@ -98,6 +160,16 @@ def get_text_from_pdf_scan(input_file: str,
             | 3    Default, based on what is available.
     as_page_list : bool
         If True, return list of text of individual pages.
+    timeout : float
+        | Wall-clock timeout [s] of Tesseract for one page. See `common_subprocess`.
+        | Rendering of the whole document by gm gets this timeout multiplied by number of pages (see `pdf_limits`)
+          and raises `SubprocessTimeoutError` when exceeded.
+    cpu_time : int
+        CPU time limit [s] of Tesseract for one page. Scaled for gm like `timeout`.
+    timeouts : list
+        | If set, pages on which Tesseract was killed (see `timeout` and `cpu_time`) are appended to this list as dicts
+          with "page", "tool" and "elapsed" keys and their text is empty.
+        | If None, `SubprocessTimeoutError` is raised.
 
     Returns
     -------
@@ -118,7 +190,8 @@ def get_text_from_pdf_scan(input_file: str,
     temp_dir = TemporaryDirectory()
     convert_cmd = "gm convert -density 300 {input_file_path} +adjoin -depth 8 -quality 100 {temp_dir}/{input_file}-0%d.png".format(
         input_file_path=input_file_path, input_file=input_file, temp_dir=temp_dir.name)
-    stdout, stderr, exit_code = common_subprocess(convert_cmd.split())
+    gm_timeout, gm_cpu_time = pdf_limits(input_file_path, timeout, cpu_time)
+    stdout, stderr, exit_code = common_subprocess(convert_cmd.split(), timeout=gm_timeout, cpu_time=gm_cpu_time)
     if exit_code > 0:
         raise RuntimeError("Error converting scanned PDF to image. Stderr: {}".format(stderr))
 
@@ -128,7 +201,14 @@ def get_text_from_pdf_scan(input_file: str,
         lang=lang, tessdata_prefix=tessdata_prefix)
 
     for file, page in get_temp_images(temp_dir.name):
-        _text, stderr, exit_code = common_subprocess(ocr_cmd.format(image_file=file).split())
+        try:
+            _text, stderr, exit_code = common_subprocess(ocr_cmd.format(image_file=file).split(), timeout=timeout,
+                                                         cpu_time=cpu_time)
+        except SubprocessTimeoutError as e:
+            if timeouts is None:
+                raise
+            timeouts.append({"page": page, "tool": "tesseract", "elapsed": e.elapsed})
+            _text, exit_code = "", 0
         if exit_code > 0:
             raise RuntimeError("Tesseract OCR error. Stderr: {}".format(stderr))
         if as_page_list:
@@ -136,12 +216,15 @@ def get_text_from_pdf_scan(input_file: str,
         else:
             text += "\f" + _text
 
-    return pages, temp_dir if as_page_list else text, temp_dir
+    return (pages if as_page_list else text), temp_dir
 
 
 def get_text_from_image(input_file: str,
                         lang: str = "eng",
-                        tessdata_prefix: str = "") -> str:
+                        tessdata_prefix: str = "",
+                        timeout: float = 0,
+                        cpu_time: int = 0,
+                        timeouts: list = None) -> str:
     """
     Get text from image using Tesseract OCR.
 
@@ -153,6 +236,14 @@ def get_text_from_image(input_file: str,
         | Multiple languages can be specified with "+" character, i.e. "eng+bul+fra".
     tessdata_prefix : str
         Path to directory with Tesseract language data. If empty, the TESSDATA_PREFIX environment variable will be used.
+    timeout : float
+        Wall-clock timeout [s] of Tesseract. See `common_subprocess`.
+    cpu_time : int
+        CPU time limit [s] of Tesseract.
+    timeouts : list
+        | If set and Tesseract was killed, dict with "page", "tool" and "elapsed" keys is appended to it and empty text
+          is returned.
+        | If None, `SubprocessTimeoutError` is raised.
 
     Returns
     -------
@@ -164,7 +255,13 @@ def get_text_from_image(input_file: str,
 
     ocr_cmd = "tesseract {input_file} stdout -l {lang} {tessdata_prefix}".format(
         input_file=input_file, lang=lang, tessdata_prefix=tessdata_prefix)
-    text, stderr, exit_code = common_subprocess(ocr_cmd.split())
+    try:
+        text, stderr, exit_code = common_subprocess(ocr_cmd.split(), timeout=timeout, cpu_time=cpu_time)
+    except SubprocessTimeoutError as e:
+        if timeouts is None:
+            raise
+        timeouts.append({"page": 1, "tool": "tesseract", "elapsed": e.elapsed})
+        return ""
     if exit_code > 0:
         raise RuntimeError("Tesseract OCR error. Stderr: {}".format(stderr))
     return text
@@ -194,13 +291,16 @@ def get_input_file_type(input_file: str) -> str:
         return mime_type
 
 
-def get_text(input_file: str, input_type: str, lang: str = "en", tessdata_prefix: str = "") -> str:
+def get_text(input_file: str, input_type: str, lang: str = "en", tessdata_prefix: str = "", timeout: float = 0,
+             cpu_time: int = 0, timeouts: list = None) -> str:
     if input_type == "pdf":
         return get_text_from_pdf(input_file), None
     elif input_type == "pdf_scan":
-        return get_text_from_pdf_scan(input_file, lang=lang, tessdata_prefix=tessdata_prefix)
+        return get_text_from_pdf_scan(input_file, lang=lang, tessdata_prefix=tessdata_prefix, timeout=timeout,
+                                      cpu_time=cpu_time, timeouts=timeouts)
     elif input_type == "image":
-        return get_text_from_image(input_file, lang=lang, tessdata_prefix=tessdata_prefix), None
+        return get_text_from_image(input_file, lang=lang, tessdata_prefix=tessdata_prefix, timeout=timeout,
+                                   cpu_time=cpu_time, timeouts=timeouts), None
     else:
         raise ValueError("Unknown 'input_type': {}".format(input_type))
 
@@ -232,6 +332,52 @@ def dict_to_csv(dicts: list, output_file: str = "", csv_delimiter: str = ";", wr
         output.close()
 
 
+def iter_to_csv(dicts: Iterable, output=sys.stdout, csv_delimiter: str = ";", write_header: bool = True,
+                flush_every: int = 1000) -> int:
+    """
+    Write dicts to CSV as they come, e.g. from generator. Columns are given by keys of the first dict.
+
+    Parameters
+    ----------
+    dicts : iterable
+    output : file-like object
+    csv_delimiter : str
+    write_header : bool
+    flush_every : int
+        Flush `output` after each this number of rows, so the rows reach the next process in pipeline.
+
+    Returns
+    -------
+    int
+        Number of written rows.
+    """
+
+    w = None
+    n = 0
+    for n, row in enumerate(dicts, start=1):
+        if w is None:
+            w = csv.DictWriter(output, row.keys(), delimiter=csv_delimiter)
+            if write_header:
+                w.writeheader()
+        w.writerow(row)
+        if n % flush_every == 0:
+            output.flush()
+    output.flush()
+    return n
+
+
+def file_hash(file: str, block_size: int = 1 << 20) -> str:
+    """
+    Return SHA-256 hex digest of file content.
+    """
+
+    h = hashlib.sha256()
+    with open(file, mode="rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 def write_empty_file(file: str, csv_delimiter: str = ";", header: list = None, write_header: bool = False):
     with open(file, mode="w", encoding="utf-8") as f:
         if header and write_header:
@@ -247,13 +393,157 @@ def get_temp_images(temp_dir):
 
 def pdf_to_images(input_file_path, output_dir,
                   gm_command="gm convert -density {dpi} {input_file_path} +adjoin {trim} -quality 100 {temp_dir}/{input_file}-%d.png",
-                  dpi=300, trim=True):
+                  dpi=300, trim=True, timeout=0, cpu_time=0):
     trim = "-trim" if trim else ""
     stdout, stderr, exit_code = common_subprocess(
         gm_command.format(dpi=dpi, trim=trim, input_file_path=input_file_path,
-                          input_file=os.path.basename(input_file_path), temp_dir=output_dir))
+                          input_file=os.path.basename(input_file_path), temp_dir=output_dir),
+        timeout=timeout, cpu_time=cpu_time)
 
     if exit_code > 0:
         raise RuntimeError("Error when converting PDF to PNG images. Stderr: {}".format(stderr))
 
     return stdout, stderr, exit_code
+
+
+def get_pdf_page_count(input_file: str) -> int:
+    """
+    Get number of pages in PDF using pdfinfo binary (part of poppler-utils).
+
+    Parameters
+    ----------
+    input_file : str
+
+    Returns
+    -------
+    int
+    """
+
+    stdout, stderr, exit_code = common_subprocess(["pdfinfo", input_file])
+    match = re.search(r"^Pages:\s+(\d+)", stdout, flags=re.MULTILINE)
+    if exit_code > 0 or not match:
+        raise RuntimeError("Error when reading number of pages from PDF with pdfinfo. Stderr: {}".format(stderr))
+    return int(match.group(1))
+
+
+def pdf_limits(input_file: str, timeout: float = 0, cpu_time: int = 0, n_pages: int = 0) -> tuple:
+    """
+    Scale per-page limits for tools processing the whole PDF at once (e.g. gm rendering all pages).
+
+    Parameters
+    ----------
+    input_file : str
+    timeout : float
+        Wall-clock timeout [s] for one page.
+    cpu_time : int
+        CPU time limit [s] for one page.
+    n_pages : int
+        Number of pages, if known. Otherwise it's read by pdfinfo or, when pdfinfo fails, estimated from page objects
+        in the file (at least 1).
+
+    Returns
+    -------
+    tuple
+        (timeout, cpu_time) for the whole document. Zero limits stay zero.
+    """
+
+    if not timeout and not cpu_time:
+        return timeout, cpu_time
+
+    if not n_pages:
+        try:
+            n_pages = get_pdf_page_count(input_file)
+        except (RuntimeError, OSError):
+            with open(input_file, mode="rb") as f:
+                n_pages = max(1, len(re.findall(rb"/Type\s*/Page\b", f.read())))
+
+    return timeout * n_pages, cpu_time * n_pages
+
+
+def pdf_page_to_image(input_file_path: str, page: int, output_file: str, dpi: int = 300, trim: bool = True,
+                      crop: tuple = None, timeout: float = 0):
+    """
+    Convert one page of PDF to PNG image using GraphicsMagick.
+
+    Parameters
+    ----------
+    input_file_path : str
+    page : int
+        Zero-based page index.
+    output_file : str
+    dpi : int
+    trim : bool
+        If True, trim the image borders.
+    crop : tuple
+        If set, only region (left, top, width, height) of page [pixels at `dpi`] is written. `trim` is then ignored,
+        so the region stays at known position.
+    timeout : float
+        Wall-clock timeout [s], see `common_subprocess`.
+    """
+
+    commands = ["gm", "convert", "-density", str(dpi), "{}[{}]".format(input_file_path, page)]
+    if crop:
+        commands.extend(["-crop", "{2}x{3}+{0}+{1}".format(*crop), "+page"])
+    elif trim:
+        commands.append("-trim")
+    commands.extend(["-quality", "100", output_file])
+
+    stdout, stderr, exit_code = common_subprocess(commands, timeout=timeout)
+
+    if exit_code > 0:
+        raise RuntimeError("Error when converting page {} of PDF to PNG image. Stderr: {}".format(page + 1, stderr))
+
+    return stdout, stderr, exit_code
+
+
+def get_pdf_image_boxes(input_file: str, temp_dir: str, min_size: float = 0.3, timeout: float = 0,
+                        cpu_time: int = 0) -> dict:
+    """
+    Get positions of raster images embedded in PDF using pdftohtml binary (part of poppler-utils).
+
+    Parameters
+    ----------
+    input_file : str
+    temp_dir : str
+        Directory for pdftohtml output (XML and extracted images).
+    min_size : float
+        Images smaller than this [inches] in both dimensions (logos, icons, rules) are left out.
+    timeout : float
+        Wall-clock timeout [s] of pdftohtml, see `common_subprocess`.
+    cpu_time : int
+        CPU time limit [s] of pdftohtml.
+
+    Returns
+    -------
+    dict
+        Page number (starting from 1) -> list of boxes (left, top, width, height) in points (1/72 inch).
+    """
+
+    output_prefix = os.path.join(temp_dir, "images")
+    stdout, stderr, exit_code = common_subprocess(["pdftohtml", "-xml", "-zoom", "1", "-q", "-nodrm", input_file,
+                                                   output_prefix], timeout=timeout, cpu_time=cpu_time)
+    if exit_code > 0 or not os.path.isfile(output_prefix + ".xml"):
+        raise RuntimeError("Error when reading images from PDF with pdftohtml. Stderr: {}".format(stderr))
+
+    with open(output_prefix + ".xml", mode="r", encoding="utf-8", errors="replace") as f:
+        xml = f.read()
+    # only positions are needed
+    for file in glob(output_prefix + "*"):
+        os.remove(file)
+
+    boxes = {}
+    page = 0
+    # XML is not parsed as a whole, because pdftohtml can write invalid characters from text
+    for match in re.finditer(r'<page number="(\d+)"|<image ([^>]*)>', xml):
+        if match.group(1):
+            page = int(match.group(1))
+            continue
+        attributes = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+        try:
+            box = tuple(float(attributes[x]) for x in ["left", "top", "width", "height"])
+        except (KeyError, ValueError):
+            continue
+        if max(box[2], box[3]) >= min_size * 72:
+            boxes.setdefault(page, []).append(box)
+
+    return boxes
@@ -21,7 +21,8 @@ setup(
     zip_safe=False,
     entry_points={'console_scripts': ['molminer = molminer.cli:cli']},
     #tests_require=['pytest'],
-    install_requires=['joblib', 'molvs', 'python-magic', 'click', 'pubchempy', 'chemspipy'],
+    install_requires=['numpy', 'joblib', 'molvs', 'python-magic', 'click', 'requests'],
+    extras_require={'server': ['JPype1']},
     classifiers=[
         'Intended Audience :: Developers',
         'Intended Audience :: Science/Research',